@@ -0,0 +1,218 @@
+"""
+Build several books from one manifest.
+
+    python batch.py books.json --jobs 8
+
+The manifest is a JSON object with a "books" list and optional "defaults":
+
+    {
+        "defaults": {"folder_name": "Test-First Copilot", "reference_docx": "custom-reference.docx"},
+        "books": [
+            {"name": "greenfield", "output": "book.docx", "chapters_file": "chapters.txt"},
+            {"name": "new", "output": "book-new.docx", "chapters_file": "chapters_new.txt"}
+        ]
+    }
+
+Relative paths are resolved against the manifest's directory.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from convert import (
+    DEFAULT_HEADER_TEXT, PYGMENTS_THEME, RenderPool, cached_reference_docx, convert_markdowns_to_docx,
+    make_preprocessor, read_chapter,
+)
+
+# Options a book (or the manifest's defaults) can set, passed on to convert_markdowns_to_docx
+BOOK_OPTIONS = ("output", "chapters_file", "md_files", "folder_name", "reference_docx", "header_text",
+                "optimize_images", "joplin_export", "strict", "theme", "prehighlight")
+PATH_OPTIONS = ("output", "chapters_file", "folder_name", "reference_docx", "joplin_export")
+
+
+def load_manifest(path):
+    """
+    Read a batch manifest and return its books as dicts with a "name" and
+    the BOOK_OPTIONS they set, defaults applied and paths made absolute.
+    """
+    with open(path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    defaults = manifest.get("defaults", {})
+    books = []
+    for i, entry in enumerate(manifest.get("books", [])):
+        book = {**defaults, **entry}
+        name = (book.pop("name", None) or os.path.splitext(os.path.basename(book.get("output", "")))[0]
+                or f"book{i + 1}")
+        unknown = sorted(set(book) - set(BOOK_OPTIONS))
+        if unknown:
+            raise ValueError(f"Book {name!r}: unknown options {', '.join(unknown)}")
+        if not book.get("output"):
+            raise ValueError(f"Book {name!r}: no output file")
+        for key in PATH_OPTIONS:
+            if book.get(key):
+                book[key] = os.path.join(base, book[key])
+        if book.get("md_files"):
+            book["md_files"] = [f if os.path.isabs(f) or book.get("folder_name") else os.path.join(base, f)
+                                for f in book["md_files"]]
+        books.append({"name": name, **book})
+    if not books:
+        raise ValueError(f"No books in {path}")
+    outputs = [book["output"] for book in books]
+    if len(set(outputs)) != len(outputs):
+        raise ValueError("Several books write to the same output file")
+    return books
+
+
+class SharedPreprocessor:
+    """
+    Preprocessor wrapper that remembers its output by the hash of its input,
+    so a chapter that appears in several books is preprocessed (and its
+    images optimized) once per batch. Stats of a remembered result are
+    replayed, so traces count its images and code blocks in every book.
+    """
+
+    def __init__(self, preprocessor):
+        self.preprocessor = preprocessor
+        self.code_renderer = preprocessor.code_renderer
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def process(self, md, stats=None):
+        key = hashlib.sha1(md.encode("utf-8")).digest()
+        with self._lock:
+            result = self._results.get(key)
+        if result is None:
+            run_stats = {}
+            result = (self.preprocessor.process(md, run_stats), run_stats)
+            with self._lock:
+                result = self._results.setdefault(key, result)
+        if stats is not None:
+            for name, count in result[1].items():
+                stats[name] = stats.get(name, 0) + count
+        return result[0]
+
+
+class SharedReader:
+    """Chapter reader that reads each file once per batch."""
+
+    def __init__(self):
+        self._texts = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, path):
+        key = os.path.abspath(path)
+        with self._lock:
+            text = self._texts.get(key)
+        if text is None:
+            text = read_chapter(path)
+            with self._lock:
+                text = self._texts.setdefault(key, text)
+        return text
+
+
+def build_books(books, jobs=4, cache_dir=None):
+    """
+    Build every book, scheduling all pandoc runs on one RenderPool.
+    Books are built as fragment builds sharing one fragment cache, so a part
+    page or chapter that renders the same in several books is rendered once.
+    Chapter files, preprocessed markdown, optimized images and reference
+    templates are shared across books too.
+    Args:
+        books: Books as returned by load_manifest
+        jobs: Number of pandoc processes to run at once
+        cache_dir: Optional cache root. Without one, fragments go to a cache
+            that is removed once the batch is done
+    Returns one result dict per book, in order, with "name", "output",
+    "status" ("ok" or "failed"), "error" and "wall_s".
+    """
+    scratch_dir = None if cache_dir else tempfile.mkdtemp(prefix="docx-batch-")
+    build_cache = cache_dir or scratch_dir
+    reader = SharedReader()
+    preprocessors = {}
+
+    def preprocessor_key(book):
+        theme = book.get("theme", PYGMENTS_THEME) if book.get("prehighlight", True) else None
+        return book.get("folder_name"), book.get("optimize_images", True), theme
+
+    for book in books:
+        key = preprocessor_key(book)
+        if key not in preprocessors:
+            folder_name, optimize_images, theme = key
+            preprocessors[key] = SharedPreprocessor(
+                make_preprocessor(folder_name, optimize_images, cache_dir=build_cache, theme=theme))
+        # Prepare each distinct reference template once, before books race for it
+        try:
+            cached_reference_docx(book.get("reference_docx"), book.get("header_text", DEFAULT_HEADER_TEXT),
+                                  cache_dir=build_cache)
+        except Exception as e:
+            print(f"Warning: could not create generated reference docx for {book['name']}:", e)
+
+    def build(book):
+        options = {key: value for key, value in book.items() if key != "name"}
+        output = options.pop("output")
+        result = {"name": book["name"], "output": output, "status": "ok", "error": None}
+        started = time.perf_counter()
+        try:
+            trace = convert_markdowns_to_docx(output_file=output, incremental=True, cache_dir=build_cache,
+                                              jobs=jobs, preprocessor=preprocessors[preprocessor_key(book)],
+                                              reader=reader, render_pool=render_pool, **options)
+            if trace.error:
+                result.update(status="failed", error=trace.error)
+        except Exception as e:
+            result.update(status="failed", error=str(e))
+        result["wall_s"] = time.perf_counter() - started
+        return result
+
+    try:
+        with RenderPool(jobs) as render_pool, ThreadPoolExecutor(max_workers=min(len(books), max(1, jobs))) as pool:
+            return list(pool.map(build, books))
+    finally:
+        if scratch_dir:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+def format_results(results, wall_s=None):
+    """Return per-book results as a text table."""
+    width = max(len(result["name"]) for result in results)
+    lines = [f"{result['name']:<{width}}  {result['status']:<6}  {result['wall_s']:7.2f}s  "
+             f"{result['error'] or result['output']}" for result in results]
+    failed = sum(result["status"] != "ok" for result in results)
+    summary = f"{len(results) - failed} of {len(results)} books built"
+    if wall_s is not None:
+        summary += f" in {wall_s:.2f}s"
+    return "\n".join(lines + [summary])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("manifest", help="JSON manifest listing the books to build")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1,
+                        help="number of pandoc processes to run at once, across all books")
+    parser.add_argument("--cache-dir", help="cache root to keep fragments in between batches")
+    parser.add_argument("--report", metavar="REPORT.json", help="write per-book results as JSON ('-' for stdout)")
+    args = parser.parse_args()
+
+    books = load_manifest(args.manifest)
+    started = time.perf_counter()
+    results = build_books(books, jobs=args.jobs, cache_dir=args.cache_dir)
+    print(format_results(results, time.perf_counter() - started))
+    if args.report:
+        data = json.dumps(results, indent=2)
+        if args.report == "-":
+            print(data)
+        else:
+            with open(args.report, "w", encoding="utf-8") as f:
+                f.write(data + "\n")
+    return 0 if all(result["status"] == "ok" for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
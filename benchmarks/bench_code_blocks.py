@@ -0,0 +1,81 @@
+"""
+Compare the table and compact code block renderings of convert_old.
+
+Builds a document of --blocks code listings of --lines lines each in both
+modes and reports the build time (add_code_block calls plus saving) and the
+size of word/document.xml. Highlighting is warmed up first so only the DOCX
+rendering is compared.
+
+    python benchmarks/bench_code_blocks.py --blocks 100 --lines 60
+"""
+import argparse
+import io
+import os
+import sys
+import time
+import zipfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from docx import Document  # noqa: E402
+
+import convert_old  # noqa: E402
+from highlight import highlight_lines  # noqa: E402
+
+FUNCTION = '''def handler_{i}(request, retries=3):
+    """Handle one request, retrying on timeouts."""
+    for attempt in range(retries):  # bounded
+        try:
+            return request.send(timeout=2.5 * attempt)
+        except TimeoutError as e:
+            log.warning("retry %d: %s", attempt, e)
+    raise RuntimeError("gave up")
+
+'''
+
+
+def listing(index, lines):
+    chunks, n = [], 0
+    while n < lines:
+        chunks.append(FUNCTION.format(i=index * 1000 + n))
+        n += FUNCTION.count("\n")
+    return "".join(chunks)
+
+
+def build(listings, code_style, line_numbers=True):
+    start = time.perf_counter()
+    document = Document()
+    for code in listings:
+        convert_old.add_code_block(document, code, language="python", code_style=code_style,
+                                   line_numbers=line_numbers)
+    out = io.BytesIO()
+    document.save(out)
+    elapsed = time.perf_counter() - start
+    with zipfile.ZipFile(out) as z:
+        xml_size = z.getinfo("word/document.xml").file_size
+    return elapsed, xml_size, len(out.getvalue())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--blocks", type=int, default=100)
+    parser.add_argument("--lines", type=int, default=60)
+    args = parser.parse_args()
+
+    listings = [listing(i, args.lines) for i in range(args.blocks)]
+    for code in listings:
+        highlight_lines(code, language="python")
+
+    print(f"{args.blocks} blocks of ~{args.lines} lines")
+    results = {}
+    for name, code_style, line_numbers in (("table", "table", True), ("compact", "compact", True),
+                                           ("compact, no numbers", "compact", False)):
+        results[name] = elapsed, xml_size, docx_size = build(listings, code_style, line_numbers)
+        print(f"  {name:20s} {elapsed:7.3f}s  document.xml {xml_size / 1e6:7.2f} MB  docx {docx_size / 1e6:6.2f} MB")
+    table, compact = results["table"], results["compact"]
+    print(f"  compact vs table: {table[0] / compact[0]:.1f}x faster, {table[1] / compact[1]:.1f}x less XML")
+
+
+if __name__ == "__main__":
+    main()
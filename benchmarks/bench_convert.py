@@ -0,0 +1,150 @@
+"""
+Time full builds of synthetic books with both converters at several sizes.
+
+Each size builds a book with write_book (parts, code blocks, tables, nested
+lists, images and Joplin-style chapter names) and converts it with
+convert.convert_markdowns_to_docx (pandoc) and
+convert_old.convert_markdowns_to_docx (python-docx). Every run starts from
+an empty cache, so the times are for cold builds. The best of --repeat runs
+is kept, together with that run's stage trace.
+
+Results are written as JSON. With --baseline, each result is compared with
+the same converter and size in the baseline file, and the script exits with
+status 1 if any is more than --threshold slower. --update-baseline writes the
+results as the new baseline instead.
+
+    python benchmarks/bench_convert.py --sizes 5,20,50 --repeat 3 --output results.json
+    python benchmarks/bench_convert.py --update-baseline
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import convert  # noqa: E402
+import convert_old  # noqa: E402
+import pandoc_runner  # noqa: E402
+from benchmarks.synthbook import write_book  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+
+CONVERTERS = {
+    "convert": convert.convert_markdowns_to_docx,
+    "convert_old": convert_old.convert_markdowns_to_docx,
+}
+
+# Blocks per chapter of the synthetic book
+BOOK_SHAPE = {"paragraphs": 20, "code_blocks": 5, "tables": 2, "lists": 2, "images": 1}
+
+
+def time_build(name, chapters_file, folder, repeat):
+    """Return (best seconds, output bytes, stage trace of the best run) for one converter."""
+    best = None
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as cache, tempfile.TemporaryDirectory() as out:
+            output_file = os.path.join(out, "book.docx")
+            stages = {}
+            os.environ["JOPLIN_DOCX_CACHE"] = cache
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                CONVERTERS[name](output_file=output_file, chapters_file=chapters_file, folder_name=folder,
+                                 on_stage=lambda record: stages.__setitem__(record["stage"], record))
+            elapsed = time.perf_counter() - start
+            if not os.path.exists(output_file):
+                raise RuntimeError(f"{name} did not write {output_file}")
+            if best is None or elapsed < best[0]:
+                best = (elapsed, os.path.getsize(output_file), list(stages.values()))
+    return best
+
+
+def run_suite(sizes, converters, repeat):
+    results = []
+    for chapters in sizes:
+        with tempfile.TemporaryDirectory() as folder:
+            chapters_file = write_book(folder, chapters=chapters, **BOOK_SHAPE)
+            markdown_bytes = sum(os.path.getsize(os.path.join(folder, n)) for n in os.listdir(folder)
+                                 if n.endswith(".md"))
+            for name in converters:
+                seconds, output_bytes, stages = time_build(name, chapters_file, folder, repeat)
+                results.append({
+                    "converter": name,
+                    "chapters": chapters,
+                    "seconds": seconds,
+                    "markdown_bytes": markdown_bytes,
+                    "output_bytes": output_bytes,
+                    "stages": stages,
+                })
+                print(f"  {name:12s} {chapters:4d} chapters  {seconds:8.3f}s  {output_bytes / 1e6:6.2f} MB")
+    return results
+
+
+def find_regressions(results, baseline, threshold):
+    """Return (result, baseline result) pairs where the result is more than threshold slower."""
+    previous = {(r["converter"], r["chapters"]): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        base = previous.get((result["converter"], result["chapters"]))
+        if base and result["seconds"] > base["seconds"] * (1 + threshold):
+            regressions.append((result, base))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="5,20,50", help="comma separated chapter counts")
+    parser.add_argument("--converters", default=",".join(CONVERTERS), help="comma separated converters to run")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="write the results as JSON to this path")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline results to compare with")
+    parser.add_argument("--threshold", type=float, default=0.15, help="allowed slowdown, 0.15 is 15%%")
+    parser.add_argument("--update-baseline", action="store_true", help="write the results to --baseline")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    converters = args.converters.split(",")
+    unknown = set(converters) - set(CONVERTERS)
+    if unknown:
+        parser.error(f"unknown converters: {', '.join(sorted(unknown))}")
+
+    print(f"best of {args.repeat}, cold cache")
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "pandoc": pandoc_runner.get_pandoc_version(),
+        "cpus": os.cpu_count(),
+        "created_at": time.time(),
+        "results": run_suite(sizes, converters, args.repeat),
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.update_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --update-baseline to create one")
+        return 0
+
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline.get("platform") != report["platform"] or baseline.get("cpus") != report["cpus"]:
+        print("Warning: baseline was recorded on a different machine; comparisons are indicative only")
+    regressions = find_regressions(report["results"], baseline, args.threshold)
+    for result, base in regressions:
+        print(f"REGRESSION {result['converter']} {result['chapters']} chapters: "
+              f"{base['seconds']:.3f}s -> {result['seconds']:.3f}s")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+"""
+Compare the cost of the pandoc filter stage before and after book-filter.lua.
+
+"legacy" is the old chain: pandoc-pagebreak.py through --filter (a panflute
+subprocess fed the whole AST as JSON) followed by style-map.lua. "lua" is the
+single in-process book-filter.lua. A run with no filters is the floor, so the
+filter cost is each run's time minus the "none" time.
+
+    python benchmarks/bench_filters.py --chapters 200 --repeat 3
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import convert  # noqa: E402
+import pandoc_runner  # noqa: E402
+from benchmarks.synthbook import write_book  # noqa: E402
+
+FILTER_CHAINS = {
+    "none": [],
+    "legacy": ["--filter", os.path.join(ROOT, "pandoc-pagebreak.py"),
+               "--lua-filter", os.path.join(ROOT, "style-map.lua")],
+    "lua": ["--lua-filter", os.path.join(ROOT, "book-filter.lua")],
+}
+
+
+def time_chain(pandoc, md_file, chain, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([pandoc, md_file, "-f", "markdown+raw_tex", "-t", "native", *chain],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--chapters", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    pandoc = pandoc_runner.get_pandoc_path()
+    with tempfile.TemporaryDirectory() as tmp:
+        chapters_file = write_book(tmp, chapters=args.chapters)
+        items = convert.read_book_items(chapters_file=chapters_file, folder_name=tmp)
+        md_file = os.path.join(tmp, "book.md")
+        with open(md_file, "w", encoding="utf-8") as f:
+            f.write(convert.preprocess_markdown("".join(item["markdown"] for item in items)))
+        size_mb = os.path.getsize(md_file) / 1e6
+
+        # The native writer keeps the measurement on parsing and filtering
+        # rather than on DOCX packaging.
+        results = {name: time_chain(pandoc, md_file, chain, args.repeat) for name, chain in FILTER_CHAINS.items()}
+
+    print(f"{args.chapters} chapters, {size_mb:.1f} MB of markdown, best of {args.repeat}")
+    for name, elapsed in results.items():
+        filter_cost = elapsed - results["none"]
+        print(f"  {name:7s} total {elapsed:7.3f}s  filter cost {filter_cost:7.3f}s")
+
+
+if __name__ == "__main__":
+    main()
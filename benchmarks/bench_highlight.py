@@ -0,0 +1,80 @@
+"""
+Compare the token-stream highlighter with the old HTML round trip.
+
+The old path in convert_old.add_code_block rendered each block to HTML with
+a new HtmlFormatter, parsed it back with BeautifulSoup and re-derived the
+theme from the formatter's CSS. Both sides produce the runs of every line;
+building the DOCX table is left out. Books repeat snippets, so --unique
+controls how many distinct blocks there are among --blocks.
+
+    python benchmarks/bench_highlight.py --blocks 2000 --unique 200
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bs4 import BeautifulSoup  # noqa: E402
+from pygments import highlight  # noqa: E402
+from pygments.formatters.html import HtmlFormatter  # noqa: E402
+from pygments.lexers import get_lexer_by_name  # noqa: E402
+
+import highlight as token_highlight  # noqa: E402
+from benchmarks.synthbook import CODE_BLOCK  # noqa: E402
+
+SNIPPET = CODE_BLOCK.strip().strip("`").replace("python\n", "", 1)
+
+
+def legacy_lines(code, language, theme):
+    lexer = get_lexer_by_name(language)
+    formatter = HtmlFormatter(nowrap=False, style=theme)
+    soup = BeautifulSoup(highlight(code, lexer, formatter), "html.parser")
+    css = {}
+    for rule in formatter.get_style_defs('.highlight').split("\n"):
+        m = re.match(r"\.highlight\s+\.([a-zA-Z0-9_-]+)\s*\{([^}]*)\}", rule.strip())
+        if m:
+            css[m.group(1)] = m.group(2)
+    lines, current = [], []
+    for node in soup.find("pre").children:
+        if isinstance(node, str):
+            for i, part in enumerate(node.split("\n")):
+                if i > 0:
+                    lines.append(current)
+                    current = []
+                if part:
+                    current.append((part, None))
+        else:
+            current.append((node.get_text(), [css.get(cls) for cls in node.get("class", [])]))
+    if current:
+        lines.append(current)
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--blocks", type=int, default=2000)
+    parser.add_argument("--unique", type=int, default=200)
+    parser.add_argument("--theme", default="friendly")
+    args = parser.parse_args()
+
+    blocks = [SNIPPET.replace("add", f"add_{i % args.unique}") for i in range(args.blocks)]
+    results = {}
+    for name, fn in (("html", legacy_lines), ("tokens", token_highlight.highlight_lines)):
+        token_highlight.clear_cache()
+        start = time.perf_counter()
+        for code in blocks:
+            fn(code, "python", args.theme)
+        results[name] = time.perf_counter() - start
+
+    print(f"{args.blocks} blocks, {args.unique} distinct")
+    for name, elapsed in results.items():
+        print(f"  {name:7s} {elapsed:7.3f}s  {args.blocks / elapsed:9.0f} blocks/s")
+    print(f"  speedup {results['html'] / results['tokens']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
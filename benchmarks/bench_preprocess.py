@@ -0,0 +1,69 @@
+"""
+Compare the single-pass Preprocessor with the old whole-document regex chain.
+
+The old chain ran suppress_image_alt and the no-op reset_caps_in_code as two
+re.sub passes over the combined book, rewriting images inside code as well.
+
+    python benchmarks/bench_preprocess.py --megabytes 8 --repeat 5
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.synthbook import chapter_markdown  # noqa: E402
+from preprocess import DEFAULT_RULES, Preprocessor  # noqa: E402
+
+IMAGE_CHAPTER_TAIL = (
+    "![A screenshot](images/shot.png)\n\n"
+    "Inline `![not an image](code.png)` stays as code.\n\n"
+    "```markdown\n![inside a fence](fence.png)\n```\n\n"
+    "<!-- ![commented out](old.png) -->\n\n"
+)
+
+
+def regex_chain(md):
+    md = re.sub(r'!\[[^\]]*\]\(([^\)]+)\)', r'![&nbsp;](\1)', md)
+    return re.sub(r'(\n```[a-zA-Z0-9_+-]*)', r'\1', md)
+
+
+def best_of(fn, md, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(md)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--megabytes", type=float, default=8)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    chunks, size, i = [], 0, 0
+    while size < args.megabytes * 1e6:
+        i += 1
+        chunk = chapter_markdown(i) + IMAGE_CHAPTER_TAIL
+        chunks.append(chunk)
+        size += len(chunk)
+    md = "".join(chunks)
+
+    preprocessor = Preprocessor(DEFAULT_RULES)
+    old = best_of(regex_chain, md, args.repeat)
+    new = best_of(preprocessor.process, md, args.repeat)
+    print(f"{len(md) / 1e6:.1f} MB, best of {args.repeat}")
+    print(f"  regex chain   {old:7.3f}s  {len(md) / 1e6 / old:7.1f} MB/s")
+    print(f"  preprocessor  {new:7.3f}s  {len(md) / 1e6 / new:7.1f} MB/s")
+    changed = sum(a != b for a, b in zip(regex_chain(md).splitlines(), preprocessor.process(md).splitlines()))
+    print(f"  lines the regex chain rewrote inside code or comments: {changed}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Load test the conversion service against one convert_markdowns_to_docx call per document.
+
+A synthetic book is zipped into a bundle and posted --requests times by
+--concurrency clients to a service started in this process (or to --url).
+The baseline runs the same conversions one after another the way a thin
+web wrapper would: a fresh `python -c` per document, so each pays for the
+imports, pandoc discovery and template setup.
+
+    python benchmarks/bench_service.py --chapters 5 --requests 40 --concurrency 4
+"""
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import zipfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.synthbook import write_book  # noqa: E402
+from service import ConversionService, make_server  # noqa: E402
+
+
+def make_bundle(folder):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w", zipfile.ZIP_DEFLATED) as archive:
+        for root, _, names in os.walk(folder):
+            for name in names:
+                path = os.path.join(root, name)
+                archive.write(path, os.path.relpath(path, folder))
+    return data.getvalue()
+
+
+def load(url, bundle, requests, concurrency):
+    """Post bundle `requests` times from `concurrency` threads; return (wall seconds, latencies)."""
+    latencies = []
+    remaining = iter(range(requests))
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                if next(remaining, None) is None:
+                    return
+            started = time.perf_counter()
+            request = urllib.request.Request(f"{url}/convert", data=bundle, method="POST",
+                                             headers={"Content-Type": "application/zip"})
+            with urllib.request.urlopen(request) as response:
+                response.read()
+            with lock:
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started, sorted(latencies)
+
+
+def cold_runs(folder, runs):
+    script = ("import convert; convert.convert_markdowns_to_docx(output_file='out.docx', "
+              f"chapters_file={os.path.join(folder, 'chapters.txt')!r}, folder_name={folder!r})")
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory() as out_dir:
+        for _ in range(runs):
+            subprocess.run([sys.executable, "-c", script], cwd=out_dir, check=True, stdout=subprocess.DEVNULL,
+                           env={**os.environ, "PYTHONPATH": ROOT})
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--chapters", type=int, default=5)
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--url", help="load test a running service instead of starting one")
+    parser.add_argument("--baseline-runs", type=int, default=5, help="cold conversions to time (0 to skip)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = os.path.join(tmp, "book")
+        write_book(folder, chapters=args.chapters)
+        bundle = make_bundle(folder)
+        service = server = None
+        url = args.url
+        if url is None:
+            service = ConversionService(workers=args.workers, queue_size=args.requests).start()
+            server = make_server(service, port=0)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            url = f"http://127.0.0.1:{server.server_address[1]}"
+        try:
+            wall, latencies = load(url, bundle, args.requests, args.concurrency)
+        finally:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+                service.stop()
+        results = {
+            "service_docs_per_s": len(latencies) / wall,
+            "service_latency_p50_s": latencies[len(latencies) // 2],
+            "service_latency_p95_s": latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))],
+        }
+        if args.baseline_runs:
+            results["cold_docs_per_s"] = args.baseline_runs / cold_runs(folder, args.baseline_runs)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Measure the startup cost of the converter CLI and guard it against regressions.
+
+`python -X importtime -c "import convert"` is run --runs times and the
+median cumulative import time is reported with the modules that cost the
+most. Wall times of `convert.py --help`, a --dry-run and a full conversion
+of a one-note book follow. The run fails (exit status 1) if the import
+takes longer than --max-import-ms or pulls in one of the modules only
+later stages need.
+
+    python benchmarks/bench_startup.py --runs 10 --max-import-ms 150
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules `import convert` must not load; the stages that need them import them
+LAZY_MODULES = ("docx", "lxml", "PIL", "pygments", "pypandoc", "argparse")
+
+
+def import_times(module="convert"):
+    """Return ({module: (self us, cumulative us)}, set of top-level packages imported) for one fresh import."""
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=ROOT,
+                          capture_output=True, text=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        if not fields[0].strip().isdigit():
+            continue  # header line
+        name = fields[2].strip()
+        times[name] = (int(fields[0]), int(fields[1]))
+    return times, {name.split(".")[0] for name in times}
+
+
+def wall(args, cwd, runs):
+    """Return the median wall seconds of running `python convert.py args`."""
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(ROOT, "convert.py"), *args], cwd=cwd, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--max-import-ms", type=float, help="fail if `import convert` takes longer than this")
+    parser.add_argument("--top", type=int, default=10, help="number of slowest modules to list")
+    args = parser.parse_args()
+
+    runs = [import_times() for _ in range(args.runs)]
+    import_ms = statistics.median(times["convert"][1] for times, _ in runs) / 1000
+    slowest = sorted(runs[-1][0].items(), key=lambda item: -item[1][0])[:args.top]
+    loaded = sorted(set(LAZY_MODULES) & runs[-1][1])
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, "note.md"), "w", encoding="utf-8") as f:
+            f.write("# Note\n\nA short note with `code`.\n\n```python\nprint('hi')\n```\n")
+        note = ["note.md", "-o", "note.docx", "--cache-dir", os.path.join(tmp, "cache")]
+        wall(note, tmp, 1)  # warm the template, pandoc and code block caches
+        results = {
+            "import_convert_ms": import_ms,
+            "slowest_imports_self_ms": {name: self_us / 1000 for name, (self_us, _) in slowest},
+            "eagerly_loaded": loaded,
+            "help_s": wall(["--help"], tmp, args.runs),
+            "dry_run_s": wall([*note, "--dry-run"], tmp, args.runs),
+            "convert_note_s": wall(note, tmp, args.runs),
+        }
+    print(json.dumps(results, indent=2))
+    failed = bool(loaded)
+    if args.max_import_ms is not None and import_ms > args.max_import_ms:
+        print(f"import convert took {import_ms:.1f} ms, over the {args.max_import_ms:.1f} ms budget")
+        failed = True
+    if loaded:
+        print(f"import convert loaded {', '.join(loaded)}, which should only be imported when needed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
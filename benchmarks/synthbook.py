@@ -0,0 +1,153 @@
+import os
+import random
+import struct
+import zlib
+
+PARAGRAPH = (
+    "Copilot suggestions are only as good as the context around them. Write the "
+    "test first, keep the *intent* explicit and let the **model** fill in the `glue`. "
+    "See [the docs](https://example.com/docs) for details.\n\n"
+)
+
+CODE_BLOCK = '''```python
+def add(a, b):
+    """Return the sum of a and b."""
+    return a + b
+
+
+def test_add():
+    assert add(2, 3) == 5
+```
+
+'''
+
+TABLE = '''| Prompt | Suggestion | Accepted |
+|:-------|:----------:|---------:|
+| `def add(` | `a, b): return a + b` | yes |
+| Write a test for *add* | `assert add(2, 3) == 5` | **no** |
+| Rename the fixture | `@pytest.fixture` | yes |
+
+'''
+
+NESTED_LIST = '''- Red: write a failing test
+    - Name the behaviour, not the method
+    - Keep the *arrange* step short
+        1. Build the inputs
+        2. Call the unit
+- Green: accept the smallest suggestion that passes
+- Refactor with the tests as a safety net
+
+'''
+
+# Chapter names follow the Joplin export convention, where characters that
+# are not allowed in file names (such as "?" and ":") become "_".
+CHAPTER_TITLES = [
+    "What is AI_",
+    "Tests, Prompts & Context",
+    "Copilot's Blind Spots",
+    "Red_Green_Refactor (Again)",
+    "Naïve Mocks vs. Fakes",
+]
+
+IMAGE_FOLDER = "_resources"
+
+
+def chapter_name(index):
+    """Return the file name (without .md) of chapter index, e.g. "Chapter 1. What is AI_"."""
+    return f"Chapter {index}. {CHAPTER_TITLES[(index - 1) % len(CHAPTER_TITLES)]}"
+
+
+def chapter_markdown(index, paragraphs=20, code_blocks=5, tables=0, lists=0, images=(), rng=None):
+    """
+    Return the markdown of one synthetic chapter.
+    Args:
+        index: Chapter number
+        paragraphs, code_blocks, tables, lists: Number of blocks of each kind
+        images: Image paths to link, one block each
+        rng: Optional random.Random used to shuffle the blocks
+    """
+    rng = rng or random.Random(index)
+    blocks = [f"# Chapter {index}\n\n"]
+    kinds = ["p"] * paragraphs + ["code"] * code_blocks + ["table"] * tables + ["list"] * lists
+    kinds += [("image", path) for path in images]
+    rng.shuffle(kinds)
+    for n, kind in enumerate(kinds):
+        if n % 8 == 0:
+            blocks.append(f"## Section {index}.{n // 8 + 1}\n\n")
+        if kind == "p":
+            blocks.append(PARAGRAPH)
+        elif kind == "code":
+            blocks.append(CODE_BLOCK)
+        elif kind == "table":
+            blocks.append(TABLE)
+        elif kind == "list":
+            blocks.append(NESTED_LIST)
+        else:
+            blocks.append(f"![Figure {index}.{n}]({kind[1]})\n\n")
+    return "".join(blocks)
+
+
+def write_png(path, width, height, seed=0):
+    """Write an RGB PNG with a gradient and some noise, so it neither compresses to nothing nor needs Pillow."""
+    rng = random.Random(seed)
+    base = bytearray()
+    for x in range(width):
+        noise = rng.randrange(16)
+        base += bytes(((x * 255 // width + noise) & 255, noise * 8, (seed * 40 + noise) & 255))
+    base = bytes(base)
+    rows = []
+    for y in range(height):
+        # Shift every channel value per row; translate keeps this fast for large images
+        shift = y * 255 // height
+        table = bytes((v + shift) & 255 for v in range(256))
+        rows.append(b"\x00" + base.translate(table))  # filter type None
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(b"".join(rows), 6)))
+        f.write(chunk(b"IEND", b""))
+
+
+def write_book(folder, chapters=20, chapters_per_part=5, paragraphs=20, code_blocks=5, tables=0, lists=0,
+               images=0, image_size=(1600, 900), seed=0):
+    """
+    Write a synthetic book to folder and return the path of its chapters.txt.
+    Chapters are grouped under <partname> entries every chapters_per_part
+    chapters and named like Joplin exports ("Chapter 1. What is AI_").
+    Each chapter links `images` pictures; there are only a few distinct image
+    files so books also exercise image deduplication.
+    Args:
+        folder: Folder to write the book to
+        chapters: Number of chapters
+        chapters_per_part: Chapters per <partname> entry
+        paragraphs, code_blocks, tables, lists, images: Blocks of each kind per chapter
+        image_size: (width, height) of the generated images in pixels
+        seed: Seed for the block order and image content
+    """
+    os.makedirs(folder, exist_ok=True)
+    rng = random.Random(seed)
+    image_paths = []
+    if images:
+        os.makedirs(os.path.join(folder, IMAGE_FOLDER), exist_ok=True)
+        for n in range(min(images, 3)):
+            rel = f"{IMAGE_FOLDER}/figure-{n + 1}.png"
+            write_png(os.path.join(folder, rel), *image_size, seed=seed + n)
+            image_paths.append(rel)
+    lines = []
+    for i in range(1, chapters + 1):
+        if (i - 1) % chapters_per_part == 0:
+            lines.append(f"<partname>PART {(i - 1) // chapters_per_part + 1}")
+        name = chapter_name(i)
+        chapter_images = [image_paths[(i + n) % len(image_paths)] for n in range(images)] if images else ()
+        with open(os.path.join(folder, name + ".md"), "w", encoding="utf-8") as f:
+            f.write(chapter_markdown(i, paragraphs=paragraphs, code_blocks=code_blocks, tables=tables,
+                                     lists=lists, images=chapter_images, rng=rng))
+        lines.append(name)
+    chapters_file = os.path.join(folder, "chapters.txt")
+    with open(chapters_file, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    return chapters_file
@@ -0,0 +1,74 @@
+-- Book filter pipeline, run in-process by pandoc with --lua-filter.
+--
+-- * <!-- PAGEBREAK --> comments (chapters.txt builds) become page breaks.
+-- * :::pagebreak::: markers (md_files builds) become page breaks. Pandoc
+--   reads them as a fenced div that stays open until the end of the input, so
+--   the div is unwrapped and its content kept after the break.
+-- * Headers with the csp-chapter-title class get the "CSP - Chapter Title"
+--   custom style. Pandoc's DOCX writer ignores custom-style on headers, so
+--   the title is emitted as a styled paragraph that keeps the header's id.
+--   The generated reference DOCX gives that style an outline level, so the
+--   title stays in the TOC and Word's navigation pane.
+--
+-- Counters are kept quietly and written to stderr as a single line only when
+-- the BOOK_FILTER_STATS environment variable is set.
+
+local PAGEBREAK_XML = '<w:p><w:r><w:br w:type="page"/></w:r></w:p>'
+local MARKER_CLASSES = { ["pagebreak:::"] = true, ["pagebreak"] = true }
+
+local stats = { pagebreaks = 0, markers = 0, chapter_titles = 0 }
+
+local function pagebreak()
+  stats.pagebreaks = stats.pagebreaks + 1
+  return pandoc.RawBlock("openxml", PAGEBREAK_XML)
+end
+
+local function is_marker_div(div)
+  for _, cls in ipairs(div.classes) do
+    if MARKER_CLASSES[cls] then
+      return true
+    end
+  end
+  return false
+end
+
+function RawBlock(elem)
+  if elem.format == "html" and elem.text:match("^<!%-%-%s*PAGEBREAK%s*%-%->$") then
+    return pagebreak()
+  end
+end
+
+function Div(elem)
+  if is_marker_div(elem) then
+    stats.markers = stats.markers + 1
+    local blocks = { pagebreak() }
+    for _, block in ipairs(elem.content) do
+      table.insert(blocks, block)
+    end
+    return blocks
+  end
+end
+
+function Para(elem)
+  if #elem.content == 1 and elem.content[1].t == "Str" and elem.content[1].text == ":::pagebreak:::" then
+    stats.markers = stats.markers + 1
+    return pagebreak()
+  end
+end
+
+function Header(elem)
+  if elem.classes:includes("csp-chapter-title") then
+    stats.chapter_titles = stats.chapter_titles + 1
+    return pandoc.Div({ pandoc.Para(elem.content) },
+      pandoc.Attr(elem.identifier, {}, { ["custom-style"] = "CSP - Chapter Title" }))
+  end
+end
+
+function Pandoc(doc)
+  if os.getenv("BOOK_FILTER_STATS") then
+    io.stderr:write(string.format(
+      "book-filter: %d page breaks (%d markers), %d chapter titles\n",
+      stats.pagebreaks, stats.markers, stats.chapter_titles))
+  end
+  return doc
+end
@@ -0,0 +1,182 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+# Bump when the layout or meaning of cached entries changes so stale entries
+# from older versions of the converter are never reused.
+CACHE_VERSION = "1"
+
+
+def default_cache_dir():
+    """Cache root used when none is given: $JOPLIN_DOCX_CACHE or ~/.cache/joplin-export-to-docx."""
+    return os.environ.get(
+        "JOPLIN_DOCX_CACHE",
+        os.path.join(os.path.expanduser("~"), ".cache", "joplin-export-to-docx"),
+    )
+
+
+def hash_parts(*parts):
+    """
+    Return a hex sha256 digest over an ordered sequence of parts.
+    str parts are UTF-8 encoded, None is hashed as a distinct marker, and each
+    part is length-prefixed so ("ab", "c") and ("a", "bc") never collide.
+    """
+    h = hashlib.sha256(CACHE_VERSION.encode("ascii"))
+    for part in parts:
+        if part is None:
+            data = b"\x00none"
+        elif isinstance(part, bytes):
+            data = part
+        else:
+            data = str(part).encode("utf-8")
+        h.update(len(data).to_bytes(8, "big"))
+        h.update(data)
+    return h.hexdigest()
+
+
+def hash_file(path, chunk_size=1 << 20):
+    """Return the hex sha256 digest of a file's content, or None if it is missing."""
+    try:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                h.update(chunk)
+        return h.hexdigest()
+    except OSError:
+        return None
+
+
+class DiskCache:
+    """
+    Content-addressed file cache stored under <root>/<namespace>.
+    Entries are written to a temp file and renamed into place, so concurrent
+    builds sharing a cache never see a half-written entry.
+    """
+
+    def __init__(self, root=None, namespace="default"):
+        self.root = os.path.join(root or default_cache_dir(), namespace)
+
+    def path(self, key, suffix=""):
+        return os.path.join(self.root, key[:2], key + suffix)
+
+    def get(self, key, suffix="", touch=False):
+        """
+        Return the path of a cached entry, or None on a miss. With touch, a
+        hit is marked as just used, so prune() evicts it last.
+        """
+        path = self.path(key, suffix)
+        if not os.path.exists(path):
+            return None
+        if touch:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return path
+
+    def put_file(self, key, src_path, suffix="", move=False):
+        """Store the file at src_path under key and return the cached path."""
+        dest = self.path(key, suffix)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dest), suffix=".tmp")
+        os.close(fd)
+        try:
+            if move:
+                shutil.move(src_path, tmp)
+            else:
+                shutil.copyfile(src_path, tmp)
+            os.replace(tmp, dest)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return dest
+
+    def put_bytes(self, key, data, suffix=""):
+        """Store data under key and return the cached path."""
+        dest = self.path(key, suffix)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dest), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, dest)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return dest
+
+    def entries(self):
+        """Yield (path, size, mtime) for every entry, skipping writes in progress."""
+        if not os.path.isdir(self.root):
+            return
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".tmp") or not entry.is_file():
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                yield entry.path, st.st_size, st.st_mtime
+
+    def stats(self):
+        """Return the number of entries and their total size in bytes."""
+        entries = list(self.entries())
+        return {"root": self.root, "entries": len(entries), "bytes": sum(size for _, size, _ in entries)}
+
+    def prune(self, max_bytes):
+        """Remove the least recently used entries until at most max_bytes remain; return how many were removed."""
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for path, size, _ in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Show, prune or clear the converter caches.")
+    parser.add_argument("command", choices=("stats", "prune", "clear"))
+    parser.add_argument("--cache-dir",
+                        help="cache root (default: $JOPLIN_DOCX_CACHE or ~/.cache/joplin-export-to-docx)")
+    parser.add_argument("--namespace", action="append",
+                        help="cache to act on, e.g. ast, fragments, images (default: all)")
+    parser.add_argument("--max-mb", type=float, help="size to prune each cache down to")
+    args = parser.parse_args()
+    root = args.cache_dir or default_cache_dir()
+    namespaces = args.namespace
+    if not namespaces:
+        namespaces = sorted(entry.name for entry in os.scandir(root) if entry.is_dir()) if os.path.isdir(root) else []
+    if args.command == "prune" and args.max_mb is None:
+        parser.error("prune needs --max-mb")
+    for namespace in namespaces:
+        cache = DiskCache(root, namespace)
+        if args.command == "stats":
+            stats = cache.stats()
+            print(f"{namespace}: {stats['entries']} entries, {stats['bytes'] / 1e6:.1f} MB")
+        elif args.command == "prune":
+            print(f"{namespace}: removed {cache.prune(int(args.max_mb * 1e6))} entries")
+        else:
+            cache.clear()
+            print(f"{namespace}: cleared")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Fenced code blocks highlighted ahead of pandoc.
+
+Each fenced block with a language is highlighted with Pygments and replaced
+by a raw OOXML block, so pandoc copies it into the DOCX as it is instead of
+highlighting it again. The OOXML of each block is kept in a disk cache keyed
+by language, theme and code, so a rebuild only highlights the blocks that
+changed.
+"""
+import re
+from xml.sax.saxutils import escape
+
+import pygments
+from pygments.styles import get_style_by_name
+from pygments.util import ClassNotFound
+
+from cache import DiskCache, hash_parts
+from highlight import highlight_lines
+from tracing import BuildTrace
+
+# Bump when the generated OOXML changes, so cached blocks are rebuilt
+CODE_XML_VERSION = "1"
+# Size the code block cache is pruned to by prune()
+CODE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Code styles of pandoc's DOCX writer, as its own highlighted blocks use them:
+# SourceCode for the paragraph and VerbatimChar for the font of each run
+SOURCE_CODE_STYLE = "SourceCode"
+VERBATIM_CHAR_STYLE = "VerbatimChar"
+
+XML_INVALID_RE = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+# Language of a fence's info string: "python", "python title=x" or "{.python .numberLines}"
+INFO_LANGUAGE_RE = re.compile(r"^\s*(?:\{\s*\.)?([\w+#.-]+)")
+
+
+def fence_language(opening):
+    """Return the language named by an opening fence line, or None."""
+    info = opening.strip().lstrip("`~")
+    m = INFO_LANGUAGE_RE.match(info)
+    if m is None or info.lstrip().startswith("{="):
+        return None
+    return m.group(1).rstrip(".")
+
+
+def code_block_xml(code, language, theme):
+    """
+    Return one w:p holding the highlighted lines of code separated by line
+    breaks, as pandoc lays out code blocks. Runs use pandoc's VerbatimChar
+    style for the font and carry their token's color and weight directly.
+    """
+    background = get_style_by_name(theme).background_color.lstrip("#")
+    ppr = f'<w:pStyle w:val="{SOURCE_CODE_STYLE}"/>'
+    if len(background) == 6:
+        ppr += f'<w:shd w:val="clear" w:color="auto" w:fill="{background.upper()}"/>'
+    parts = [f"<w:p><w:pPr>{ppr}</w:pPr>"]
+    for i, line in enumerate(highlight_lines(code.rstrip("\n"), language, theme)):
+        if i:
+            parts.append("<w:r><w:br/></w:r>")
+        for text, color, bold, italic in line:
+            rpr = f'<w:rStyle w:val="{VERBATIM_CHAR_STYLE}"/>' + ("<w:b/>" if bold else "") + ("<w:i/>" if italic else "")
+            if color:
+                rpr += '<w:color w:val="%02X%02X%02X"/>' % color
+            parts.append(f'<w:r><w:rPr>{rpr}</w:rPr><w:t xml:space="preserve">'
+                         f'{XML_INVALID_RE.sub("", escape(text))}</w:t></w:r>')
+    parts.append("</w:p>")
+    return "".join(parts)
+
+
+class CodeBlockRenderer:
+    """
+    code_renderer for preprocess.Preprocessor that turns fenced blocks with
+    a language into raw OOXML blocks, caching the OOXML of each block.
+    Blocks without a language are left for pandoc, which does not highlight
+    them either.
+    Args:
+        theme: Pygments style name
+        cache_dir: Optional cache root
+        trace: Optional BuildTrace to time highlighting in, as "highlight"
+    """
+
+    def __init__(self, theme, cache_dir=None, trace=None):
+        try:
+            get_style_by_name(theme)
+        except ClassNotFound:
+            raise ValueError(f"Unknown Pygments style: {theme!r}")
+        self.theme = theme
+        self.cache = DiskCache(cache_dir, "code")
+        self.trace = trace or BuildTrace()
+        self.hits = self.misses = 0
+
+    def __call__(self, opening, code, closing):
+        language = fence_language(opening)
+        if language is None:
+            return None
+        # Inside a list item the code carries the item's indentation, which pandoc strips
+        indent = opening[:len(opening) - len(opening.lstrip(" "))]
+        if indent:
+            code = "".join(line[len(indent):] if line.startswith(indent) else line.lstrip(" ")
+                           for line in code.splitlines(True))
+        key = hash_parts(CODE_XML_VERSION, pygments.__version__, language, self.theme, code)
+        path = self.cache.get(key, ".xml", touch=True)
+        if path is not None:
+            self.hits += 1
+            with open(path, encoding="utf-8") as f:
+                xml = f.read()
+        else:
+            self.misses += 1
+            with self.trace.stage("highlight"):
+                xml = code_block_xml(code, language, self.theme)
+            self.cache.put_bytes(key, xml.encode("utf-8"), ".xml")
+        newline = "\n" if closing.endswith("\n") else ""
+        return f"{indent}```{{=openxml}}\n{indent}{xml}\n{indent}```{newline}"
+
+    def prune(self, max_bytes=CODE_CACHE_MAX_BYTES):
+        return self.cache.prune(max_bytes)
@@ -1,144 +1,859 @@
+import base64
+import io
+import json
+import mimetypes
 import os
+import posixpath
+import shutil
+import subprocess
+import sys
 import tempfile
-import pypandoc
-import re
-from docx import Document
-from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
-from docx.oxml import OxmlElement
-from docx.oxml.ns import qn
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-def convert_markdowns_to_docx(md_files=None, output_file="combined.docx", chapters_file=None, folder_name=None, reference_docx=None):
+# python-docx, lxml, Pillow and Pygments are imported by the stages that use
+# them, so a run that stops early or only checks the book never loads them.
+import pandoc_runner
+from cache import DiskCache, hash_file, hash_parts
+from pandoc_ast import CHAPTER_TITLE_STYLE, merge_documents
+from preflight import preflight
+from tracing import BuildTrace, traced_items
+from preprocess import DEFAULT_RULES, Preprocessor, image_paths, image_rule, local_image_path
+
+MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PAGEBREAK = "\n\n<!-- PAGEBREAK -->\n\n"
+MD_FILES_PAGEBREAK = "\n\n:::pagebreak:::\n\n"
+# Page breaks and custom styles are applied by one Lua filter that runs inside
+# pandoc, instead of a panflute subprocess plus a second Lua pass.
+PANDOC_FILTERS = [os.path.join(MODULE_DIR, "book-filter.lua")]
+
+# Markdown dialect chapters are read as; raw_tex is enabled for page breaks
+READER = "markdown+raw_tex"
+# Default Pygments theme for code blocks (e.g., monokai, tango, zenburn, etc.)
+PYGMENTS_THEME = "tango"
+# Highlight styles pandoc itself knows. Pandoc is always given one of these,
+# even when code is pre-highlighted, so the SourceCode and VerbatimChar
+# styles the highlighted blocks use are defined in the DOCX.
+PANDOC_THEMES = ("pygments", "tango", "espresso", "zenburn", "kate", "monochrome", "breezedark", "haddock")
+
+DEFAULT_HEADER_TEXT = "Test-First Copilot - Greenfield Edition"
+# Field code placed in the centered footer of the generated reference DOCX.
+FOOTER_FIELD = "PAGE"
+# Bump when make_reference_with_header_footer changes, so cached templates are rebuilt
+REFERENCE_VERSION = "2"
+# Size the AST cache is pruned to after each build that uses it
+AST_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Markdown rewrites applied to every chapter before pandoc. Rules only touch
+# prose, never code blocks, inline code or HTML comments.
+PREPROCESSOR = Preprocessor(DEFAULT_RULES)
+
+
+def preprocess_markdown(md, preprocessor=PREPROCESSOR):
+    return preprocessor.process(md)
+
+
+def make_preprocessor(folder_name=None, optimize_images=True, cache_dir=None, trace=None, theme=None):
     """
-    Convert markdown files to DOCX using Pandoc, handling <partname> logic from chapters.txt.
+    Return the Preprocessor for a build. With optimize_images, local image
+    links are pointed at downsampled, deduplicated copies from the image cache;
+    that work is traced as "optimize_images", nested in "preprocess". With a
+    theme, fenced code blocks are highlighted in that Pygments style and
+    replaced by cached OOXML (see code_blocks), traced as "highlight".
+    """
+    trace = trace or BuildTrace()
+    code_renderer = None
+    if theme:
+        from code_blocks import CodeBlockRenderer
+        code_renderer = CodeBlockRenderer(theme, cache_dir=cache_dir, trace=trace)
+    if not optimize_images:
+        return Preprocessor(DEFAULT_RULES, code_renderer) if code_renderer else PREPROCESSOR
+
+    def rewrite_src(src):
+        path = local_image_path(src, folder_name)
+        if path is None or not os.path.exists(path):
+            return src
+        from images import optimize_image
+        with trace.stage("optimize_images") as counts:
+            optimized = optimize_image(path, cache_dir=cache_dir)
+            counts["images"] += 1
+            counts["bytes_read"] += os.path.getsize(path)
+        return optimized
+
+    return Preprocessor([image_rule(rewrite_src)] + [rule for rule in DEFAULT_RULES if rule.name != "images"],
+                        code_renderer)
+
+
+def read_chapter(path):
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
+def iter_book_items(md_files=None, chapters_file=None, folder_name=None, joplin_index=None, reader=read_chapter):
+    """
+    Return an iterator over the book's parts and chapters, in order.
+    Each item is a dict with "type" ("part" or "chapter"), "name" and
+    "markdown", the text that goes into the book including its trailing page
+    break. Chapter items also carry the resolved "path", or the "note_id"
+    when they come from a Joplin export. Chapter files are read only when
+    their item is reached, so at most one chapter is held in memory.
+    Missing chapters are skipped with a warning.
     Args:
         md_files: List of markdown files (used if chapters_file is None)
-        output_file: Output DOCX file path
         chapters_file: Path to chapters.txt file (takes precedence over md_files)
         folder_name: Optional folder where markdown files are located
-        reference_docx: Optional DOCX template for styling
+        joplin_index: Optional joplin.JoplinIndex to look chapters up in by
+            note title instead of reading them from folder_name
+        reader: Function returning the text of a chapter file, given its path
     """
-    temp_files = []
-    combined_md = ""
     if chapters_file and os.path.exists(chapters_file):
-        with open(chapters_file, encoding="utf-8") as f:
-            lines = [line.strip() for line in f if line.strip() and not line.strip().startswith("#")]
-        for line in lines:
-            if line.startswith("<partname>"):
-                part_title = line.replace("<partname>", "").strip()
-                combined_md += f"\n\n# {part_title}\n\n<!-- PAGEBREAK -->\n\n"
-            else:
-                chapter_file = line
-                if folder_name and not os.path.isabs(chapter_file):
-                    chapter_file = os.path.join(folder_name, chapter_file)
-                if not chapter_file.endswith(".md"):
-                    chapter_file += ".md"
-                if os.path.exists(chapter_file):
-                    with open(chapter_file, encoding="utf-8") as chf:
-                        combined_md += chf.read() + "\n\n<!-- PAGEBREAK -->\n\n"
+        return _iter_chapters_file(chapters_file, folder_name, joplin_index, reader)
     elif md_files:
-        for f in md_files:
-            chapter_file = os.path.join(folder_name, f) if folder_name and not os.path.isabs(f) else f
-            if os.path.exists(chapter_file):
-                with open(chapter_file, encoding="utf-8") as chf:
-                    combined_md += chf.read() + "\n\n:::pagebreak:::\n\n"
+        return _iter_md_files(md_files, folder_name, joplin_index, reader)
     else:
         raise ValueError("Either chapters_file must exist or md_files must be provided")
 
-    # Suppress alt text captions for images by removing alt text from markdown
-    def suppress_image_alt(md):
-        # Replace ![alt](src) with ![](src)
-        return re.sub(r'!\[[^\]]*\]\(([^\)]+)\)', r'![&nbsp;](\1)', md)
-    def reset_caps_in_code(md):
-        return re.sub(r'(\n```[a-zA-Z0-9_+-]*)', r'\1', md)
-    combined_md = suppress_image_alt(combined_md)
-    combined_md = reset_caps_in_code(combined_md)
 
-    # Write combined markdown to a temp file
+def read_book_items(md_files=None, chapters_file=None, folder_name=None, joplin_index=None):
+    """Return the items of iter_book_items as a list."""
+    return list(iter_book_items(md_files=md_files, chapters_file=chapters_file, folder_name=folder_name,
+                                joplin_index=joplin_index))
+
+
+def _note_item(name, joplin_index, pagebreak):
+    note_id = joplin_index.find_note(name)
+    if note_id is None:
+        print(f"Warning: no note titled {name!r} in the Joplin export")
+        return None
+    return {"type": "chapter", "name": name, "note_id": note_id,
+            "markdown": joplin_index.note_markdown(note_id) + pagebreak}
+
+
+def _iter_chapters_file(chapters_file, folder_name=None, joplin_index=None, reader=read_chapter):
+    with open(chapters_file, encoding="utf-8") as f:
+        lines = [line.strip() for line in f if line.strip() and not line.strip().startswith("#")]
+    for line in lines:
+        if line.startswith("<partname>"):
+            part_title = line.replace("<partname>", "").strip()
+            yield {"type": "part", "name": part_title, "markdown": f"\n\n# {part_title}{PAGEBREAK}"}
+        elif joplin_index is not None:
+            item = _note_item(line, joplin_index, PAGEBREAK)
+            if item:
+                yield item
+        else:
+            chapter_file = line
+            if folder_name and not os.path.isabs(chapter_file):
+                chapter_file = os.path.join(folder_name, chapter_file)
+            if not chapter_file.endswith(".md"):
+                chapter_file += ".md"
+            if os.path.exists(chapter_file):
+                yield {"type": "chapter", "name": line, "path": chapter_file,
+                       "markdown": reader(chapter_file) + PAGEBREAK}
+            else:
+                print(f"Warning: chapter file not found: {chapter_file}")
+
+
+def _iter_md_files(md_files, folder_name=None, joplin_index=None, reader=read_chapter):
+    for f in md_files:
+        if joplin_index is not None:
+            item = _note_item(f, joplin_index, MD_FILES_PAGEBREAK)
+            if item:
+                yield item
+            continue
+        chapter_file = os.path.join(folder_name, f) if folder_name and not os.path.isabs(f) else f
+        if os.path.exists(chapter_file):
+            yield {"type": "chapter", "name": f, "path": chapter_file,
+                   "markdown": reader(chapter_file) + MD_FILES_PAGEBREAK}
+        else:
+            print(f"Warning: chapter file not found: {chapter_file}")
+
+
+def filter_arguments():
+    args = []
+    for pandoc_filter in PANDOC_FILTERS:
+        args += ["--lua-filter" if pandoc_filter.endswith(".lua") else "--filter", pandoc_filter]
+    return args
+
+
+def highlight_option(cache_dir=None):
+    """Return pandoc's option for the highlight style: --syntax-highlighting, or --highlight-style before 3.8."""
+    try:
+        if not pandoc_runner.supports("--syntax-highlighting", cache_dir):
+            return "--highlight-style"
+    except OSError:
+        pass  # No pandoc: the build reports that once it runs it
+    return "--syntax-highlighting"
+
+
+def writer_arguments(folder_name=None, theme=PYGMENTS_THEME, cache_dir=None):
+    """Return the pandoc options the DOCX writer needs, before the reference DOCX is added."""
+    args = [f"{highlight_option(cache_dir)}={theme if theme in PANDOC_THEMES else PYGMENTS_THEME}"]
+    # Set resource_path for images
+    if folder_name:
+        args.extend(["--resource-path", folder_name])
+    return args
+
+
+def pandoc_arguments(folder_name=None, theme=PYGMENTS_THEME, cache_dir=None):
+    """Return the pandoc options of a build, before its reference DOCX is added."""
+    return ["-f", READER, *filter_arguments(), *writer_arguments(folder_name, theme, cache_dir)]
+
+
+def preprocess_item(item, preprocessor=PREPROCESSOR, trace=None):
+    """Preprocess one item's markdown, counting its images and code blocks in the trace."""
+    stats = {}
+    with (trace or BuildTrace()).stage("preprocess") as counts:
+        md = preprocessor.process(item["markdown"], stats)
+        counts["images"] += stats.get("images", 0)
+        counts["code_blocks"] += stats.get("code_blocks", 0)
+    return md
+
+
+def write_book_markdown(items, stream, preprocessor=PREPROCESSOR, trace=None):
+    """
+    Preprocess each item and write it to the text stream as soon as it is
+    read, so the combined book never has to exist as one string.
+    Returns the number of characters written.
+    """
+    trace = trace or BuildTrace()
+    written = 0
+    for item in traced_items(items, trace):
+        md = preprocess_item(item, preprocessor, trace)
+        with trace.stage("write_markdown") as counts:
+            written += stream.write(md)
+            counts["bytes_written"] += len(md.encode("utf-8"))
+    return written
+
+
+# Create a temporary reference DOCX that contains the requested centered
+# header and a centered page-number footer. If `base_ref` points to an
+# existing DOCX, use it as a base then inject header/footer.
+def make_reference_with_header_footer(base_ref, header_text, footer_field=FOOTER_FIELD):
+    from docx import Document
+    from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
+    from docx.oxml import OxmlElement
+    from docx.oxml.ns import qn
+
+    # Load existing template or create a new document
+    doc = Document(base_ref) if base_ref and os.path.exists(base_ref) else Document()
+
+    def add_page_number_field_to_paragraph(paragraph):
+        # Append a simple field for PAGE to the paragraph XML
+        fld = OxmlElement('w:fldSimple')
+        fld.set(qn('w:instr'), footer_field)
+        paragraph._p.append(fld)
+
+    for section in doc.sections:
+        # Header: center the provided header_text
+        header = section.header
+        # Use first paragraph or add one
+        if header.paragraphs:
+            hdr_p = header.paragraphs[0]
+            hdr_p.text = header_text
+        else:
+            hdr_p = header.add_paragraph(header_text)
+        hdr_p.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+
+        # Footer: center a page-number field
+        footer = section.footer
+        if footer.paragraphs:
+            ftr_p = footer.paragraphs[0]
+            # clear any existing text
+            ftr_p.text = ''
+        else:
+            ftr_p = footer.add_paragraph()
+        add_page_number_field_to_paragraph(ftr_p)
+        ftr_p.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+
+    add_chapter_title_style(doc)
+
+    # Save to a temp file and return its path
+    tmp_ref = tempfile.NamedTemporaryFile(delete=False, suffix='.docx')
+    tmp_path = tmp_ref.name
+    tmp_ref.close()
+    doc.save(tmp_path)
+    return tmp_path
+
+
+def add_chapter_title_style(doc):
+    """
+    Give the chapter title paragraph style an outline level, adding the style
+    (based on Heading 1) if the template has none. book-filter.lua writes
+    chapter titles as paragraphs in this style, and the outline level keeps
+    them in the TOC and Word's navigation pane like the headings they were.
+    """
+    from docx.enum.style import WD_STYLE_TYPE
+    from docx.oxml import OxmlElement
+    from docx.oxml.ns import qn
+
+    styles = doc.styles
+    if CHAPTER_TITLE_STYLE in [style.name for style in styles]:
+        style = styles[CHAPTER_TITLE_STYLE]
+    else:
+        style = styles.add_style(CHAPTER_TITLE_STYLE, WD_STYLE_TYPE.PARAGRAPH)
+        style.base_style = styles["Heading 1"]
+        style.next_paragraph_style = styles["Normal"]
+        style.quick_style = True
+    p_pr = style.element.get_or_add_pPr()
+    if p_pr.find(qn("w:outlineLvl")) is None:
+        outline_level = OxmlElement("w:outlineLvl")
+        outline_level.set(qn("w:val"), "0")
+        # Elements that follow w:outlineLvl in a w:pPr
+        p_pr.insert_element_before(outline_level, "w:divId", "w:cnfStyle", "w:rPr", "w:sectPr", "w:pPrChange")
+
+
+def reference_key(base_ref, header_text, footer_field=FOOTER_FIELD):
+    """Cache key of a generated reference DOCX: base template content, header text and footer field."""
+    return hash_parts("reference", REFERENCE_VERSION, hash_file(base_ref) if base_ref else None, header_text,
+                      footer_field)
+
+
+def cached_reference_docx(base_ref, header_text, footer_field=FOOTER_FIELD, cache_dir=None):
+    """
+    Return the path of a reference DOCX with the requested header and footer,
+    building it with make_reference_with_header_footer only when no build
+    with the same base template, header text and footer field is cached.
+    """
+    cache = DiskCache(cache_dir, "templates")
+    key = reference_key(base_ref, header_text, footer_field)
+    path = cache.get(key, ".docx")
+    if path is None:
+        generated_ref = make_reference_with_header_footer(base_ref, header_text, footer_field)
+        path = cache.put_file(key, generated_ref, ".docx", move=True)
+    return path
+
+
+def fragment_key(md, settings_key, folder_name=None):
+    """Cache key of one rendered fragment: its markdown, its images and the build settings."""
+    images = [(path, hash_file(path)) for path in image_paths(md, folder_name)]
+    return hash_parts(settings_key, md, *[part for image in images for part in image])
+
+
+class RenderPool:
+    """
+    Thread pool running up to `jobs` pandoc renders at once for one or more
+    builds. Each worker thread only waits on its own pandoc subprocess, so
+    threads are enough to keep the pandoc processes busy. A fragment that
+    several builds ask for while it is being rendered is rendered once, and
+    they all wait on the same future.
+    """
+
+    def __init__(self, jobs=1):
+        self.jobs = max(1, jobs)
+        self._pool = ThreadPoolExecutor(max_workers=self.jobs)
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def submit(self, md, key, pandoc_args, cache, trace=None, cache_dir=None):
+        """Return a future for the cached path of the fragment with this key, rendering it if needed."""
+        with self._lock:
+            future = self._futures.get(key)
+            if future is None:
+                future = self._futures[key] = self._pool.submit(render_fragment, md, key, pandoc_args, cache, trace,
+                                                                 cache_dir)
+                future.add_done_callback(lambda _: self._forget(key))
+            return future
+
+    def _forget(self, key):
+        # Finished fragments are found in the cache from now on
+        with self._lock:
+            self._futures.pop(key, None)
+
+    def shutdown(self):
+        self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+def build_incremental(items, output_file, pandoc_args, settings_key, cache, folder_name=None, jobs=1,
+                      preprocessor=PREPROCESSOR, trace=None, render_pool=None, cache_dir=None):
+    """
+    Render every item to its own DOCX fragment, reusing cached fragments whose
+    key is unchanged, then merge the fragments in order into output_file.
+    Missing fragments are rendered by up to `jobs` pandoc processes at once,
+    or on render_pool when several builds share one. cache_dir is the cache
+    root pandoc's info is kept under.
+    """
+    trace = trace or BuildTrace()
+    if render_pool is None:
+        with RenderPool(jobs) as pool:
+            return build_incremental(items, output_file, pandoc_args, settings_key, cache, folder_name,
+                                     preprocessor=preprocessor, trace=trace, render_pool=pool, cache_dir=cache_dir)
+    keys = []
+    submitted = set()
+    # Chapters are read and submitted as workers free up, so only a few are
+    # held in memory at once.
+    in_flight = set()
+    for item in traced_items(items, trace):
+        md = preprocess_item(item, preprocessor, trace)
+        key = fragment_key(md, settings_key, folder_name)
+        keys.append(key)
+        if key in submitted or cache.get(key, ".docx") is not None:
+            continue
+        if len(in_flight) >= 2 * render_pool.jobs:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+        in_flight.add(render_pool.submit(md, key, pandoc_args, cache, trace, cache_dir))
+        submitted.add(key)
+    for future in in_flight:
+        future.result()
+    if not keys:
+        raise ValueError("No chapters found to convert")
+
+    from docx_merge import merge_docx
+    with trace.stage("merge_fragments") as counts:
+        fragment_paths = [cache.get(key, ".docx") for key in keys]
+        merge_docx(fragment_paths, output_file)
+        counts["bytes_read"] += sum(os.path.getsize(path) for path in fragment_paths)
+        counts["bytes_written"] += os.path.getsize(output_file)
+    print(f"Rendered {len(submitted)} of {len(keys)} fragments, reused {len(keys) - len(submitted)} from cache")
+
+
+def ast_key(md, pandoc_version):
+    """Cache key of a chapter's parsed and filtered AST: its markdown, the reader and the filters."""
+    return hash_parts("ast", md, pandoc_version, READER, *filter_arguments(),
+                      *[hash_file(pandoc_filter) for pandoc_filter in PANDOC_FILTERS])
+
+
+def parse_chapter(md, key, cache, trace=None, cache_dir=None):
+    """Parse one chapter with pandoc and the book filters and store its JSON AST in the cache."""
+    with (trace or BuildTrace()).stage("parse") as counts:
+        data = pandoc_runner.convert_text(md, "json", format=READER, extra_args=filter_arguments(),
+                                          cache_dir=cache_dir).encode("utf-8")
+        counts["bytes_read"] += len(md.encode("utf-8"))
+        counts["bytes_written"] += len(data)
+    return cache.put_bytes(key, data, ".json")
+
+
+def build_from_asts(items, output_file, writer_args, cache, jobs=1, preprocessor=PREPROCESSOR, trace=None,
+                    max_bytes=AST_CACHE_MAX_BYTES, cache_dir=None):
+    """
+    Build output_file from each item's parsed and filtered pandoc AST.
+    ASTs are looked up in the cache by ast_key(), and only the missing ones
+    are parsed, by up to `jobs` pandoc processes at once. The ASTs are then
+    merged into one document that pandoc only has to write as DOCX. The
+    cache is pruned to max_bytes afterwards, least recently used first.
+    cache_dir is the cache root pandoc's info is kept under.
+    """
+    trace = trace or BuildTrace()
+    pandoc_version = pandoc_runner.get_pandoc_version(cache_dir)
+    keys = []
+    submitted = set()
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        futures = []
+        for item in traced_items(items, trace):
+            md = preprocess_item(item, preprocessor, trace)
+            key = ast_key(md, pandoc_version)
+            keys.append(key)
+            if key in submitted or cache.get(key, ".json", touch=True) is not None:
+                continue
+            futures.append(pool.submit(parse_chapter, md, key, cache, trace, cache_dir))
+            submitted.add(key)
+        for future in futures:
+            future.result()
+    if not keys:
+        raise ValueError("No chapters found to convert")
+
+    with trace.stage("merge_asts") as counts:
+        docs = []
+        for key in keys:
+            with open(cache.get(key, ".json"), encoding="utf-8") as f:
+                data = f.read()
+            counts["bytes_read"] += len(data)
+            docs.append(json.loads(data))
+        book = json.dumps(merge_documents(docs))
+    with trace.stage("pandoc") as counts:
+        counts["bytes_read"] += len(book)
+        pandoc_runner.convert_text(book, "docx", format="json", outputfile=output_file, extra_args=writer_args,
+                                   cache_dir=cache_dir)
+        counts["bytes_written"] += os.path.getsize(output_file)
+    cache.prune(max_bytes)
+    print(f"Parsed {len(submitted)} of {len(keys)} chapters, reused {len(keys) - len(submitted)} from the AST cache")
+
+
+def render_fragment(md, key, pandoc_args, cache, trace=None, cache_dir=None):
+    """Convert one markdown fragment with pandoc and store the DOCX in the cache."""
     temp_md_file = tempfile.NamedTemporaryFile(delete=False, suffix=".md", mode="w", encoding="utf-8")
-    temp_md_file.write(combined_md)
+    temp_md_file.write(md)
     temp_md_file.close()
-    temp_files.append(temp_md_file.name)
-
-    # Helper to create a temporary reference DOCX that contains the requested
-    # centered header and a centered page-number footer. If `reference_docx`
-    # points to an existing DOCX, use it as a base then inject header/footer.
-    def make_reference_with_header_footer(base_ref, header_text):
-        # Load existing template or create a new document
-        doc = Document(base_ref) if base_ref and os.path.exists(base_ref) else Document()
-
-        def add_page_number_field_to_paragraph(paragraph):
-            # Append a simple field for PAGE to the paragraph XML
-            fld = OxmlElement('w:fldSimple')
-            fld.set(qn('w:instr'), 'PAGE')
-            paragraph._p.append(fld)
-
-        for section in doc.sections:
-            # Header: center the provided header_text
-            header = section.header
-            # Use first paragraph or add one
-            if header.paragraphs:
-                hdr_p = header.paragraphs[0]
-                hdr_p.text = header_text
-            else:
-                hdr_p = header.add_paragraph(header_text)
-            hdr_p.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-
-            # Footer: center a page-number field
-            footer = section.footer
-            if footer.paragraphs:
-                ftr_p = footer.paragraphs[0]
-                # clear any existing text
-                ftr_p.text = ''
-            else:
-                ftr_p = footer.add_paragraph()
-            add_page_number_field_to_paragraph(ftr_p)
-            ftr_p.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-
-        # Save to a temp file and return its path
-        tmp_ref = tempfile.NamedTemporaryFile(delete=False, suffix='.docx')
-        tmp_path = tmp_ref.name
-        tmp_ref.close()
-        doc.save(tmp_path)
-        return tmp_path
-
-    # Use pypandoc to convert, set resource_path for images, enable raw_tex for page breaks
-    # Choose your Pygments theme here (e.g., monokai, tango, zenburn, haddock, etc.)
-    pygments_theme = "tango"  # Use a supported theme for DOCX
-    pandoc_args = [
-        "-f", "markdown+raw_tex",
-        f"--syntax-highlighting={pygments_theme}",
-        "--filter", "pandoc-pagebreak.py",
-        "--lua-filter","style-map.lua"
-    ]
-
-    # Always generate a reference DOCX that ensures the header and footer we want.
+    fd, temp_docx = tempfile.mkstemp(suffix=".docx")
+    os.close(fd)
+    try:
+        with (trace or BuildTrace()).stage("pandoc") as counts:
+            pandoc_runner.convert_file(temp_md_file.name, 'docx', outputfile=temp_docx, extra_args=pandoc_args,
+                                       cache_dir=cache_dir)
+            counts["bytes_read"] += os.path.getsize(temp_md_file.name)
+            counts["bytes_written"] += os.path.getsize(temp_docx)
+        return cache.put_file(key, temp_docx, ".docx", move=True)
+    finally:
+        for tf in (temp_md_file.name, temp_docx):
+            if os.path.exists(tf):
+                os.remove(tf)
+
+
+def convert_markdowns_to_docx(md_files=None, output_file="combined.docx", chapters_file=None, folder_name=None,
+                              reference_docx=None, incremental=False, cache_dir=None, jobs=1,
+                              header_text=DEFAULT_HEADER_TEXT, optimize_images=True, profile=None, on_stage=None,
+                              joplin_export=None, strict=False, preprocessor=None, reader=read_chapter,
+                              render_pool=None, ast_cache=False, optimize_output=False, compress_level=6,
+                              theme=PYGMENTS_THEME, prehighlight=True):
+    """
+    Convert markdown files to DOCX using Pandoc, handling <partname> logic from chapters.txt.
+    Args:
+        md_files: List of markdown files (used if chapters_file is None)
+        output_file: Output DOCX file path
+        chapters_file: Path to chapters.txt file (takes precedence over md_files)
+        folder_name: Optional folder where markdown files are located
+        reference_docx: Optional DOCX template for styling
+        incremental: Render each part page and chapter to its own cached DOCX
+            fragment and merge them, so only changed chapters are re-rendered
+        cache_dir: Optional cache root for fragments and generated reference DOCX files
+        jobs: Number of chapters to convert in parallel. Above 1, chapters are
+            rendered as separate fragments and merged, as in incremental builds
+        header_text: Text of the centered page header
+        optimize_images: Embed downsampled, recompressed and deduplicated
+            copies of local images instead of the originals
+        profile: Optional path ("-" for stdout) to write a JSON trace of the
+            build's stages to: wall and CPU time, peak RSS, bytes read and
+            written, and chapter, image and code block counts
+        on_stage: Optional callback called with each stage record as it ends
+        joplin_export: Optional Joplin JEX archive or RAW export directory;
+            chapter lines and md_files then name notes (by title or exported
+            file name) instead of files in folder_name
+        strict: Run the preflight check first and raise ValueError before
+            running pandoc if it finds a missing chapter, image or resource.
+            Otherwise missing chapters are skipped with a warning and
+            missing images are left to pandoc
+        preprocessor: Optional Preprocessor to use instead of the one built
+            from folder_name and optimize_images
+        reader: Function returning the text of a chapter file, given its path
+        render_pool: Optional RenderPool shared with other builds; chapters
+            are then rendered as fragments and merged, as in incremental builds
+        ast_cache: Keep each chapter's parsed and filtered pandoc AST in the
+            cache and only run pandoc's DOCX writer over the merged ASTs, so
+            only changed chapters are parsed again. Takes precedence over
+            incremental and render_pool
+        optimize_output: Run docx_optimize on the finished DOCX: store
+            identical media once, drop unused styles and orphaned parts, and
+            repack it at compress_level
+        compress_level: Deflate level of the optimized DOCX, 0 (store) to 9
+        theme: Pygments style to highlight code blocks in
+        prehighlight: Highlight fenced code blocks with Pygments before
+            pandoc and keep each block's OOXML in the cache, so unchanged
+            blocks are not highlighted again. Otherwise pandoc highlights
+            them, in theme if it is one of PANDOC_THEMES
+    Returns the build's BuildTrace; its error is set if pandoc failed.
+    """
+    temp_files = []
+    trace = BuildTrace("convert", on_stage=on_stage)
+    joplin_index = None
+    if joplin_export:
+        from joplin import JoplinIndex
+        with trace.stage("index_export"):
+            joplin_index = JoplinIndex.load(joplin_export, cache_dir=cache_dir)
+    if strict:
+        # Reads every chapter an extra time, so only strict builds pay for it
+        with trace.stage("preflight"):
+            report = preflight(chapters_file=chapters_file, md_files=md_files, folder_name=folder_name,
+                               joplin_index=joplin_index)
+        if not report.ok:
+            raise ValueError(report.format())
+    items = iter_book_items(md_files=md_files, chapters_file=chapters_file, folder_name=folder_name,
+                            joplin_index=joplin_index, reader=reader)
+    if preprocessor is None:
+        preprocessor = make_preprocessor(folder_name, optimize_images=optimize_images, cache_dir=cache_dir,
+                                         trace=trace, theme=theme if prehighlight else None)
+
+    pandoc_args = pandoc_arguments(folder_name, theme, cache_dir)
+
+    fragments = incremental or jobs > 1 or render_pool is not None
+    # Everything that changes how a fragment renders, other than its own text
+    # and images, goes into the fragment cache key.
+    settings_key = hash_parts(
+        *pandoc_args,
+        *[hash_file(pandoc_filter) for pandoc_filter in PANDOC_FILTERS],
+        reference_key(reference_docx, header_text),
+        pandoc_runner.get_pandoc_version(cache_dir) if fragments else None,
+    )
+    # Always use a reference DOCX that ensures the header and footer we want.
     # Use any provided reference_docx as a base template (it will be copied and
-    # the header/footer injected), otherwise create a minimal template.
-    header_text = "Test-First Copilot - Greenfield Edition"
+    # the header/footer injected), otherwise create a minimal template. The
+    # result is cached, so repeated builds reuse the prepared template.
     try:
-        generated_ref = make_reference_with_header_footer(reference_docx, header_text)
-        pandoc_args.append(f"--reference-doc={generated_ref}")
-        # ensure cleanup later
-        temp_files.append(generated_ref)
+        with trace.stage("reference_docx"):
+            generated_ref = cached_reference_docx(reference_docx, header_text, cache_dir=cache_dir)
+        reference_args = [f"--reference-doc={generated_ref}"]
     except Exception as e:
         print("Warning: could not create generated reference docx:", e)
-    if folder_name:
-        pandoc_args.extend(["--resource-path", folder_name])
-    try:
-        pypandoc.convert_file(temp_md_file.name, 'docx', outputfile=output_file, extra_args=pandoc_args)
-        print(f"Saved {output_file}")
-    except Exception as e:
-        print("Pandoc error:", e)
+        reference_args = []
+    pandoc_args += reference_args
+
+    if ast_cache:
+        try:
+            build_from_asts(items, output_file, writer_arguments(folder_name, theme, cache_dir) + reference_args,
+                            DiskCache(cache_dir, "ast"), jobs=jobs, preprocessor=preprocessor, trace=trace,
+                            cache_dir=cache_dir)
+            print(f"Saved {output_file}")
+        except Exception as e:
+            trace.error = str(e)
+            print("Pandoc error:", e)
+    elif fragments:
+        # A parallel build that is not incremental renders into a throwaway cache.
+        scratch_dir = None if incremental else tempfile.mkdtemp(prefix="docx-fragments-")
+        try:
+            cache = DiskCache(cache_dir if incremental else scratch_dir, "fragments")
+            build_incremental(items, output_file, pandoc_args, settings_key, cache,
+                              folder_name=folder_name, jobs=jobs, preprocessor=preprocessor, trace=trace,
+                              render_pool=render_pool, cache_dir=cache_dir)
+            print(f"Saved {output_file}")
+        except Exception as e:
+            trace.error = str(e)
+            print("Pandoc error:", e)
+        finally:
+            if scratch_dir:
+                shutil.rmtree(scratch_dir, ignore_errors=True)
+    else:
+        # Stream the preprocessed chapters straight into the pandoc input file
+        temp_md_file = tempfile.NamedTemporaryFile(delete=False, suffix=".md", mode="w", encoding="utf-8")
+        temp_files.append(temp_md_file.name)
+        with temp_md_file:
+            write_book_markdown(items, temp_md_file, preprocessor, trace)
+        try:
+            with trace.stage("pandoc") as counts:
+                counts["bytes_read"] += os.path.getsize(temp_md_file.name)
+                pandoc_runner.convert_file(temp_md_file.name, 'docx', outputfile=output_file, extra_args=pandoc_args,
+                                           cache_dir=cache_dir)
+                counts["bytes_written"] += os.path.getsize(output_file)
+            print(f"Saved {output_file}")
+        except Exception as e:
+            trace.error = str(e)
+            print("Pandoc error:", e)
 
+    if optimize_output and trace.error is None:
+        from docx_optimize import format_report, optimize_docx
+        with trace.stage("optimize_docx") as counts:
+            report = optimize_docx(output_file, compress_level=compress_level)
+            counts["bytes_read"] += report["bytes_before"]
+            counts["bytes_written"] += report["bytes_after"]
+        print(format_report(report, output_file))
+    prune_code_cache = getattr(getattr(preprocessor, "code_renderer", None), "prune", None)
+    if prune_code_cache is not None:
+        prune_code_cache()
     # Clean up temp files
     for tf in temp_files:
         try:
             os.remove(tf)
         except Exception:
             pass
+    if profile:
+        trace.write(profile)
+    return trace
+
+
+def _chapter_text(source):
+    """Return the markdown of a chapter given as str, bytes or a file-like object."""
+    if hasattr(source, "read"):
+        source = source.read()
+    if isinstance(source, bytes):
+        source = source.decode("utf-8")
+    if not isinstance(source, str):
+        raise ValueError(f"Chapters must be str, bytes or file-like objects, not {type(source).__name__}")
+    return source
+
+
+def data_uri(data, name):
+    """Return a data: URI for image bytes, with the MIME type guessed from name."""
+    mime = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    return f"data:{mime};base64,{base64.b64encode(data).decode('ascii')}"
+
+
+def convert_to_docx(chapters, output=None, images=None, reference_docx=None, header_text=DEFAULT_HEADER_TEXT,
+                    optimize_images=True, cache_dir=None, on_stage=None):
+    """
+    Convert chapters held in memory to a DOCX without writing any files.
+    Chapters are read, preprocessed and piped into pandoc's stdin one at a
+    time as pandoc consumes them, so a generator can produce them lazily.
+    Image links whose source is a key of `images` are replaced by data:
+    URIs, and pandoc's stdout is copied to output as it is produced. Only
+    the generated reference DOCX lives on disk, in the template cache.
+    Args:
+        chapters: Iterable of chapters, each a str, bytes (UTF-8) or
+            file-like object; a page break follows each one
+        output: Optional binary stream to write the DOCX to
+        images: Optional {source as written in the markdown: bytes or
+            binary file-like object} of the images the chapters link to
+        reference_docx: Optional DOCX template for styling
+        header_text: Text of the centered page header
+        optimize_images: Embed downsampled and recompressed images
+        cache_dir: Optional cache root for the generated reference DOCX
+        on_stage: Optional callback called with each stage record as it ends
+    Returns the DOCX bytes, or the number of bytes written if output is given.
+    Raises RuntimeError if pandoc fails.
+    """
+    trace = BuildTrace("convert", on_stage=on_stage)
+    images = {posixpath.normpath(name): data for name, data in (images or {}).items()}
+    uris = {}
+
+    def rewrite_src(src):
+        name = posixpath.normpath(src)
+        if name not in images:
+            return src
+        if name not in uris:
+            data = images[name]
+            data = data.read() if hasattr(data, "read") else data
+            if optimize_images:
+                from images import optimize_image_bytes
+                with trace.stage("optimize_images") as counts:
+                    counts["images"] += 1
+                    counts["bytes_read"] += len(data)
+                    data = optimize_image_bytes(data)
+            uris[name] = data_uri(data, name)
+        return uris[name]
+
+    preprocessor = Preprocessor([image_rule(rewrite_src)] + [rule for rule in DEFAULT_RULES if rule.name != "images"])
+    pandoc_args = pandoc_arguments(cache_dir=cache_dir)
+    try:
+        with trace.stage("reference_docx"):
+            pandoc_args.append(f"--reference-doc={cached_reference_docx(reference_docx, header_text, cache_dir)}")
+    except Exception as e:
+        print("Warning: could not create generated reference docx:", e)
+
+    proc = subprocess.Popen([pandoc_runner.get_pandoc_path(cache_dir), *pandoc_args, "-t", "docx", "-o", "-"],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    errors = []
+    stderr = []
+
+    def feed():
+        items = ({"type": "chapter", "name": f"chapter {i + 1}", "markdown": _chapter_text(chapter) + PAGEBREAK}
+                 for i, chapter in enumerate(chapters))
+        try:
+            for item in traced_items(items, trace):
+                data = preprocess_item(item, preprocessor, trace).encode("utf-8")
+                with trace.stage("write_markdown") as counts:
+                    proc.stdin.write(data)
+                    counts["bytes_written"] += len(data)
+        except BrokenPipeError:
+            pass  # pandoc exited early; its exit status says why
+        except BaseException as e:
+            errors.append(e)
+            proc.kill()
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    threads = [threading.Thread(target=feed), threading.Thread(target=lambda: stderr.append(proc.stderr.read()))]
+    for thread in threads:
+        thread.start()
+    stream = output if output is not None else io.BytesIO()
+    written = 0
+    try:
+        with trace.stage("pandoc") as counts:
+            for chunk in iter(lambda: proc.stdout.read(1 << 16), b""):
+                stream.write(chunk)
+                written += len(chunk)
+            counts["bytes_written"] += written
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+        proc.stdout.close()
+        proc.stderr.close()
+        proc.wait()
+    if errors:
+        raise errors[0]
+    if proc.returncode != 0:
+        trace.error = stderr[0].decode("utf-8", "replace").strip() if stderr else ""
+        raise RuntimeError(f"Pandoc error: {trace.error}")
+    return written if output is not None else stream.getvalue()
+
+
+def main(argv=None):
+    """Command line entry point; returns the exit status."""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert the chapters listed in chapters.txt to a DOCX book.")
+    parser.add_argument("md_files", nargs="*", metavar="MD",
+                        help="markdown files to convert, in order, instead of the chapters file")
+    parser.add_argument("-o", "--output", default="book.docx", help="DOCX file to write")
+    parser.add_argument("--chapters-file", default="chapters.txt", help="file listing parts and chapters")
+    parser.add_argument("--folder",
+                        help="folder the chapter files are in (default: Test-First Copilot for the chapters file)")
+    parser.add_argument("--reference-docx", default="custom-reference.docx",
+                        help="DOCX template for styling (ignored if it does not exist)")
+    parser.add_argument("--cache-dir",
+                        help="cache root (default: $JOPLIN_DOCX_CACHE or ~/.cache/joplin-export-to-docx)")
+    parser.add_argument("--jobs", type=int, default=1, help="number of chapters to convert in parallel")
+    parser.add_argument("--incremental", action="store_true", help="reuse cached chapter fragments")
+    parser.add_argument("--no-optimize-images", dest="optimize_images", action="store_false",
+                        help="embed the original image files")
+    parser.add_argument("--header-text", default=DEFAULT_HEADER_TEXT, help="text of the centered page header")
+    parser.add_argument("--profile", metavar="TRACE.json", help="write a JSON trace of the build stages ('-' for stdout)")
+    parser.add_argument("--joplin-export", metavar="EXPORT",
+                        help="read chapters from a Joplin JEX archive or RAW export directory by note title")
+    parser.add_argument("--ast-cache", action="store_true",
+                        help="reuse parsed chapter ASTs and only run pandoc's DOCX writer")
+    parser.add_argument("--optimize-output", action="store_true",
+                        help="dedupe media, drop unused styles and parts, and repack the finished DOCX")
+    parser.add_argument("--compress-level", type=int, default=6,
+                        help="deflate level of the optimized DOCX, 0 (fastest) to 9 (smallest)")
+    parser.add_argument("--strict", action="store_true",
+                        help="stop before converting if a chapter, image or resource is missing")
+    parser.add_argument("--theme", default=PYGMENTS_THEME, help="Pygments style to highlight code blocks in")
+    parser.add_argument("--no-prehighlight", dest="prehighlight", action="store_false",
+                        help="let pandoc highlight code blocks instead of reusing cached ones")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="check the chapters, images and pandoc, print the pandoc command and stop")
+    args = parser.parse_args(argv)
+    md_files = args.md_files or None
+    chapters_file = None if md_files else args.chapters_file
+    if args.folder is None and chapters_file:
+        args.folder = "Test-First Copilot"
+    try:
+        return _run_cli(args, md_files, chapters_file)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 1
+
+
+def _run_cli(args, md_files, chapters_file):
+    if args.dry_run:
+        joplin_index = None
+        if args.joplin_export:
+            from joplin import JoplinIndex
+            joplin_index = JoplinIndex.load(args.joplin_export, cache_dir=args.cache_dir)
+        report = preflight(chapters_file=chapters_file, md_files=md_files, folder_name=args.folder,
+                           joplin_index=joplin_index)
+        print(report.format())
+        try:
+            pandoc = pandoc_runner.pandoc_info(args.cache_dir)
+        except OSError as e:
+            print(e)
+            return 1
+        print(f"pandoc {pandoc['version']}: " + " ".join(
+            [pandoc["path"], *pandoc_arguments(args.folder, args.theme, args.cache_dir),
+             "-t", "docx", "-o", args.output]))
+        return 0 if report.ok else 1
+
+    trace = convert_markdowns_to_docx(md_files=md_files, output_file=args.output, chapters_file=chapters_file,
+                                      folder_name=args.folder, reference_docx=args.reference_docx,
+                                      incremental=args.incremental, cache_dir=args.cache_dir, jobs=args.jobs,
+                                      header_text=args.header_text, optimize_images=args.optimize_images,
+                                      profile=args.profile, joplin_export=args.joplin_export, strict=args.strict,
+                                      ast_cache=args.ast_cache, optimize_output=args.optimize_output,
+                                      compress_level=args.compress_level, theme=args.theme,
+                                      prehighlight=args.prehighlight)
+    return 1 if trace.error else 0
+
 
 if __name__ == "__main__":
-    output_docx = "book.docx"
-    # Set reference_docx to your template path or None
-    reference_docx = "custom-reference.docx" # None # "template.docx"  # e.g., "reference.docx"
-    convert_markdowns_to_docx(output_file=output_docx, chapters_file="chapters.txt", folder_name="Test-First Copilot", reference_docx=reference_docx)
+    sys.exit(main())
@@ -0,0 +1,243 @@
+"""
+Asyncio version of convert_markdowns_to_docx for services that run many
+conversions on one event loop.
+
+    trace = await convert_markdowns_to_docx_async(chapters_file="chapters.txt",
+                                                  folder_name="Test-First Copilot",
+                                                  output_file="book.docx", timeout=60)
+
+The reference template is prepared while the chapters are read and
+preprocessed, and each chapter is written to pandoc's stdin as soon as it
+is ready, so pandoc is already reading the book while the later chapters
+are still being prepared. File reads, preprocessing and template building
+run in worker threads, and pandoc runs as an asyncio subprocess, so the
+event loop is never blocked. Failures raise ConversionError, which names
+the chapter when reading or preprocessing it failed. A timeout or
+a cancelled task kills pandoc and leaves no partial output file.
+"""
+import asyncio
+import os
+import tempfile
+
+import pandoc_runner
+from convert import (
+    DEFAULT_HEADER_TEXT, PYGMENTS_THEME, cached_reference_docx, iter_book_items, make_preprocessor,
+    pandoc_arguments, preprocess_item, read_chapter,
+)
+from preflight import preflight
+from tracing import BuildTrace, traced_items
+
+# Preprocessed chapters that may wait for pandoc to read them
+QUEUE_SIZE = 4
+
+
+class ConversionError(RuntimeError):
+    """
+    A conversion that failed.
+    Args:
+        message: What went wrong
+        stage: Stage that failed: "preflight", "read", "preprocess", "pandoc"
+            or "timeout"
+        returncode: Pandoc's exit status, if it ran to the end
+        stderr: What pandoc printed to stderr
+        trace: The BuildTrace of the conversion
+        path: The chapter that could not be read or preprocessed
+    """
+
+    def __init__(self, message, stage, returncode=None, stderr="", trace=None, path=None):
+        super().__init__(message)
+        self.stage = stage
+        self.returncode = returncode
+        self.stderr = stderr
+        self.trace = trace
+        self.path = path
+
+
+class PreflightError(ConversionError, ValueError):
+    """A strict conversion stopped because a chapter, image or resource is missing; report has the details."""
+
+    def __init__(self, report, trace=None):
+        super().__init__(report.format(), "preflight", trace=trace)
+        self.report = report
+
+
+class ConversionTimeout(ConversionError, TimeoutError):
+    """A conversion that took longer than its timeout; pandoc was killed."""
+
+
+async def convert_markdowns_to_docx_async(md_files=None, output_file="combined.docx", chapters_file=None,
+                                          folder_name=None, reference_docx=None, header_text=DEFAULT_HEADER_TEXT,
+                                          optimize_images=True, cache_dir=None, joplin_export=None, strict=False,
+                                          theme=PYGMENTS_THEME, prehighlight=True, timeout=None, on_stage=None,
+                                          reader=read_chapter):
+    """
+    Convert markdown files to a DOCX like convert_markdowns_to_docx's
+    single-pass build, without blocking the event loop.
+    Args:
+        md_files: List of markdown files (used if chapters_file is None)
+        output_file: Output DOCX file path; it is only replaced once pandoc succeeds
+        chapters_file: Path to chapters.txt file (takes precedence over md_files)
+        folder_name: Optional folder where markdown files are located
+        reference_docx: Optional DOCX template for styling
+        header_text: Text of the centered page header
+        optimize_images: Embed downsampled, recompressed and deduplicated
+            copies of local images instead of the originals
+        cache_dir: Optional cache root
+        joplin_export: Optional Joplin JEX archive or RAW export directory
+            to look chapters up in by note title
+        strict: Run the preflight check first and raise PreflightError
+            before running pandoc if a chapter, image or resource is
+            missing. Otherwise missing chapters are skipped with a warning
+            and missing images are left to pandoc
+        theme: Pygments style to highlight code blocks in
+        prehighlight: Reuse cached highlighted code blocks
+        timeout: Optional seconds the whole conversion may take
+        on_stage: Optional callback called with each stage record as it
+            ends; it may be called from a worker thread
+        reader: Function returning the text of a chapter file, given its path
+    Returns the conversion's BuildTrace.
+    Raises ConversionError if a chapter cannot be read or preprocessed or
+    pandoc fails, ConversionTimeout (also a
+    TimeoutError) on timeout and PreflightError (also a ValueError) for a
+    strict conversion of an incomplete book.
+    """
+    trace = BuildTrace("convert", on_stage=on_stage)
+    try:
+        await asyncio.wait_for(_convert(trace, md_files, output_file, chapters_file, folder_name, reference_docx,
+                                        header_text, optimize_images, cache_dir, joplin_export, strict, theme,
+                                        prehighlight, reader), timeout)
+    except asyncio.TimeoutError:
+        trace.error = f"Conversion timed out after {timeout}s"
+        raise ConversionTimeout(trace.error, "timeout", trace=trace) from None
+    except ConversionError as e:
+        trace.error = str(e)
+        e.trace = trace
+        raise
+    except asyncio.CancelledError:
+        trace.error = "cancelled"
+        raise
+    return trace
+
+
+async def _convert(trace, md_files, output_file, chapters_file, folder_name, reference_docx, header_text,
+                   optimize_images, cache_dir, joplin_export, strict, theme, prehighlight, reader):
+    def build_reference():
+        with trace.stage("reference_docx"):
+            return cached_reference_docx(reference_docx, header_text, cache_dir=cache_dir)
+
+    # The template is built while the book is checked and read
+    reference_task = asyncio.ensure_future(asyncio.to_thread(build_reference))
+    tasks = [reference_task]
+    proc = None
+    fd, temp_output = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output_file)), suffix=".docx.tmp")
+    os.close(fd)
+    try:
+        joplin_index = None
+        if joplin_export:
+            from joplin import JoplinIndex
+
+            def load_index():
+                with trace.stage("index_export"):
+                    return JoplinIndex.load(joplin_export, cache_dir=cache_dir)
+
+            joplin_index = await asyncio.to_thread(load_index)
+
+        def check():
+            with trace.stage("preflight"):
+                return preflight(chapters_file=chapters_file, md_files=md_files, folder_name=folder_name,
+                                 joplin_index=joplin_index)
+
+        # Reads every chapter an extra time before pandoc can start, so only strict builds pay for it
+        if strict:
+            report = await asyncio.to_thread(check)
+            if not report.ok:
+                raise PreflightError(report)
+
+        # Building the preprocessor imports Pygments; keep that off the event loop too
+        preprocessor = await asyncio.to_thread(make_preprocessor, folder_name, optimize_images=optimize_images,
+                                               cache_dir=cache_dir, trace=trace,
+                                               theme=theme if prehighlight else None)
+
+        def read(path):
+            try:
+                return reader(path)
+            except (OSError, UnicodeDecodeError) as e:
+                raise ConversionError(f"Could not read {path}: {e}", "read", path=path) from e
+
+        items = traced_items(iter_book_items(md_files=md_files, chapters_file=chapters_file,
+                                             folder_name=folder_name, joplin_index=joplin_index, reader=read),
+                             trace)
+        chapters = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+        def next_chapter():
+            item = next(items, None)
+            if item is None:
+                return None
+            try:
+                return preprocess_item(item, preprocessor, trace).encode("utf-8")
+            except Exception as e:
+                path = item.get("path", item["name"])
+                raise ConversionError(f"Could not preprocess {path}: {e}", "preprocess", path=path) from e
+
+        async def produce():
+            while True:
+                md = await asyncio.to_thread(next_chapter)
+                await chapters.put(md)
+                if md is None:
+                    return
+
+        producer = asyncio.ensure_future(produce())
+        tasks.append(producer)
+
+        # Looking pandoc up may probe it once; keep that off the event loop
+        args = await asyncio.to_thread(pandoc_arguments, folder_name, theme, cache_dir)
+        try:
+            args.append(f"--reference-doc={await reference_task}")
+        except Exception as e:
+            print("Warning: could not create generated reference docx:", e)
+        pandoc = pandoc_runner.get_pandoc_path(cache_dir)
+        proc = await asyncio.create_subprocess_exec(pandoc, *args, "-t", "docx", "-o", temp_output,
+                                                    stdin=asyncio.subprocess.PIPE,
+                                                    stdout=asyncio.subprocess.DEVNULL,
+                                                    stderr=asyncio.subprocess.PIPE)
+
+        async def feed():
+            # If pandoc exits early, the remaining chapters are still taken
+            # off the queue so the producer can finish; the exit status says why.
+            broken = False
+            while (md := await chapters.get()) is not None:
+                if broken:
+                    continue
+                with trace.stage("write_markdown") as counts:
+                    try:
+                        proc.stdin.write(md)
+                        await proc.stdin.drain()
+                        counts["bytes_written"] += len(md)
+                    except (BrokenPipeError, ConnectionResetError):
+                        broken = True
+            proc.stdin.close()
+
+        with trace.stage("pandoc") as counts:
+            feeder = asyncio.ensure_future(feed())
+            stderr = asyncio.ensure_future(proc.stderr.read())
+            tasks += [feeder, stderr]
+            await asyncio.gather(producer, feeder, stderr)
+            returncode = await proc.wait()
+            if returncode == 0:
+                counts["bytes_written"] += os.path.getsize(temp_output)
+        err = stderr.result().decode("utf-8", "replace").strip()
+        if returncode != 0:
+            raise ConversionError(f"Pandoc error: {err}", "pandoc", returncode=returncode, stderr=err)
+        os.replace(temp_output, output_file)
+        prune_code_cache = getattr(preprocessor.code_renderer, "prune", None)
+        if prune_code_cache is not None:
+            await asyncio.to_thread(prune_code_cache)
+    finally:
+        if proc is not None and proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if os.path.exists(temp_output):
+            os.remove(temp_output)
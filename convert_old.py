@@ -2,38 +2,113 @@ import markdown
 from docx import Document
 from docx.shared import Pt, RGBColor, Cm, Emu
 from docx.oxml import OxmlElement, parse_xml
-from docx.oxml.ns import qn, nsmap
-from pygments import highlight
-from pygments.lexers import guess_lexer, get_lexer_by_name
-from pygments.formatters.html import HtmlFormatter
+from docx.oxml.ns import qn, nsmap, nsdecls
+from docx.enum.style import WD_STYLE_TYPE
+from docx.image.image import Image as DocxImage
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.table import _Cell
+from xml.sax.saxutils import escape
 from bs4 import BeautifulSoup
 import re
 import os
-num_def_counter = [1]
-def add_numbering_restart(document):
-        numbering_part = document.part.numbering_part
-        abstract_num_id = num_def_counter[0]
-        num_id = num_def_counter[0]
-        num_def_counter[0] += 1
-        abstract_num_xml = f'''
-        <w:abstractNum w:abstractNumId="{abstract_num_id}" xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">
-            <w:multiLevelType w:val="singleLevel"/>
-            <w:lvl w:ilvl="0">
-                <w:start w:val="1"/>
-                <w:numFmt w:val="decimal"/>
-                <w:lvlText w:val="%1."/>
-                <w:lvlJc w:val="left"/>
-                <w:pPr/>
-            </w:lvl>
-        </w:abstractNum>
-        '''
-        abstract_num = parse_xml(abstract_num_xml)
-        numbering_part.element.append(abstract_num)
-        num_xml = f'<w:num w:numId="{num_id}" xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:abstractNumId w:val="{abstract_num_id}"/></w:num>'
-        num = parse_xml(num_xml)
-        numbering_part.element.append(num)
+import weakref
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from io import BytesIO
+from lxml import etree
+from docx_optimize import format_report, optimize_docx
+from docx_stream import StreamingDocxWriter
+from highlight import highlight_lines
+from images import optimize_image
+from tracing import BuildTrace
+LIST_LEVELS = 9
+NUMBER_FORMATS = ("decimal", "lowerLetter", "lowerRoman")
+BULLET_CHARS = ("\u2022", "\u25e6", "\u25aa")
+LIST_INDENT_TWIPS = 720
+
+_list_numberings = weakref.WeakKeyDictionary()
+# Next wp:docPr id of documents that chapters are spliced into
+_next_drawing_ids = weakref.WeakKeyDictionary()
+
+
+class ListNumbering:
+    """
+    List numbering of one document.
+    Ordered and bullet lists each get a single multi-level w:abstractNum,
+    added on first use. Every ordered list gets its own small w:num that
+    points at the shared definition and restarts its level with a
+    w:lvlOverride; all bullet lists share one w:num. Ids continue from the
+    ones already in the document, so builds are deterministic. Each w:num
+    added is recorded in created as (num_id, kind, level, start).
+    """
+
+    def __init__(self, document):
+        self._numbering = document.part.numbering_part.element
+        self._next_abstract_id = max(
+            (int(i) for i in self._numbering.xpath("./w:abstractNum/@w:abstractNumId")), default=-1) + 1
+        self._next_num_id = max((int(i) for i in self._numbering.xpath("./w:num/@w:numId")), default=0) + 1
+        self._abstract_ids = {}
+        self._bullet_num_id = None
+        self.created = []
+
+    @classmethod
+    def for_document(cls, document):
+        numbering = _list_numberings.get(document.part)
+        if numbering is None:
+            numbering = _list_numberings[document.part] = cls(document)
+        return numbering
+
+    def _abstract_id(self, kind):
+        if kind not in self._abstract_ids:
+            levels = []
+            for i in range(LIST_LEVELS):
+                if kind == "ordered":
+                    fmt, text = NUMBER_FORMATS[i % len(NUMBER_FORMATS)], f"%{i + 1}."
+                else:
+                    fmt, text = "bullet", BULLET_CHARS[i % len(BULLET_CHARS)]
+                levels.append(
+                    f'<w:lvl w:ilvl="{i}"><w:start w:val="1"/><w:numFmt w:val="{fmt}"/>'
+                    f'<w:lvlText w:val="{text}"/><w:lvlJc w:val="left"/>'
+                    f'<w:pPr><w:ind w:left="{LIST_INDENT_TWIPS * (i + 1)}" w:hanging="360"/></w:pPr></w:lvl>'
+                )
+            abstract = parse_xml(
+                f'<w:abstractNum {nsdecls("w")} w:abstractNumId="{self._next_abstract_id}">'
+                f'<w:multiLevelType w:val="multilevel"/>{"".join(levels)}</w:abstractNum>'
+            )
+            # Definitions must come before the first w:num
+            first_num = self._numbering.find(qn("w:num"))
+            if first_num is not None:
+                first_num.addprevious(abstract)
+            else:
+                self._numbering.append(abstract)
+            self._abstract_ids[kind] = self._next_abstract_id
+            self._next_abstract_id += 1
+        return self._abstract_ids[kind]
+
+    def _add_num(self, kind, restart_level=None, start=1):
+        num_id = self._next_num_id
+        self._next_num_id += 1
+        override = ""
+        if restart_level is not None:
+            override = (f'<w:lvlOverride w:ilvl="{restart_level}">'
+                        f'<w:startOverride w:val="{start}"/></w:lvlOverride>')
+        self._numbering._insert_num(parse_xml(
+            f'<w:num {nsdecls("w")} w:numId="{num_id}">'
+            f'<w:abstractNumId w:val="{self._abstract_id(kind)}"/>{override}</w:num>'
+        ))
+        self.created.append((num_id, kind, restart_level, start))
         return num_id
-    # ...existing code...
+
+    def restart(self, level=0, start=1):
+        """Return the numId of a new ordered list numbered from start at level."""
+        return self._add_num("ordered", restart_level=min(level, LIST_LEVELS - 1), start=start)
+
+    def bullets(self):
+        """Return the numId shared by all bullet lists."""
+        if self._bullet_num_id is None:
+            self._bullet_num_id = self._add_num("bullet")
+        return self._bullet_num_id
 
 
 def set_run_font(run, monospace=False, bold=False, italic=False, color=None, size=9):
@@ -51,33 +126,6 @@ def set_run_font(run, monospace=False, bold=False, italic=False, color=None, siz
         run.font.color.rgb = RGBColor(*color)
 
 
-def parse_css_styles(formatter):
-    """Return dict {class: {color, bold, italic}} from Pygments CSS."""
-    css = formatter.get_style_defs('.highlight')
-    styles = {}
-    for rule in css.split("\n"):
-        m = re.match(r"\.highlight\s+\.([a-zA-Z0-9_-]+)\s*\{([^}]*)\}", rule.strip())
-        if not m:
-            continue
-        cls, body = m.groups()
-        props = {}
-        for part in body.split(";"):
-            part = part.strip()
-            if part.startswith("color:"):
-                hexcol = part.split(":")[1].strip()
-                if hexcol.startswith("#") and len(hexcol) == 7:
-                    r = int(hexcol[1:3], 16)
-                    g = int(hexcol[3:5], 16)
-                    b = int(hexcol[5:7], 16)
-                    props["color"] = (r, g, b)
-            if "bold" in part:
-                props["bold"] = True
-            if "italic" in part:
-                props["italic"] = True
-        styles[cls] = props
-    return styles
-
-
 def set_cell_width(cell, emu_value):
     """Force table cell width in EMU."""
     tc = cell._element
@@ -88,42 +136,95 @@ def set_cell_width(cell, emu_value):
     tcPr.append(tcW)
 
 
-def add_code_block(document, code, theme="friendly", language=None):
-    """Render syntax-highlighted code in a 2-column table (line numbers + code)."""
-    # Choose lexer
+CODE_BLOCK_STYLE = "Code Block"
+CODE_LINE_NUMBER_STYLE = "Code Line Number"
+CODE_STYLES = ("table", "compact")
+BACKENDS = ("python-docx", "stream")
+# Control characters that cannot appear in XML
+XML_INVALID_RE = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def code_block_styles(document):
+    """
+    Return the style ids of the shared paragraph style for compact code blocks
+    and of the character style for their line numbers, adding both to the
+    document on first use.
+    """
+    styles = document.styles
     try:
-        if language:
-            lexer = get_lexer_by_name(language)
-        else:
-            lexer = guess_lexer(code)
-    except Exception:
-        lexer = get_lexer_by_name("text")
-
-    # Format with chosen theme
-    formatter = HtmlFormatter(nowrap=False, style=theme)
-    highlighted = highlight(code, lexer, formatter)
-    soup = BeautifulSoup(highlighted, "html.parser")
-    css_styles = parse_css_styles(formatter)
-
-    pre = soup.find("pre")
-    if pre is None:
-        return
+        para_style = styles[CODE_BLOCK_STYLE]
+    except KeyError:
+        para_style = styles.add_style(CODE_BLOCK_STYLE, WD_STYLE_TYPE.PARAGRAPH)
+        para_style.font.name = "Courier New"
+        para_style.font.size = Pt(9)
+        para_style.paragraph_format.line_spacing = 1.2
+        para_style.paragraph_format.space_before = Pt(6)
+        para_style.paragraph_format.space_after = Pt(12)
+        para_style.paragraph_format.keep_together = True
+        shd = OxmlElement('w:shd')
+        shd.set(qn('w:val'), 'clear')
+        shd.set(qn('w:color'), 'auto')
+        shd.set(qn('w:fill'), "F2F2F2")
+        para_style.element.get_or_add_pPr().append(shd)
+    try:
+        number_style = styles[CODE_LINE_NUMBER_STYLE]
+    except KeyError:
+        number_style = styles.add_style(CODE_LINE_NUMBER_STYLE, WD_STYLE_TYPE.CHARACTER)
+        number_style.font.color.rgb = RGBColor(128, 128, 128)
+    return para_style.style_id, number_style.style_id
 
-    # Split into lines, keeping <span>
-    lines, current_line = [], []
-    for node in pre.children:
-        if isinstance(node, str):
-            parts = node.split("\n")
-            for i, part in enumerate(parts):
-                if i > 0:
-                    lines.append(current_line)
-                    current_line = []
-                if part:
-                    current_line.append(part)
-        else:
-            current_line.append(node)
-    if current_line:
-        lines.append(current_line)
+
+def compact_code_xml(lines, para_style_id, number_style_id=None):
+    """
+    Return the XML of one paragraph holding all lines of a highlighted code
+    block, separated by line breaks. Runs only carry their token's color,
+    bold and italic; font, size and shading come from the paragraph style.
+    If number_style_id is given, each line starts with its right-aligned
+    number in that character style.
+    """
+    width = len(str(len(lines)))
+    parts = [f'<w:p {nsdecls("w")}><w:pPr><w:pStyle w:val="{para_style_id}"/></w:pPr>']
+    for i, runs in enumerate(lines, start=1):
+        if i > 1:
+            parts.append('<w:r><w:br/></w:r>')
+        if number_style_id:
+            parts.append(f'<w:r><w:rPr><w:rStyle w:val="{number_style_id}"/></w:rPr>'
+                         f'<w:t xml:space="preserve">{i:>{width}}  </w:t></w:r>')
+        for text, color, bold, italic in runs:
+            text = XML_INVALID_RE.sub("", escape(text))
+            rpr = ('<w:b/>' if bold else '') + ('<w:i/>' if italic else '')
+            if color:
+                rpr += '<w:color w:val="%02X%02X%02X"/>' % color
+            parts.append(f'<w:r><w:rPr>{rpr}</w:rPr><w:t xml:space="preserve">{text}</w:t></w:r>'
+                         if rpr else f'<w:r><w:t xml:space="preserve">{text}</w:t></w:r>')
+    parts.append('</w:p>')
+    return "".join(parts)
+
+
+def add_code_block(document, code, theme="friendly", language=None, code_style="table", line_numbers=True):
+    """
+    Render syntax-highlighted code.
+    Args:
+        document: Document to append to
+        code: Source code
+        theme: Syntax highlighting theme
+        language: Language name, or None to guess it
+        code_style: "table" for a 2-column table (line numbers + code) with
+            one row per line, or "compact" for a single shaded paragraph
+            with line breaks and shared styles, which keeps long listings
+            to a fraction of the XML
+        line_numbers: Number the lines of compact code blocks
+    """
+    if code_style not in CODE_STYLES:
+        raise ValueError(f"Unknown code style: {code_style!r}")
+    lines = highlight_lines(code, language=language, theme=theme)
+    if code_style == "compact":
+        if not lines:
+            return
+        para_style_id, number_style_id = code_block_styles(document)
+        xml = compact_code_xml(lines, para_style_id, number_style_id if line_numbers else None)
+        document.element.body._insert_p(parse_xml(xml))
+        return
 
     # Two-column table
     table = document.add_table(rows=0, cols=2)
@@ -152,22 +253,9 @@ def add_code_block(document, code, theme="friendly", language=None):
         para_code.paragraph_format.line_spacing = 1.2
         para_code.paragraph_format.space_after = Pt(0)
 
-        for node in parts:
-            if isinstance(node, str):
-                run = para_code.add_run(node)
-                set_run_font(run, monospace=True, size=9)
-            elif node.name == "span":
-                text = node.get_text()
-                run = para_code.add_run(text)
-                set_run_font(run, monospace=True, size=9)
-                for cls in node.get("class", []):
-                    style = css_styles.get(cls, {})
-                    if "color" in style:
-                        run.font.color.rgb = RGBColor(*style["color"])
-                    if style.get("bold"):
-                        run.bold = True
-                    if style.get("italic"):
-                        run.italic = True
+        for text, color, bold, italic in parts:
+            run = para_code.add_run(text)
+            set_run_font(run, monospace=True, size=9, bold=bold, italic=italic, color=color)
 
     # Grey background
     for row in table.rows:
@@ -204,49 +292,132 @@ def handle_inline(element, para):
             handle_inline(child, para)
 
 
-def process_list(document, element, level=0, folder_name=None):
-    num_id = None
+TABLE_ALIGNMENTS = {"left": 0, "center": 1, "right": 2}  # WD_ALIGN_PARAGRAPH values
+TEXT_ALIGN_RE = re.compile(r"text-align:\s*(left|center|right)")
+
+
+def table_rows(element):
+    """
+    Return the rows of an HTML table as lists of (cell, colspan, alignment,
+    is_header) tuples, with a flag telling whether the row is a header row.
+    Only the table's own rows are returned, not those of nested tables.
+    """
+    trs = []
+    for child in element.find_all(["thead", "tbody", "tfoot", "tr"], recursive=False):
+        trs.extend([child] if child.name == "tr" else child.find_all("tr", recursive=False))
+    rows = []
+    for tr in trs:
+        cells = []
+        for cell in tr.find_all(["td", "th"], recursive=False):
+            try:
+                colspan = max(1, int(cell.get("colspan", 1)))
+            except ValueError:
+                colspan = 1
+            m = TEXT_ALIGN_RE.search(cell.get("style", ""))
+            align = m.group(1) if m else cell.get("align")
+            cells.append((cell, colspan, TABLE_ALIGNMENTS.get(align), cell.name == "th"))
+        is_header = tr.parent.name == "thead" or (bool(cells) and all(c[3] for c in cells))
+        rows.append((cells, is_header))
+    return rows
+
+
+def add_table(document, element):
+    """
+    Build a DOCX table from an HTML table in one pass over its cells.
+    Header rows are bold and repeat on every page, cell content keeps its
+    inline formatting, colspan becomes gridSpan, text-align sets the
+    paragraph alignment and short rows are padded with empty cells.
+    """
+    rows = table_rows(element)
+    n_cols = max((sum(c[1] for c in cells) for cells, _ in rows), default=0)
+    if not n_cols:
+        return None
+    table = document.add_table(rows=0, cols=n_cols)
+    tbl = table._tbl
+    col_widths = [gridCol.w for gridCol in tbl.tblGrid.gridCol_lst]
+    for cells, is_header in rows:
+        tr = tbl.add_tr()
+        if is_header:
+            tr.get_or_add_trPr().append(OxmlElement('w:tblHeader'))
+        col = 0
+        for cell, colspan, align, _ in cells:
+            colspan = min(colspan, n_cols - col)
+            if colspan <= 0:
+                break
+            tc = tr.add_tc()
+            widths = col_widths[col:col + colspan]
+            if None not in widths:
+                tc.width = sum(widths)
+            if colspan > 1:
+                grid_span = OxmlElement('w:gridSpan')
+                grid_span.set(qn('w:val'), str(colspan))
+                tc.get_or_add_tcPr().append(grid_span)
+            para = _Cell(tc, table).paragraphs[0]
+            for child in cell.children:
+                handle_inline(child, para)
+            if is_header:
+                for run in para.runs:
+                    run.bold = True
+            if align is not None:
+                para.alignment = align
+            col += colspan
+        for width in col_widths[col:]:
+            tc = tr.add_tc()
+            if width is not None:
+                tc.width = width
+    return table
+
+
+def process_list(document, element, level=0, folder_name=None, optimize_images=True, counts=None):
+    """Add an ul or ol element as list paragraphs; images are counted in counts, if given."""
+    numbering = ListNumbering.for_document(document)
     if element.name == "ol":
-        document.add_paragraph()  # Insert blank paragraph to force restart
-        num_id = add_numbering_restart(document)
-    for idx, li in enumerate(element.find_all("li", recursive=False), start=1):
-        style = "ListBullet" if element.name == "ul" else None
-        if style:
-            para = document.add_paragraph(style=style)
-        else:
-            para = document.add_paragraph()
-            p = para._p
-            numPr = OxmlElement('w:numPr')
-            ilvl = OxmlElement('w:ilvl')
-            ilvl.set(qn('w:val'), str(level))
-            numPr.append(ilvl)
-            numId = OxmlElement('w:numId')
-            numId.set(qn('w:val'), str(num_id))
-            numPr.append(numId)
-            p.append(numPr)
-
-        if level > 0:
-            para.paragraph_format.left_indent = Cm(0.75 * level)
+        try:
+            start = int(element.get("start", 1))
+        except ValueError:
+            start = 1
+        num_id = numbering.restart(level, start=start)
+    else:
+        num_id = numbering.bullets()
+    ilvl = min(level, LIST_LEVELS - 1)
+    for li in element.find_all("li", recursive=False):
+        para = document.add_paragraph(style="List Paragraph")
+        num_pr = para._p.get_or_add_pPr().get_or_add_numPr()
+        num_pr.get_or_add_ilvl().val = ilvl
+        num_pr.get_or_add_numId().val = num_id
 
         for child in li.children:
             if isinstance(child, str) and child.strip() == "":
                 continue
             if getattr(child, "name", None) in ["ul", "ol"]:
-                process_list(document, child, level + 1, folder_name=folder_name)
+                process_list(document, child, level + 1, folder_name=folder_name, optimize_images=optimize_images,
+                             counts=counts)
             else:
                 if getattr(child, "name", None) == "img":
                     run = para.add_run()
                     img_src = child["src"]
                     if folder_name and not os.path.isabs(img_src):
                         img_src = os.path.join(folder_name, img_src)
-                    run.add_picture(img_src)
+                    width = None
+                    if optimize_images:
+                        # The optimized copy may have fewer pixels; keep the original's printed size
+                        width = DocxImage.from_file(img_src).width
+                        img_src = optimize_image(img_src)
+                    run.add_picture(img_src, width=width)
+                    if counts is not None:
+                        counts["images"] += 1
                     # Center align image
                     para.alignment = 1  # 1 = center
                 else:
                     handle_inline(child, para)
 
 
-def add_markdown_content(document, md_content, theme="friendly", folder_name=None):
+def add_markdown_content(document, md_content, theme="friendly", folder_name=None, optimize_images=True,
+                         code_style="table", line_numbers=True, counts=None):
+    """
+    Render markdown into document. If a counts dict (such as a BuildTrace
+    stage's) is given, the images and code blocks added are counted in it.
+    """
     html = markdown.markdown(md_content, extensions=["fenced_code", "tables"])
     soup = BeautifulSoup(html, "html.parser")
 
@@ -263,20 +434,20 @@ def add_markdown_content(document, md_content, theme="friendly", folder_name=Non
                     img_src = child["src"]
                     if folder_name and not os.path.isabs(img_src):
                         img_src = os.path.join(folder_name, img_src)
+                    if optimize_images:
+                        img_src = optimize_image(img_src, width_cm=10)
                     run.add_picture(img_src, width=Cm(10))
+                    if counts is not None:
+                        counts["images"] += 1
                 else:
                     handle_inline(child, para)
 
         elif element.name in ["ul", "ol"]:
-            process_list(document, element, level=0, folder_name=folder_name)
+            process_list(document, element, level=0, folder_name=folder_name, optimize_images=optimize_images,
+                         counts=counts)
 
         elif element.name == "table":
-            rows = element.find_all("tr")
-            n_cols = len(rows[0].find_all(["td", "th"]))
-            table = document.add_table(rows=len(rows), cols=n_cols)
-            for r, row in enumerate(rows):
-                for c, cell in enumerate(row.find_all(["td", "th"])):
-                    table.cell(r, c).text = cell.get_text(strip=True)
+            add_table(document, element)
         
         elif element.name == "hr":
             para = document.add_paragraph()
@@ -305,7 +476,10 @@ def add_markdown_content(document, md_content, theme="friendly", folder_name=Non
                 if lang in ("py", "python3", "python"):
                     lang = "python"
 
-                add_code_block(document, code_tag.get_text(), theme=theme, language=lang)
+                add_code_block(document, code_tag.get_text(), theme=theme, language=lang,
+                               code_style=code_style, line_numbers=line_numbers)
+                if counts is not None:
+                    counts["code_blocks"] += 1
 
         else:
             if hasattr(element, "children"):
@@ -318,6 +492,90 @@ def add_markdown_content(document, md_content, theme="friendly", folder_name=Non
             process_element(element)
 
 
+@lru_cache(maxsize=1)
+def _template_style_ids():
+    """Return the style ids of the default template, which every worker document starts with."""
+    return frozenset(Document().styles.element.xpath("./w:style/@w:styleId"))
+
+
+def render_chapter(md_content, theme="friendly", folder_name=None, optimize_images=True, code_style="table",
+                   line_numbers=True):
+    """
+    Render one chapter into a blank document, in a worker process, and
+    return what splice_chapter needs to add it to the book: the serialized
+    w:body without its w:sectPr, the blobs of the images it relates to by
+    rId, the lists it numbered (ListNumbering.created), the styles it
+    added to the template and the images and code blocks it counted.
+    """
+    document = Document()
+    counts = {"images": 0, "code_blocks": 0}
+    add_markdown_content(document, md_content, theme=theme, folder_name=folder_name,
+                         optimize_images=optimize_images, code_style=code_style, line_numbers=line_numbers,
+                         counts=counts)
+    body = document.element.body
+    body.remove(body.sectPr)
+    numbering = _list_numberings.get(document.part)
+    template_styles = _template_style_ids()
+    return {
+        "body": etree.tostring(body),
+        "images": {r_id: rel.target_part.blob for r_id, rel in document.part.rels.items()
+                   if rel.reltype == RT.IMAGE},
+        "lists": numbering.created if numbering else [],
+        "styles": [etree.tostring(style) for style in document.styles.element.findall(qn("w:style"))
+                   if style.get(qn("w:styleId")) not in template_styles],
+        "counts": counts,
+    }
+
+
+def splice_chapter(document, chapter):
+    """
+    Append a chapter returned by render_chapter to document, as if it had
+    been rendered there: its lists are numbered again in order, its images
+    are added (or reused) and related in order, its drawings are numbered
+    on from the ones already spliced, and the styles it added are copied
+    over. Drawings must only be added to document through splice_chapter.
+    """
+    body = parse_xml(chapter["body"])
+    numbering = ListNumbering.for_document(document)
+    num_ids = {}
+    for num_id, kind, level, start in chapter["lists"]:
+        num_ids[str(num_id)] = str(numbering.bullets() if kind == "bullet" else numbering.restart(level, start))
+    r_ids = {}
+    next_drawing_id = _next_drawing_ids.get(document.part)
+    for element in body.iter(qn("w:numId"), qn("a:blip"), qn("wp:docPr")):
+        if element.tag == qn("w:numId"):
+            element.set(qn("w:val"), num_ids.get(element.get(qn("w:val")), element.get(qn("w:val"))))
+        elif element.tag == qn("a:blip"):
+            r_id = element.get(qn("r:embed"))
+            if r_id not in r_ids:
+                r_ids[r_id] = document.part.get_or_add_image(BytesIO(chapter["images"][r_id]))[0]
+            element.set(qn("r:embed"), r_ids[r_id])
+        else:
+            # What python-docx's next_id gives, without searching the whole document each time
+            if next_drawing_id is None:
+                next_drawing_id = document.part.next_id
+            element.set("id", str(next_drawing_id))
+            element.set("name", f"Picture {next_drawing_id}")
+            next_drawing_id += 1
+    if next_drawing_id is not None:
+        _next_drawing_ids[document.part] = next_drawing_id
+
+    styles = document.styles.element
+    style_ids = set(styles.xpath("./w:style/@w:styleId"))
+    for xml in chapter["styles"]:
+        style = parse_xml(xml)
+        if style.get(qn("w:styleId")) not in style_ids:
+            styles.append(style)
+
+    target = document.element.body
+    sect_pr = target.sectPr
+    for child in list(body):
+        if sect_pr is not None:
+            sect_pr.addprevious(child)
+        else:
+            target.append(child)
+
+
 def read_chapters_file(chapters_file, folder_name=None):
     """
     Read chapters.txt file and return list of items to process.
@@ -357,7 +615,9 @@ def add_part_page(document, part_name):
 
 
 def convert_markdowns_to_docx(md_files=None, output_file="combined.docx", theme="friendly", 
-                              chapters_file="chapters.txt", folder_name=None):
+                              chapters_file="chapters.txt", folder_name=None, optimize_images=True,
+                              profile=None, on_stage=None, code_style="table", line_numbers=True,
+                              backend="python-docx", optimize_output=False, compress_level=6, jobs=1):
     """
     Convert markdown files to DOCX.
     
@@ -367,40 +627,157 @@ def convert_markdowns_to_docx(md_files=None, output_file="combined.docx", theme=
         theme: Syntax highlighting theme
         chapters_file: Path to chapters.txt file (takes precedence over md_files)
         folder_name: Optional folder where markdown files are located
+        optimize_images: Embed downsampled, recompressed and deduplicated
+            copies of images instead of the originals
+        profile: Optional path ("-" for stdout) to write a JSON trace of the
+            read_chapters, render and save stages to
+        on_stage: Optional callback called with each stage record as it ends
+        code_style: "table" or "compact" rendering of code blocks, see add_code_block
+        line_numbers: Number the lines of compact code blocks
+        backend: "python-docx" to build the whole document in memory and save
+            it at the end, or "stream" to stream each chapter into the output
+            file as soon as it is rendered, which keeps memory flat for very
+            large books
+        optimize_output: Run docx_optimize on the finished DOCX: store
+            identical media once, drop unused styles and orphaned parts, and
+            repack it at compress_level
+        compress_level: Deflate level of the optimized DOCX, 0 (store) to 9
+        jobs: Number of worker processes to render chapters in; the output
+            is the same as with 1, which renders them in this process
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend!r}")
+    if jobs < 1:
+        raise ValueError(f"jobs must be at least 1, got {jobs}")
+    if not (chapters_file and os.path.exists(chapters_file)) and not md_files:
+        raise ValueError("Either chapters_file must exist or md_files must be provided")
+    trace = BuildTrace("convert_old", on_stage=on_stage)
+    writer = StreamingDocxWriter(output_file) if backend == "stream" else None
+    try:
+        document = writer.document if writer else Document()
+        build_document(document, md_files, chapters_file, folder_name, theme, optimize_images, code_style,
+                       line_numbers, trace, flush=writer.flush if writer else None, jobs=jobs)
+        with trace.stage("save") as counts:
+            if writer:
+                writer.close()
+            else:
+                document.save(output_file)
+            counts["bytes_written"] += os.path.getsize(output_file)
+    except BaseException:
+        if writer:
+            writer.abort()
+        raise
+    if optimize_output and trace.error is None:
+        with trace.stage("optimize_docx") as counts:
+            report = optimize_docx(output_file, compress_level=compress_level)
+            counts["bytes_read"] += report["bytes_before"]
+            counts["bytes_written"] += report["bytes_after"]
+        print(format_report(report, output_file))
+    if profile:
+        trace.write(profile)
+
+
+def build_document(document, md_files, chapters_file, folder_name, theme, optimize_images, code_style,
+                   line_numbers, trace, flush=None, jobs=1):
+    """
+    Render the chapters into document, calling flush after each part page
+    and chapter. With jobs > 1 the chapters are rendered by that many worker
+    processes and spliced into document in order, see render_chapter.
     """
-    document = Document()
-    
     # If chapters_file exists, use it; otherwise fall back to md_files
     if chapters_file and os.path.exists(chapters_file):
         items = read_chapters_file(chapters_file, folder_name)
+        for item in items:
+            if item["type"] == "markdown" and not item["path"].endswith(".md"):
+                item["path"] += ".md"
+        report = True
+    elif md_files:
+        items = [{"type": "markdown", "path": os.path.join(folder_name, md_file)
+                  if folder_name and not os.path.isabs(md_file) else md_file} for md_file in md_files]
+        report = False
+    else:
+        return
+    options = dict(theme=theme, folder_name=folder_name, optimize_images=optimize_images, code_style=code_style,
+                   line_numbers=line_numbers)
+    paths = [item["path"] for item in items if item["type"] == "markdown"]
+    pool = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 and len(paths) > 1 else None
+    try:
+        chapters = _rendered_chapters(paths, pool, 2 * jobs, trace, options) if pool else None
         for i, item in enumerate(items):
             if item["type"] == "part":
                 add_part_page(document, item["name"])
             elif item["type"] == "markdown":
                 if i > 0:
                     document.add_section(1)  # WD_SECTION.NEW_PAGE
-                if not item["path"].endswith(".md"):
-                    item["path"] += ".md"
-                with open(item["path"], "r", encoding="utf-8") as f:
-                    md_content = f.read()
-                add_markdown_content(document, md_content, theme=theme, folder_name=folder_name)
-            print(f"Processed: {item}")
-    elif md_files:
-        for i, md_file in enumerate(md_files):
-            if i > 0:
-                document.add_section(1)  # WD_SECTION.NEW_PAGE
-            full_path = md_file
-            if folder_name and not os.path.isabs(md_file):
-                full_path = os.path.join(folder_name, md_file)
-            with open(full_path, "r", encoding="utf-8") as f:
-                md_content = f.read()
-            add_markdown_content(document, md_content, theme=theme, folder_name=folder_name)
-    else:
-        raise ValueError("Either chapters_file must exist or md_files must be provided")
-    document.save(output_file)
+                if chapters is not None:
+                    chapter = next(chapters)
+                    with trace.stage("splice"):
+                        splice_chapter(document, chapter)
+                else:
+                    md_content = _read_chapter(item["path"], trace)
+                    with trace.stage("render") as counts:
+                        add_markdown_content(document, md_content, counts=counts, **options)
+            if flush:
+                with trace.stage("save"):
+                    flush()
+            if report:
+                print(f"Processed: {item}")
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
+
+
+def _read_chapter(path, trace):
+    with trace.stage("read_chapters") as counts:
+        with open(path, "r", encoding="utf-8") as f:
+            md_content = f.read()
+        counts["chapters"] += 1
+        counts["bytes_read"] += os.path.getsize(path)
+    return md_content
+
+
+def _rendered_chapters(paths, pool, window, trace, options):
+    """Yield render_chapter's result for each path in order, keeping up to window chapters in the pool."""
+    pending = deque()
+    paths = iter(paths)
+    while True:
+        while len(pending) < window:
+            path = next(paths, None)
+            if path is None:
+                break
+            pending.append(pool.submit(render_chapter, _read_chapter(path, trace), **options))
+        if not pending:
+            return
+        # Time spent waiting for the workers
+        with trace.stage("render") as counts:
+            chapter = pending.popleft().result()
+            for counter, value in chapter["counts"].items():
+                counts[counter] += value
+        yield chapter
 
 
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert the book's markdown chapters to DOCX with python-docx.")
+    parser.add_argument("--profile", metavar="TRACE.json", help="write a JSON trace of the build stages ('-' for stdout)")
+    parser.add_argument("--code-style", choices=CODE_STYLES, default="table",
+                        help="render code blocks as a table row per line or as one compact shaded paragraph")
+    parser.add_argument("--no-line-numbers", dest="line_numbers", action="store_false",
+                        help="leave out line numbers in compact code blocks")
+    parser.add_argument("--backend", choices=BACKENDS, default="python-docx",
+                        help="build the document in memory, or stream each chapter into the output file")
+    parser.add_argument("--optimize-output", action="store_true",
+                        help="dedupe media, drop unused styles and parts, and repack the finished DOCX")
+    parser.add_argument("--compress-level", type=int, default=6,
+                        help="deflate level of the optimized DOCX, 0 (fastest) to 9 (smallest)")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="render chapters in this many worker processes")
+    args = parser.parse_args()
+
     output_docx = "book.docx"
-    convert_markdowns_to_docx(output_file=output_docx, theme="friendly", chapters_file="chapters.txt", folder_name="Test-First Copilot")
+    convert_markdowns_to_docx(output_file=output_docx, theme="friendly", chapters_file="chapters.txt", folder_name="Test-First Copilot",
+                              profile=args.profile, code_style=args.code_style, line_numbers=args.line_numbers,
+                              backend=args.backend, optimize_output=args.optimize_output,
+                              compress_level=args.compress_level, jobs=args.jobs)
     print(f"Saved {output_docx}")
\ No newline at end of file
@@ -0,0 +1,289 @@
+import copy
+import re
+from io import BytesIO
+
+from docx import Document
+from docx.opc.constants import CONTENT_TYPE as CT
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.opc.packuri import PackURI
+from docx.opc.part import Part
+from docx.oxml import parse_xml
+from docx.oxml.ns import qn
+from lxml import etree
+
+R_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+WP_DOCPR = "{http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing}docPr"
+EMPTY_FOOTNOTES = (
+    '<w:footnotes xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"/>'
+)
+
+
+def merge_docx(paths, output_file):
+    """
+    Merge DOCX files into one document, in order.
+    The first file is the base: its styles, headers, footers and final section
+    properties are kept. The bodies of the remaining files are appended after
+    it with their images, hyperlinks, footnotes, list numbering, bookmarks and
+    any styles missing from the base carried over.
+    Args:
+        paths: DOCX files to merge, in reading order
+        output_file: Output DOCX file path
+    """
+    if not paths:
+        raise ValueError("merge_docx needs at least one input document")
+    merger = DocxMerger(Document(paths[0]))
+    for path in paths[1:]:
+        merger.append(Document(path))
+    merger.save(output_file)
+
+
+class DocxMerger:
+    """Append the body of other python-docx Documents to a base Document."""
+
+    def __init__(self, document):
+        self.document = document
+        self.body = document.element.body
+        self._footnotes_part = _related_part(document.part, RT.FOOTNOTES)
+        self._footnotes = parse_xml(self._footnotes_part.blob) if self._footnotes_part is not None else None
+        self._numbering = _numbering_element(document)
+
+        self._bookmark_names = set()
+        self._next_bookmark_id = 0
+        self._next_docpr_id = 1
+        self._scan_ids(self.body)
+        if self._footnotes is not None:
+            self._scan_ids(self._footnotes)
+
+        self._abstract_by_key = {}
+        self._next_abstract_id = 0
+        self._next_num_id = 1
+        if self._numbering is not None:
+            for abstract in self._numbering.findall(qn("w:abstractNum")):
+                abstract_id = int(abstract.get(qn("w:abstractNumId")))
+                self._abstract_by_key.setdefault(_abstract_key(abstract), abstract_id)
+                self._next_abstract_id = max(self._next_abstract_id, abstract_id + 1)
+            for num in self._numbering.findall(qn("w:num")):
+                self._next_num_id = max(self._next_num_id, int(num.get(qn("w:numId"))) + 1)
+
+        self._style_ids = {
+            s.get(qn("w:styleId")) for s in document.styles.element.findall(qn("w:style"))
+        }
+
+    def _scan_ids(self, root):
+        for el in root.iter(qn("w:bookmarkStart")):
+            self._bookmark_names.add(el.get(qn("w:name")))
+            self._next_bookmark_id = max(self._next_bookmark_id, int(el.get(qn("w:id"))) + 1)
+        for el in root.iter(WP_DOCPR):
+            self._next_docpr_id = max(self._next_docpr_id, int(el.get("id")) + 1)
+
+    def append(self, other):
+        """Append the body of the python-docx Document `other` before the base's final section."""
+        rel_map = {}
+        elements = [copy.deepcopy(el) for el in other.element.body if el.tag != qn("w:sectPr")]
+
+        footnote_map = {}
+        notes = []
+        src_notes_part = _related_part(other.part, RT.FOOTNOTES)
+        if src_notes_part is not None:
+            for note in parse_xml(src_notes_part.blob).findall(qn("w:footnote")):
+                if note.get(qn("w:type")) in ("separator", "continuationSeparator", "continuationNotice"):
+                    continue
+                notes.append(note)
+
+        new_styles = self._merge_styles(other)
+        used_num_ids = {
+            el.get(qn("w:val")) for root in elements + notes + new_styles for el in root.iter(qn("w:numId"))
+        }
+        num_map = self._merge_numbering(other, used_num_ids)
+        for style in new_styles:
+            self._remap_num_ids(style, num_map)
+
+        bookmark_ids, bookmark_names = {}, {}
+        for root in elements + notes:
+            self._renumber_bookmarks(root, bookmark_ids, bookmark_names)
+        for root in elements + notes:
+            self._rename_anchors(root, bookmark_names)
+            for el in root.iter(WP_DOCPR):
+                el.set("id", str(self._next_docpr_id))
+                self._next_docpr_id += 1
+
+        if notes:
+            dst_notes_part = self._ensure_footnotes_part()
+            next_id = max([int(n.get(qn("w:id"))) for n in self._footnotes.findall(qn("w:footnote"))] + [0]) + 1
+            for note in notes:
+                footnote_map[note.get(qn("w:id"))] = str(next_id)
+                note.set(qn("w:id"), str(next_id))
+                next_id += 1
+                self._remap_rels(note, src_notes_part, dst_notes_part, rel_map)
+                self._remap_num_ids(note, num_map)
+                self._footnotes.append(note)
+
+        sect_pr = self.body.sectPr
+        for el in elements:
+            self._remap_rels(el, other.part, self.document.part, rel_map)
+            for ref in el.iter(qn("w:footnoteReference")):
+                new_id = footnote_map.get(ref.get(qn("w:id")))
+                if new_id is not None:
+                    ref.set(qn("w:id"), new_id)
+            self._remap_num_ids(el, num_map)
+            if sect_pr is not None:
+                sect_pr.addprevious(el)
+            else:
+                self.body.append(el)
+
+    def save(self, output_file):
+        if self._footnotes is not None:
+            self._footnotes_part._blob = etree.tostring(
+                self._footnotes, xml_declaration=True, encoding="UTF-8", standalone=True
+            )
+        self.document.save(output_file)
+
+    def _ensure_footnotes_part(self):
+        if self._footnotes_part is None:
+            package = self.document.part.package
+            self._footnotes_part = Part(
+                PackURI("/word/footnotes.xml"), CT.WML_FOOTNOTES, EMPTY_FOOTNOTES.encode("utf-8"), package
+            )
+            self.document.part.relate_to(self._footnotes_part, RT.FOOTNOTES)
+            self._footnotes = parse_xml(self._footnotes_part.blob)
+        return self._footnotes_part
+
+    def _renumber_bookmarks(self, root, id_map, bookmark_names):
+        for el in root.iter(qn("w:bookmarkStart"), qn("w:bookmarkEnd")):
+            old_id = el.get(qn("w:id"))
+            if old_id not in id_map:
+                id_map[old_id] = str(self._next_bookmark_id)
+                self._next_bookmark_id += 1
+            el.set(qn("w:id"), id_map[old_id])
+            name = el.get(qn("w:name"))
+            if name is None:
+                continue
+            if name not in bookmark_names:
+                new_name, n = name, 0
+                while new_name in self._bookmark_names:
+                    n += 1
+                    new_name = f"{name}-{n}"
+                bookmark_names[name] = new_name
+                self._bookmark_names.add(new_name)
+            el.set(qn("w:name"), bookmark_names[name])
+
+    def _rename_anchors(self, root, bookmark_names):
+        for el in root.iter(qn("w:hyperlink")):
+            anchor = el.get(qn("w:anchor"))
+            if anchor in bookmark_names:
+                el.set(qn("w:anchor"), bookmark_names[anchor])
+
+    def _remap_rels(self, root, src_part, dst_part, rel_map):
+        for el in root.iter():
+            for attr, r_id in el.attrib.items():
+                if not attr.startswith(R_NS):
+                    continue
+                key = (id(src_part), r_id)
+                if key not in rel_map:
+                    rel_map[key] = self._copy_rel(src_part, dst_part, r_id)
+                if rel_map[key] is not None:
+                    el.set(attr, rel_map[key])
+
+    def _copy_rel(self, src_part, dst_part, r_id):
+        rel = src_part.rels.get(r_id)
+        if rel is None:
+            return None
+        if rel.is_external:
+            return dst_part.relate_to(rel.target_ref, rel.reltype, is_external=True)
+        target = rel.target_part
+        if rel.reltype == RT.IMAGE:
+            image_part = dst_part.package.get_or_add_image_part(BytesIO(target.blob))
+            return dst_part.relate_to(image_part, rel.reltype)
+        # Any other embedded part (charts, OLE objects...) moves over with a
+        # partname that cannot clash with the base package's own parts.
+        template = re.sub(r"\d+(\.\w+)$", r"%d\1", target.partname)
+        if "%d" not in template:
+            template = re.sub(r"(\.\w+)$", r"%d\1", target.partname)
+        target.partname = dst_part.package.next_partname(template)
+        return dst_part.relate_to(target, rel.reltype)
+
+    def _remap_num_ids(self, root, num_map):
+        for el in root.iter(qn("w:numId")):
+            new_id = num_map.get(el.get(qn("w:val")))
+            if new_id is not None:
+                el.set(qn("w:val"), new_id)
+
+    def _merge_numbering(self, other, used_num_ids):
+        """Copy the list definitions behind used_num_ids into the base and return the numId map."""
+        num_map = {}
+        src = _numbering_element(other)
+        if src is None or not used_num_ids:
+            return num_map
+        if self._numbering is None:
+            print("Warning: base document has no numbering part; list numbering is not merged")
+            return num_map
+
+        nums = [num for num in src.findall(qn("w:num")) if num.get(qn("w:numId")) in used_num_ids]
+        used_abstract_ids = {
+            ref.get(qn("w:val")) for num in nums for ref in num.findall(qn("w:abstractNumId"))
+        }
+        abstract_map = {}
+        for abstract in src.findall(qn("w:abstractNum")):
+            old_id = abstract.get(qn("w:abstractNumId"))
+            if old_id not in used_abstract_ids:
+                continue
+            key = _abstract_key(abstract)
+            if key not in self._abstract_by_key:
+                new_abstract = copy.deepcopy(abstract)
+                new_abstract.set(qn("w:abstractNumId"), str(self._next_abstract_id))
+                for nsid in new_abstract.findall(qn("w:nsid")):
+                    new_abstract.remove(nsid)
+                first_num = self._numbering.find(qn("w:num"))
+                if first_num is not None:
+                    first_num.addprevious(new_abstract)
+                else:
+                    self._numbering.append(new_abstract)
+                self._abstract_by_key[key] = self._next_abstract_id
+                self._next_abstract_id += 1
+            abstract_map[old_id] = str(self._abstract_by_key[key])
+
+        for num in nums:
+            new_num = copy.deepcopy(num)
+            new_num.set(qn("w:numId"), str(self._next_num_id))
+            abstract_ref = new_num.find(qn("w:abstractNumId"))
+            if abstract_ref is not None and abstract_ref.get(qn("w:val")) in abstract_map:
+                abstract_ref.set(qn("w:val"), abstract_map[abstract_ref.get(qn("w:val"))])
+            self._numbering.append(new_num)
+            num_map[num.get(qn("w:numId"))] = str(self._next_num_id)
+            self._next_num_id += 1
+        return num_map
+
+    def _merge_styles(self, other):
+        """Copy styles the base does not define yet and return the copies."""
+        styles = self.document.styles.element
+        added = []
+        for style in other.styles.element.findall(qn("w:style")):
+            style_id = style.get(qn("w:styleId"))
+            if style_id not in self._style_ids:
+                added.append(copy.deepcopy(style))
+                styles.append(added[-1])
+                self._style_ids.add(style_id)
+        return added
+
+
+def _related_part(part, reltype):
+    for rel in part.rels.values():
+        if rel.reltype == reltype and not rel.is_external:
+            return rel.target_part
+    return None
+
+
+def _numbering_element(document):
+    part = _related_part(document.part, RT.NUMBERING)
+    return part.element if part is not None else None
+
+
+def _abstract_key(abstract):
+    """Identity of a list definition, ignoring its id and random nsid."""
+    key = copy.deepcopy(abstract)
+    key.attrib.pop(qn("w:abstractNumId"), None)
+    for tag in ("w:nsid", "w:tmpl"):
+        for el in key.findall(qn(tag)):
+            key.remove(el)
+    return etree.tostring(key, method="c14n")
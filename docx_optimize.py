@@ -0,0 +1,244 @@
+"""
+Shrink a finished DOCX.
+
+    python docx_optimize.py book.docx --compress-level 9
+
+Identical media parts are stored once, styles nothing refers to and parts
+no relationship reaches are dropped, and the package is repacked at the
+given compression level.
+"""
+import argparse
+import hashlib
+import os
+import posixpath
+import sys
+import tempfile
+import time
+import zipfile
+from urllib.parse import quote, unquote
+
+from lxml import etree
+
+CONTENT_TYPES = "[Content_Types].xml"
+PACKAGE_RELS = "_rels/.rels"
+STYLES_PART = "word/styles.xml"
+MEDIA_PREFIX = "word/media/"
+
+CT_NS = "http://schemas.openxmlformats.org/package/2006/content-types"
+RELS_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+
+
+def _w(tag):
+    return f"{{{W_NS}}}{tag}"
+
+
+# Elements whose w:val names a style, wherever they appear
+STYLE_REFERENCES = tuple(_w(tag) for tag in ("pStyle", "rStyle", "tblStyle", "numStyleLink", "styleLink"))
+# Elements inside a style that name another style it needs
+STYLE_LINKS = tuple(_w(tag) for tag in ("basedOn", "link", "next"))
+
+
+def _rels_source(rels_name):
+    """Return the part a .rels part belongs to, or "" for the package relationships."""
+    if rels_name == PACKAGE_RELS:
+        return ""
+    directory, _, name = ("/" + rels_name).rpartition("/_rels/")
+    return posixpath.join(directory.lstrip("/"), name[:-len(".rels")])
+
+
+def _rels_name(part_name):
+    directory, _, name = part_name.rpartition("/")
+    return posixpath.join(directory, "_rels", name + ".rels") if directory else f"_rels/{name}.rels"
+
+
+def _resolve(source, target):
+    """Return the part name a relationship target of source points at."""
+    target = unquote(target)
+    if target.startswith("/"):
+        return target[1:]
+    return posixpath.normpath(posixpath.join(posixpath.dirname(source), target))
+
+
+def _relative_target(source, part_name):
+    return quote(posixpath.relpath(part_name, posixpath.dirname(source) or "."), safe="/")
+
+
+def _serialize(root):
+    return etree.tostring(root, xml_declaration=True, encoding="UTF-8", standalone=True)
+
+
+class _Package:
+    """The parts of a DOCX zip, with their relationship trees parsed."""
+
+    def __init__(self, path):
+        with zipfile.ZipFile(path) as archive:
+            self.names = archive.namelist()
+            self.parts = {name: archive.read(name) for name in self.names}
+        self.rels = {name: etree.fromstring(self.parts[name]) for name in self.names if name.endswith(".rels")}
+
+    def relationships(self, rels_name):
+        """Yield (element, target part name) for the internal relationships in a .rels part."""
+        source = _rels_source(rels_name)
+        for rel in self.rels[rels_name].iter(f"{{{RELS_NS}}}Relationship"):
+            if rel.get("TargetMode") != "External":
+                yield rel, _resolve(source, rel.get("Target"))
+
+    def remove(self, name):
+        self.parts.pop(name, None)
+        self.rels.pop(name, None)
+        rels_name = _rels_name(name)
+        self.parts.pop(rels_name, None)
+        self.rels.pop(rels_name, None)
+
+
+def dedupe_media(package):
+    """Point every relationship at one copy of each distinct media file; return the number of copies dropped."""
+    canonical = {}
+    duplicates = {}
+    for name in sorted(package.parts):
+        if name.startswith(MEDIA_PREFIX):
+            digest = hashlib.sha256(package.parts[name]).digest()
+            first = canonical.setdefault(digest, name)
+            if first != name:
+                duplicates[name] = first
+    if not duplicates:
+        return 0
+    for rels_name in package.rels:
+        source = _rels_source(rels_name)
+        for rel, target in package.relationships(rels_name):
+            if target in duplicates:
+                rel.set("Target", _relative_target(source, duplicates[target]))
+    for name in duplicates:
+        package.remove(name)
+    return len(duplicates)
+
+
+def drop_unreachable_parts(package):
+    """Drop parts no relationship chain from the package root reaches; return how many were dropped."""
+    reachable = set()
+    pending = [PACKAGE_RELS]
+    while pending:
+        rels_name = pending.pop()
+        if rels_name not in package.rels:
+            continue
+        for _, target in package.relationships(rels_name):
+            if target not in reachable and target in package.parts:
+                reachable.add(target)
+                pending.append(_rels_name(target))
+    orphans = [name for name in package.parts
+               if name != CONTENT_TYPES and not name.endswith(".rels") and name not in reachable]
+    for name in orphans:
+        package.remove(name)
+    # .rels parts whose source part is gone
+    for rels_name in [name for name in package.rels if name != PACKAGE_RELS]:
+        if _rels_source(rels_name) not in package.parts:
+            package.remove(rels_name)
+    return len(orphans)
+
+
+def prune_styles(package):
+    """Drop styles that no part uses, directly or through another used style; return how many were dropped."""
+    if STYLES_PART not in package.parts:
+        return 0
+    styles_root = etree.fromstring(package.parts[STYLES_PART])
+    styles = {style.get(_w("styleId")): style for style in styles_root.iter(_w("style"))}
+    used = {style_id for style_id, style in styles.items() if style.get(_w("default")) in ("1", "true", "on")}
+    for name, data in package.parts.items():
+        if name.startswith("word/") and name.endswith(".xml") and name != STYLES_PART and b"tyle" in data:
+            for element in etree.fromstring(data).iter(*STYLE_REFERENCES):
+                used.add(element.get(_w("val")))
+    pending = list(used)
+    while pending:
+        style = styles.get(pending.pop())
+        if style is None:
+            continue
+        for element in style.iter(*STYLE_LINKS):
+            style_id = element.get(_w("val"))
+            if style_id not in used:
+                used.add(style_id)
+                pending.append(style_id)
+    unused = [style for style_id, style in styles.items() if style_id not in used]
+    for style in unused:
+        style.getparent().remove(style)
+    if unused:
+        package.parts[STYLES_PART] = _serialize(styles_root)
+    return len(unused)
+
+
+def _update_content_types(package):
+    root = etree.fromstring(package.parts[CONTENT_TYPES])
+    for override in list(root.iter(f"{{{CT_NS}}}Override")):
+        if override.get("PartName").lstrip("/") not in package.parts:
+            root.remove(override)
+    package.parts[CONTENT_TYPES] = _serialize(root)
+
+
+def optimize_docx(path, output=None, compress_level=6, styles=True):
+    """
+    Optimize the DOCX at path and write it to output (default: in place).
+    The output is written to a temp file and moved into place, so a failed
+    run leaves the original untouched.
+    Args:
+        path: DOCX to optimize
+        output: Optional path to write the optimized DOCX to
+        compress_level: Deflate level from 0 (store, fastest) to 9 (smallest)
+        styles: Also drop styles that nothing uses
+    Returns a report dict: bytes_before, bytes_after, bytes_saved,
+    media_deduped, parts_dropped, styles_dropped and seconds.
+    """
+    if not 0 <= compress_level <= 9:
+        raise ValueError(f"compress_level must be between 0 and 9, not {compress_level}")
+    started = time.perf_counter()
+    output = output or path
+    bytes_before = os.path.getsize(path)
+    package = _Package(path)
+    report = {"media_deduped": dedupe_media(package)}
+    report["styles_dropped"] = prune_styles(package) if styles else 0
+    report["parts_dropped"] = drop_unreachable_parts(package)
+    for rels_name, root in package.rels.items():
+        package.parts[rels_name] = _serialize(root)
+    _update_content_types(package)
+
+    fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output)), suffix=".docx.tmp")
+    os.close(fd)
+    try:
+        compression = zipfile.ZIP_DEFLATED if compress_level else zipfile.ZIP_STORED
+        with zipfile.ZipFile(temp_file, "w", compression, compresslevel=compress_level or None) as archive:
+            # Content types first, then the parts in their original order
+            for name in [CONTENT_TYPES] + [name for name in package.names if name != CONTENT_TYPES]:
+                if name in package.parts:
+                    archive.writestr(name, package.parts[name])
+        os.replace(temp_file, output)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+    bytes_after = os.path.getsize(output)
+    report.update({"bytes_before": bytes_before, "bytes_after": bytes_after,
+                   "bytes_saved": bytes_before - bytes_after, "seconds": time.perf_counter() - started})
+    return report
+
+
+def format_report(report, name="DOCX"):
+    saved = report["bytes_saved"]
+    percent = 100 * saved / report["bytes_before"] if report["bytes_before"] else 0
+    return (f"Optimized {name}: {report['bytes_before']} -> {report['bytes_after']} bytes "
+            f"({saved} saved, {percent:.1f}%) in {report['seconds']:.2f}s; "
+            f"{report['media_deduped']} duplicate media, {report['styles_dropped']} unused styles, "
+            f"{report['parts_dropped']} orphaned parts dropped")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("docx", help="DOCX to optimize")
+    parser.add_argument("-o", "--output", help="write the optimized DOCX here instead of in place")
+    parser.add_argument("--compress-level", type=int, default=6, help="0 (store, fastest) to 9 (smallest)")
+    parser.add_argument("--keep-styles", dest="styles", action="store_false", help="keep unused styles")
+    args = parser.parse_args()
+    report = optimize_docx(args.docx, args.output, compress_level=args.compress_level, styles=args.styles)
+    print(format_report(report, args.output or args.docx))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
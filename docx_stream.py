@@ -0,0 +1,115 @@
+import os
+import tempfile
+import zipfile
+
+from docx import Document
+from docx.opc.pkgwriter import _ContentTypesItem
+from docx.oxml.ns import qn
+from lxml import etree
+
+XML_DECLARATION = b"<?xml version='1.0' encoding='UTF-8' standalone='yes'?>\n"
+
+
+class StreamingDocxWriter:
+    """
+    Write a DOCX whose word/document.xml is streamed into the output zip.
+    Content is added to `document`, a regular python-docx Document, with the
+    usual API, so the same element handlers work with either backend. Each
+    call to flush() serializes the body content added since the last flush
+    to the zip and removes it from the tree, so only the current chapter is
+    ever held in memory. Styles, numbering, media and other parts stay on the
+    document and are written when the writer is closed.
+    The output is written to a temp file next to output_file and moved into
+    place by close(), so a failed build never leaves a half-written file.
+    Args:
+        output_file: Path of the DOCX to write
+        template: Optional DOCX whose styles, numbering and section settings to use
+    """
+
+    def __init__(self, output_file, template=None):
+        self.output_file = output_file
+        self.document = Document(template)
+        self._body = self.document.element.body
+        fd, self._temp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output_file)),
+                                               suffix=".docx.tmp")
+        os.close(fd)
+        self._zip = zipfile.ZipFile(self._temp_file, "w", zipfile.ZIP_DEFLATED)
+        self._stream = self._zip.open("word/document.xml", "w", force_zip64=True)
+        root = self.document.element
+        self._namespace_decls = [
+            f' xmlns:{prefix}="{uri}"'.encode("utf-8") if prefix else f' xmlns="{uri}"'.encode("utf-8")
+            for prefix, uri in root.nsmap.items()
+        ]
+        open_tag = etree.tostring(etree.Element(root.tag, attrib=dict(root.attrib), nsmap=root.nsmap))
+        self._stream.write(XML_DECLARATION + open_tag[:-2] + b"><w:body>")
+        self._next_drawing_id = 0
+        self.bytes_written = 0
+
+    def _serialize(self, element):
+        data = etree.tostring(element, encoding="UTF-8", xml_declaration=False)
+        # Drop the namespace declarations already made on the root element
+        head_end = data.index(b">")
+        head = data[:head_end]
+        for decl in self._namespace_decls:
+            head = head.replace(decl, b"", 1)
+        return head + data[head_end:]
+
+    def flush(self):
+        """Stream the body content added since the last flush and drop it from memory."""
+        sect_pr_tag = qn("w:sectPr")
+        chunks = []
+        for child in list(self._body):
+            if child.tag == sect_pr_tag:
+                continue
+            # python-docx numbers drawings from what is still in the tree, so
+            # give them ids that are unique across the whole document
+            for doc_pr in child.iter(qn("wp:docPr")):
+                self._next_drawing_id += 1
+                doc_pr.set("id", str(self._next_drawing_id))
+                if doc_pr.get("name", "").startswith("Picture "):
+                    doc_pr.set("name", f"Picture {self._next_drawing_id}")
+            chunks.append(self._serialize(child))
+            self._body.remove(child)
+        data = b"".join(chunks)
+        self._stream.write(data)
+        self.bytes_written += len(data)
+
+    def close(self):
+        """Finish document.xml, write the remaining parts and move the DOCX into place."""
+        try:
+            self.flush()
+            sect_pr = self._body.find(qn("w:sectPr"))
+            tail = (self._serialize(sect_pr) if sect_pr is not None else b"") + b"</w:body></w:document>"
+            self._stream.write(tail)
+            self._stream.close()
+
+            document_part = self.document.part
+            package = document_part.package
+            parts = list(package.iter_parts())
+            for part in parts:
+                part.before_marshal()
+            self._zip.writestr("[Content_Types].xml", _ContentTypesItem.from_parts(parts).blob)
+            self._zip.writestr("_rels/.rels", package.rels.xml)
+            for part in parts:
+                if part is not document_part:
+                    self._zip.writestr(part.partname.membername, part.blob)
+                if len(part.rels):
+                    self._zip.writestr(part.partname.rels_uri.membername, part.rels.xml)
+            self._zip.close()
+            os.replace(self._temp_file, self.output_file)
+        except BaseException:
+            self.abort()
+            raise
+
+    def abort(self):
+        """Discard the partly written output."""
+        try:
+            self._stream.close()
+        except Exception:
+            pass
+        try:
+            self._zip.close()
+        except Exception:
+            pass
+        if os.path.exists(self._temp_file):
+            os.remove(self._temp_file)
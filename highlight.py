@@ -0,0 +1,116 @@
+import functools
+import hashlib
+import threading
+from collections import OrderedDict
+
+from pygments.lexers import get_lexer_by_name, guess_lexer
+from pygments.styles import get_style_by_name
+from pygments.util import ClassNotFound
+
+# Number of highlighted snippets kept in memory
+CACHE_SIZE = 4096
+
+PLAIN = (None, False, False)
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def lexer_for(language):
+    """Return the lexer for a language name or alias, or the plain text lexer if it is unknown."""
+    try:
+        return get_lexer_by_name(language)
+    except ClassNotFound:
+        return get_lexer_by_name("text")
+
+
+@functools.lru_cache(maxsize=None)
+def theme_styles(theme):
+    """
+    Return {token type: (color, bold, italic)} for a Pygments style, where
+    color is an (r, g, b) tuple or None. Token types created by lexers after
+    the style was loaded are resolved through their parents on first use.
+    """
+    style = get_style_by_name(theme)
+    styles = {}
+    for ttype, ndef in style:
+        color = ndef["color"]
+        rgb = (int(color[0:2], 16), int(color[2:4], 16), int(color[4:6], 16)) if color else None
+        styles[ttype] = (rgb, bool(ndef["bold"]), bool(ndef["italic"]))
+    return styles
+
+
+def _token_style(styles, ttype):
+    style = styles.get(ttype)
+    if style is None:
+        parent = ttype
+        while style is None and parent.parent is not None:
+            parent = parent.parent
+            style = styles.get(parent)
+        style = styles[ttype] = style or PLAIN
+    return style
+
+
+def tokenize_lines(code, lexer, theme="friendly"):
+    """
+    Highlight code with lexer and return its lines as tuples of
+    (text, color, bold, italic) runs. Tokens spanning several lines are split
+    at the line breaks, whitespace-only runs are left unstyled and adjacent
+    runs with the same style are merged.
+    """
+    styles = theme_styles(theme)
+    lines, current = [], []
+    for ttype, value in lexer.get_tokens(code):
+        style = _token_style(styles, ttype)
+        for i, part in enumerate(value.split("\n")):
+            if i:
+                lines.append(tuple(current))
+                current = []
+            if not part:
+                continue
+            part_style = PLAIN if part.isspace() else style
+            if current and current[-1][1:] == part_style:
+                current[-1] = (current[-1][0] + part,) + part_style
+            else:
+                current.append((part,) + part_style)
+    if current:
+        lines.append(tuple(current))
+    return tuple(lines)
+
+
+def highlight_lines(code, language=None, theme="friendly"):
+    """
+    Return the highlighted lines of a code block as tokenize_lines does.
+    Results are cached by (language, theme, hash of code), so repeated
+    snippets are only lexed once, and guess_lexer only runs for code without
+    a language that has not been seen before.
+    Args:
+        code: Source code to highlight
+        language: Pygments language name or alias, or None to guess it
+        theme: Pygments style name
+    """
+    key = (language, theme, hashlib.sha1(code.encode("utf-8")).digest())
+    with _cache_lock:
+        lines = _cache.get(key)
+        if lines is not None:
+            _cache.move_to_end(key)
+            return lines
+    if language:
+        lexer = lexer_for(language)
+    else:
+        try:
+            lexer = guess_lexer(code)
+        except ClassNotFound:
+            lexer = lexer_for("text")
+    lines = tokenize_lines(code, lexer, theme)
+    with _cache_lock:
+        _cache[key] = lines
+        if len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return lines
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
@@ -0,0 +1,110 @@
+import io
+import os
+
+from cache import DiskCache, hash_file, hash_parts
+
+try:
+    import PIL
+    from PIL import Image
+except ImportError:  # Pillow is optional: without it images are only deduplicated
+    PIL = Image = None
+
+# Printed width images are pinned to by convert_old, and the resolution kept for print.
+DEFAULT_WIDTH_CM = 10
+DEFAULT_DPI = 300
+# Resolution pandoc assumes for an image that has none (its --dpi default)
+ASSUMED_DPI = 96
+# Text width of the default reference DOCX; pandoc shrinks wider images to it
+MAX_WIDTH_CM = 15.24
+JPEG_QUALITY = 85
+# Bump when the optimized output changes, so cached images are rebuilt
+IMAGE_VERSION = "3"
+
+
+def target_width_px(width_cm=DEFAULT_WIDTH_CM, dpi=DEFAULT_DPI):
+    return int(round(width_cm / 2.54 * dpi))
+
+
+def optimize_image(src, width_cm=None, dpi=DEFAULT_DPI, cache_dir=None):
+    """
+    Return the path of an optimized copy of the image at src.
+    Images with more pixels than their printed width needs at dpi are
+    downsampled. The printed width is width_cm when the caller pins it;
+    otherwise it is the image's own size at its DPI (ASSUMED_DPI if it has
+    none), at most MAX_WIDTH_CM, and the DPI of a downsampled image is scaled
+    with its pixels so it prints at the same size as the original. Images
+    that are not downsampled keep their pixels and DPI, and are only
+    replaced when recompressing them in their own format is smaller.
+    Results are stored in a content-addressed cache keyed by the
+    source bytes and the settings, so identical images anywhere in a book (or
+    across books) map to one file and are never processed twice. If src is
+    missing, unreadable or not a raster image Pillow can handle, src is
+    returned unchanged.
+    Args:
+        src: Path of the source image
+        width_cm: Optional printed width the caller lays the image out at
+        dpi: Print resolution to keep
+        cache_dir: Optional cache root
+    """
+    source_hash = hash_file(src)
+    if source_hash is None:
+        return src
+    ext = os.path.splitext(src)[1].lower()
+    cache = DiskCache(cache_dir, "images")
+    key = hash_parts(IMAGE_VERSION, source_hash, width_cm, dpi, JPEG_QUALITY, PIL.__version__ if PIL else None)
+    cached = cache.get(key, ext)
+    if cached:
+        return cached
+    with open(src, "rb") as f:
+        data = f.read()
+    # If there is nothing to gain, the original is still stored so duplicates share one file
+    return cache.put_bytes(key, optimize_image_bytes(data, width_cm, dpi), ext)
+
+
+def optimize_image_bytes(data, width_cm=None, dpi=DEFAULT_DPI):
+    """Return the optimized bytes of an image as optimize_image does, or data if that gains nothing."""
+    result = _recompress(data, width_cm, dpi) if Image is not None else None
+    if result is None:
+        return data
+    optimized, downsampled = result
+    # A downsampled image is kept whatever its size, since its DPI sets its printed size
+    if not downsampled and len(optimized) >= len(data):
+        return data
+    return optimized
+
+
+def _recompress(data, width_cm, dpi):
+    """Return (recompressed bytes, whether the image was downsampled), or None if it cannot be optimized."""
+    try:
+        img = Image.open(io.BytesIO(data))
+        fmt = img.format
+        if fmt not in ("PNG", "JPEG"):
+            return None
+        source_dpi = img.info.get("dpi", (0, 0))[0]
+        if width_cm is None:
+            printed_cm = img.width / (source_dpi if source_dpi > 0 else ASSUMED_DPI) * 2.54
+            max_width = target_width_px(min(printed_cm, MAX_WIDTH_CM), dpi)
+        else:
+            max_width = target_width_px(width_cm, dpi)
+        downsampled = img.width > max_width
+        if downsampled:
+            ratio = max_width / img.width
+            height = max(1, int(round(img.height * ratio)))
+            img = img.resize((max_width, height), Image.LANCZOS)
+            if width_cm is None:
+                # Scaling the DPI with the pixels keeps the printed size
+                new_dpi = (source_dpi if source_dpi > 0 else ASSUMED_DPI) * ratio
+                options = {"dpi": (new_dpi, new_dpi)}
+            else:
+                options = {"dpi": (dpi, dpi)}
+        else:
+            options = {"dpi": img.info["dpi"]} if "dpi" in img.info else {}
+        out = io.BytesIO()
+        if fmt == "JPEG":
+            img.save(out, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True, **options)
+        else:
+            img.save(out, "PNG", optimize=True, **options)
+        return out.getvalue(), downsampled
+    except Exception as e:
+        print("Warning: could not optimize image:", e)
+        return None
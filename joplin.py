@@ -0,0 +1,153 @@
+import os
+import re
+import tarfile
+
+from cache import DiskCache, hash_parts
+from preprocess import Preprocessor, Rule
+
+# Joplin item types
+NOTE = "1"
+FOLDER = "2"
+RESOURCE = "4"
+
+RESOURCE_DIR = "resources"
+# Characters Joplin replaces with "_" when it turns a title into a file name
+UNSAFE_FILENAME_RE = re.compile(r'[/\\:*?"<>|\x00-\x1f]')
+ITEM_ID_RE = re.compile(r"^[0-9a-fA-F]{32}$")
+
+
+def safe_filename(title):
+    """Return the file name Joplin's markdown export gives a note titled title."""
+    return UNSAFE_FILENAME_RE.sub("_", title).strip()
+
+
+def parse_item(text):
+    """
+    Split a serialized Joplin item into (title, body, metadata).
+    The metadata is the trailing block of "key: value" lines; before it come
+    the title, a blank line and the body. Trailing newlines are ignored.
+    """
+    lines = text.rstrip("\r\n").split("\n")
+    metadata = {}
+    end = len(lines)
+    while end > 0:
+        line = lines[end - 1].strip()
+        end -= 1
+        if not line:
+            break
+        key, _, value = line.partition(":")
+        metadata[key.strip()] = value.strip()
+    body = lines[:end]
+    title = body[0] if body else ""
+    return title, "\n".join(body[2:]), metadata
+
+
+class JoplinIndex:
+    """
+    In-memory index of a Joplin export.
+    It maps note ids to their title and body, resource ids to local files,
+    and note titles to note ids. A title can be the one in Joplin or the
+    file name Joplin's markdown export would use, so chapters.txt lines such
+    as "Chapter 2_ LLM Fundamentals" resolve with one dict lookup.
+    Build it with JoplinIndex.load().
+    """
+
+    def __init__(self):
+        self.notes = {}
+        self.resources = {}
+        self._by_title = {}
+        self._duplicates = set()
+        self._link_rewriter = Preprocessor([Rule(
+            "joplin_resources", r"(?<=\]\():/(?P<joplin_id>[0-9a-fA-F]{32})", self._resource_link
+        )])
+
+    @classmethod
+    def load(cls, path, cache_dir=None):
+        """
+        Index a JEX archive or a RAW export directory.
+        A JEX archive is read as one stream, without extracting it. Only its
+        resources are written out, into the content-addressed "resources"
+        cache, so identical files are stored once across exports.
+        Args:
+            path: Path of the .jex file or RAW export directory
+            cache_dir: Optional cache root for resources from JEX archives
+        """
+        index = cls()
+        if os.path.isdir(path):
+            index._load_directory(path)
+        elif os.path.isfile(path):
+            index._load_jex(path, cache_dir)
+        else:
+            raise ValueError(f"Joplin export not found: {path}")
+        return index
+
+    def _load_directory(self, path):
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.endswith(".md") and entry.is_file():
+                    with open(entry.path, encoding="utf-8") as f:
+                        self._add_item(f.read())
+        resource_dir = os.path.join(path, RESOURCE_DIR)
+        if os.path.isdir(resource_dir):
+            with os.scandir(resource_dir) as entries:
+                for entry in entries:
+                    self._add_resource_file(entry.name, entry.path)
+
+    def _load_jex(self, path, cache_dir):
+        cache = DiskCache(cache_dir, "resources")
+        with tarfile.open(path, mode="r|*") as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                name = member.name.replace("\\", "/").lstrip("./")
+                directory, _, filename = name.rpartition("/")
+                data = tar.extractfile(member).read()
+                if directory == RESOURCE_DIR:
+                    ext = os.path.splitext(filename)[1]
+                    key = hash_parts(data)
+                    self._add_resource_file(filename, cache.get(key, ext) or cache.put_bytes(key, data, ext))
+                elif not directory and filename.endswith(".md"):
+                    self._add_item(data.decode("utf-8"))
+
+    def _add_resource_file(self, filename, path):
+        resource_id = os.path.splitext(filename)[0]
+        if ITEM_ID_RE.match(resource_id):
+            self.resources[resource_id] = path
+
+    def _add_item(self, text):
+        title, body, metadata = parse_item(text)
+        if metadata.get("type_") != NOTE or metadata.get("deleted_time", "0") not in ("", "0"):
+            return
+        if metadata.get("encryption_applied") == "1" or metadata.get("is_conflict") == "1":
+            return
+        note_id = metadata.get("id")
+        if not note_id:
+            return
+        self.notes[note_id] = {"id": note_id, "title": title, "body": body, "parent_id": metadata.get("parent_id")}
+        for key in {title, safe_filename(title)}:
+            if key in self._by_title and self._by_title[key] != note_id:
+                self._duplicates.add(key)
+                # Keep the choice independent of archive order
+                note_id_for_key = min(self._by_title[key], note_id)
+            else:
+                note_id_for_key = note_id
+            self._by_title[key] = note_id_for_key
+
+    def find_note(self, name):
+        """Return the id of the note titled name (as in Joplin or as an exported file name), or None."""
+        if name.endswith(".md"):
+            name = name[:-3]
+        note_id = self._by_title.get(name) or self._by_title.get(safe_filename(name))
+        if note_id and name in self._duplicates:
+            print(f"Warning: several notes are titled {name!r}; using {note_id}")
+        return note_id
+
+    def _resource_link(self, match):
+        path = self.resources.get(match.group("joplin_id"))
+        if path is None:
+            return match.group(0)
+        return f"<{path}>" if " " in path else path
+
+    def note_markdown(self, note_id):
+        """Return the body of a note with :/resourceid links pointing at the resource files."""
+        return self._link_rewriter.process(self.notes[note_id]["body"])
@@ -0,0 +1,124 @@
+"""
+Combine pandoc JSON ASTs parsed chapter by chapter into one document.
+"""
+
+# book-filter.lua turns headers with the csp-chapter-title class into a Div
+# with this custom style around a Para, keeping the header's identifier
+CHAPTER_TITLE_STYLE = "CSP - Chapter Title"
+# Blocks that hold only inlines or text, so there is no Header in them to look for
+LEAF_BLOCKS = ("Header", "Para", "Plain", "LineBlock", "CodeBlock", "RawBlock", "HorizontalRule")
+QUOTES = {"SingleQuote": ("\u2018", "\u2019"), "DoubleQuote": ("\u201c", "\u201d")}
+
+
+def stringify(node):
+    """Return the plain text of pandoc JSON inlines, as pandoc's stringify does."""
+    if isinstance(node, list):
+        return "".join(stringify(child) for child in node)
+    if not isinstance(node, dict):
+        return ""
+    kind = node.get("t")
+    content = node.get("c")
+    if kind == "Str":
+        return content
+    if kind in ("Space", "SoftBreak", "LineBreak"):
+        return " "
+    if kind in ("Code", "Math"):
+        return content[1]
+    if kind == "RawInline":
+        return " " if content == ["html", "<br>"] else ""
+    if kind == "Note":
+        return ""
+    if kind == "Quoted":
+        opening, closing = QUOTES[content[0]["t"]]
+        return opening + stringify(content[1]) + closing
+    return stringify(content)
+
+
+def identifier_base(inlines):
+    """
+    Return the identifier pandoc's markdown reader derives from a header's
+    inlines before making it unique (auto_identifiers without
+    gfm_auto_identifiers or ascii_identifiers).
+    """
+    text = "".join(c for c in stringify(inlines).lower() if c.isspace() or c.isalnum() or c in "_-.")
+    identifier = "-".join(text.split())
+    while identifier and not identifier[0].isalpha():
+        identifier = identifier[1:]
+    return identifier or "section"
+
+
+def unique_identifier(base, used):
+    """Return base, or base-N with the smallest N >= 1 that is not in used, as pandoc's uniqueIdent does."""
+    if base not in used:
+        return base
+    n = 1
+    while f"{base}-{n}" in used:
+        n += 1
+    return f"{base}-{n}"
+
+
+def _headers(node, found):
+    """Append (attr, inlines) for each header in node to found, in document order."""
+    if isinstance(node, list):
+        for child in node:
+            _headers(child, found)
+        return found
+    if not isinstance(node, dict):
+        return found
+    kind = node.get("t")
+    content = node.get("c")
+    if kind == "Header":
+        found.append((content[1], content[2]))
+    elif (kind == "Div" and ["custom-style", CHAPTER_TITLE_STYLE] in content[0][2]
+          and len(content[1]) == 1 and content[1][0]["t"] == "Para"):
+        found.append((content[0], content[1][0]["c"]))
+    elif kind not in LEAF_BLOCKS and isinstance(content, list):
+        _headers(content, found)
+    return found
+
+
+def _renumber_ids(blocks, used):
+    """
+    Give the headers of one chapter the identifiers pandoc would have given
+    them had the chapter been read after the ones whose identifiers are in
+    used. Pandoc made each generated identifier unique within the chapter
+    only, so it is derived again from the header's text with the book's
+    identifiers so far. Explicit identifiers are kept, as pandoc keeps
+    them; one equal to the identifier pandoc would generate cannot be told
+    apart and is treated as generated. Links are left alone: they name the
+    identifiers of the whole book as the author sees them.
+    """
+    chapter_used = set()
+    for attr, inlines in _headers(blocks, []):
+        identifier = attr[0]
+        if not identifier:
+            continue
+        base = identifier_base(inlines)
+        if identifier == unique_identifier(base, chapter_used):
+            attr[0] = unique_identifier(base, used)
+        chapter_used.add(identifier)
+        used.add(attr[0])
+
+
+def merge_documents(docs):
+    """
+    Return one pandoc JSON document with the blocks of docs in order.
+    Metadata is merged with the first value of a field winning, as pandoc
+    does for several YAML blocks in one input, and header identifiers are
+    made unique as if the chapters had been parsed together (see
+    _renumber_ids). The documents are modified in place.
+    Args:
+        docs: Iterable of documents as loaded from pandoc's JSON output
+    """
+    merged = None
+    used = set()
+    for doc in docs:
+        if merged is None:
+            merged = {"pandoc-api-version": doc["pandoc-api-version"], "meta": {}, "blocks": []}
+        for name, value in doc.get("meta", {}).items():
+            merged["meta"].setdefault(name, value)
+        _renumber_ids(doc["blocks"], used)
+        merged["blocks"].extend(doc["blocks"])
+    if merged is None:
+        raise ValueError("No documents to merge")
+    return merged
@@ -0,0 +1,155 @@
+"""
+Find and run the pandoc binary.
+
+pypandoc looks for pandoc in every process that uses it, running each
+candidate with --version, and lists pandoc's formats again on every
+conversion. Here the binary's path, version and supported options are
+probed once and kept on disk, keyed by the search settings and checked
+against the binary's size and mtime, so a short-lived process goes
+straight to running pandoc. convert_file and convert_text take the same
+arguments as their pypandoc counterparts. Every function takes an optional
+cache_dir, the cache root the info is kept under.
+"""
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import threading
+from importlib.util import find_spec
+
+from cache import DiskCache, default_cache_dir, hash_parts
+
+# Bump when the layout of the cached pandoc info changes
+PANDOC_INFO_VERSION = "1"
+
+# Info found by this process, by cache root
+_info = {}
+_info_lock = threading.Lock()
+
+
+def _candidates():
+    """Yield the paths pandoc may be at, in the order pypandoc prefers them."""
+    if os.environ.get("PYPANDOC_PANDOC"):
+        yield os.environ["PYPANDOC_PANDOC"]
+        return
+    found = shutil.which("pandoc")
+    if found:
+        yield found
+    # The binary pypandoc-binary ships, found without importing pypandoc
+    spec = find_spec("pypandoc")
+    if spec is not None and spec.origin:
+        yield os.path.join(os.path.dirname(spec.origin), "files", "pandoc")
+    yield os.path.join(sys.exec_prefix, "bin", "pandoc")
+    yield os.path.expanduser("~/bin/pandoc")
+    yield os.path.expanduser("~/.bin/pandoc")
+
+
+def _fingerprint(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def probe(path):
+    """Run pandoc at path and return its info: path, version, options and fingerprint."""
+    out = subprocess.run([path, "--version"], capture_output=True, check=True).stdout.decode("utf-8", "replace")
+    version = out.split("\n", 1)[0].split()[-1]
+    usage = subprocess.run([path, "--help"], capture_output=True, check=True).stdout.decode("utf-8", "replace")
+    options = sorted(set(re.findall(r"(?<![\w-])--[a-z][a-z0-9-]*", usage)))
+    return {"path": path, "version": version, "options": options, "fingerprint": _fingerprint(path)}
+
+
+def find_pandoc():
+    """Probe the candidate paths and return the info of the first usable pandoc."""
+    for path in _candidates():
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            try:
+                return probe(path)
+            except (OSError, subprocess.CalledProcessError, IndexError):
+                continue
+    raise OSError("No pandoc was found: install pandoc or pypandoc-binary, or set PYPANDOC_PANDOC")
+
+
+def pandoc_info(cache_dir=None):
+    """
+    Return the info of the pandoc to use, probing for it only when the disk
+    cache has no entry for the current search settings or the cached binary
+    has changed since.
+    Args:
+        cache_dir: Optional cache root
+    """
+    root = cache_dir or default_cache_dir()
+    with _info_lock:
+        if root in _info:
+            return _info[root]
+        cache = DiskCache(root, "pandoc")
+        key = hash_parts("pandoc", PANDOC_INFO_VERSION, os.environ.get("PYPANDOC_PANDOC"),
+                         os.environ.get("PATH"), sys.exec_prefix)
+        path = cache.get(key, ".json")
+        info = None
+        if path is not None:
+            try:
+                with open(path, encoding="utf-8") as f:
+                    info = json.load(f)
+                if _fingerprint(info["path"]) != info["fingerprint"]:
+                    info = None
+            except (OSError, ValueError, KeyError):
+                info = None
+        if info is None:
+            info = find_pandoc()
+            cache.put_bytes(key, json.dumps(info).encode("utf-8"), ".json")
+        _info[root] = info
+        return info
+
+
+def clear_memo():
+    """Forget the info of this process, so the next call reads the disk cache again."""
+    with _info_lock:
+        _info.clear()
+
+
+def get_pandoc_path(cache_dir=None):
+    return pandoc_info(cache_dir)["path"]
+
+
+def get_pandoc_version(cache_dir=None):
+    return pandoc_info(cache_dir)["version"]
+
+
+def supports(option, cache_dir=None):
+    """Return whether pandoc accepts a long option, e.g. "--syntax-highlighting"."""
+    return option in pandoc_info(cache_dir)["options"]
+
+
+def run(args, input=None, cwd=None, cache_dir=None):
+    """
+    Run pandoc with args and return its stdout. Warnings pandoc prints are
+    passed on to stderr; a failed run raises RuntimeError with its message.
+    """
+    proc = subprocess.run([get_pandoc_path(cache_dir), *args], input=input, cwd=cwd, capture_output=True)
+    err = proc.stderr.decode("utf-8", "replace").strip()
+    if proc.returncode != 0:
+        raise RuntimeError(f'Pandoc died with exitcode "{proc.returncode}" during conversion: {err}')
+    if err:
+        print(err, file=sys.stderr)
+    return proc.stdout
+
+
+def convert_file(source_file, to, format=None, extra_args=(), outputfile=None, cache_dir=None):
+    """Convert a file with pandoc; return the output as text unless outputfile is given."""
+    args = [source_file, "-t", to, *(["-f", format] if format else []), *extra_args]
+    if outputfile:
+        run([*args, "-o", str(outputfile)], cache_dir=cache_dir)
+        return ""
+    return run(args, cache_dir=cache_dir).decode("utf-8")
+
+
+def convert_text(source, to, format, extra_args=(), outputfile=None, cache_dir=None):
+    """Convert text with pandoc; return the output as text unless outputfile is given."""
+    data = source.encode("utf-8") if isinstance(source, str) else source
+    args = ["-f", format, "-t", to, *extra_args]
+    if outputfile:
+        run([*args, "-o", str(outputfile)], input=data, cache_dir=cache_dir)
+        return ""
+    return run(args, input=data, cache_dir=cache_dir).decode("utf-8")
@@ -0,0 +1,173 @@
+"""
+Check a book's manifest before converting it.
+
+    python preflight.py chapters.txt --folder "Test-First Copilot"
+
+Exits with status 1 and lists each problem, with suggestions, if a chapter
+or an image is missing.
+"""
+import difflib
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from preprocess import image_paths
+
+MISSING_CHAPTER = "missing_chapter"
+UNREADABLE_CHAPTER = "unreadable_chapter"
+MISSING_IMAGE = "missing_image"
+MISSING_RESOURCE = "missing_resource"
+
+
+class PreflightReport:
+    """
+    Result of preflight(). Each problem is a dict with "kind", "name" (the
+    chapter line or image source), "chapter" (the chapter it was found in,
+    for images) and "suggestions", the closest existing names.
+    """
+
+    def __init__(self):
+        self.problems = []
+        self.chapters = 0
+        self.images = 0
+
+    @property
+    def ok(self):
+        return not self.problems
+
+    def add(self, kind, name, chapter=None, suggestions=()):
+        self.problems.append({"kind": kind, "name": name, "chapter": chapter, "suggestions": list(suggestions)})
+
+    def to_dict(self):
+        return {"ok": self.ok, "chapters": self.chapters, "images": self.images, "problems": self.problems}
+
+    def format(self):
+        """Return the report as human-readable text."""
+        lines = [f"Checked {self.chapters} chapters and {self.images} images: "
+                 f"{len(self.problems) or 'no'} problem{'' if len(self.problems) == 1 else 's'}"]
+        for problem in self.problems:
+            where = f" (in {problem['chapter']})" if problem["chapter"] else ""
+            line = f"  {problem['kind'].replace('_', ' ')}: {problem['name']}{where}"
+            if problem["suggestions"]:
+                line += f"; did you mean {' or '.join(repr(s) for s in problem['suggestions'])}?"
+            lines.append(line)
+        return "\n".join(lines)
+
+
+def index_folder(folder_name):
+    """Return the set of files under folder_name, as paths relative to it with "/" separators."""
+    files = set()
+    if not folder_name or not os.path.isdir(folder_name):
+        return files
+    for root, _, names in os.walk(folder_name):
+        rel_root = os.path.relpath(root, folder_name).replace(os.sep, "/")
+        prefix = "" if rel_root == "." else rel_root + "/"
+        files.update(prefix + name for name in names)
+    return files
+
+
+def _suggest(name, candidates, n=3):
+    return difflib.get_close_matches(name, candidates, n=n, cutoff=0.6)
+
+
+def _manifest(chapters_file=None, md_files=None):
+    """Return the chapter names of a book, without part entries."""
+    if chapters_file and os.path.exists(chapters_file):
+        with open(chapters_file, encoding="utf-8") as f:
+            lines = [line.strip() for line in f]
+        return [line for line in lines if line and not line.startswith("#") and not line.startswith("<partname>")]
+    if md_files:
+        return list(md_files)
+    raise ValueError("Either chapters_file must exist or md_files must be provided")
+
+
+def preflight(chapters_file=None, md_files=None, folder_name=None, joplin_index=None, jobs=8):
+    """
+    Check that every chapter of a book exists and that every local image and
+    Joplin resource its chapters link to can be found, without converting
+    anything. folder_name is listed once up front; chapters are then
+    resolved against that listing, with the same ".md" suffix rule as
+    convert.py, and read and checked concurrently.
+    Args:
+        chapters_file: Path to chapters.txt file (takes precedence over md_files)
+        md_files: List of markdown files (used if chapters_file is None)
+        folder_name: Optional folder where markdown files are located
+        joplin_index: Optional joplin.JoplinIndex to look chapters up in instead
+        jobs: Number of chapters to check in parallel
+    Returns a PreflightReport.
+    """
+    names = _manifest(chapters_file, md_files)
+    report = PreflightReport()
+    files = index_folder(folder_name)
+    chapter_names = sorted(f[:-3] for f in files if f.endswith(".md"))
+
+    def check_chapter(name):
+        """Return the problems found in one chapter, and the number of images it links to."""
+        problems = []
+        if joplin_index is not None:
+            note_id = joplin_index.find_note(name)
+            if note_id is None:
+                titles = sorted({note["title"] for note in joplin_index.notes.values()})
+                return [(MISSING_CHAPTER, name, None, _suggest(name, titles))], 0
+            md = joplin_index.note_markdown(note_id)
+        else:
+            path = name if os.path.isabs(name) or not folder_name else os.path.join(folder_name, name)
+            if chapters_file and not path.endswith(".md"):
+                path += ".md"
+            rel = os.path.relpath(path, folder_name).replace(os.sep, "/") if folder_name else path
+            exists = rel in files if folder_name and not rel.startswith("../") else os.path.isfile(path)
+            if not exists:
+                return [(MISSING_CHAPTER, name, None, _suggest(name[:-3] if name.endswith(".md") else name,
+                                                               chapter_names))], 0
+            try:
+                with open(path, encoding="utf-8") as f:
+                    md = f.read()
+            except (OSError, UnicodeDecodeError) as e:
+                return [(UNREADABLE_CHAPTER, name, None, [str(e)])], 0
+        paths = image_paths(md, folder_name)
+        for src in paths:
+            if src.startswith(":/") or (folder_name and src.startswith(os.path.join(folder_name, ":/"))):
+                problems.append((MISSING_RESOURCE, src.rpartition(":/")[2], name, []))
+                continue
+            rel = os.path.relpath(src, folder_name).replace(os.sep, "/") if folder_name else src
+            if folder_name and not rel.startswith("../") and not os.path.isabs(rel):
+                if rel not in files:
+                    problems.append((MISSING_IMAGE, rel, name, _suggest(rel, files)))
+            elif not os.path.exists(src):
+                problems.append((MISSING_IMAGE, src, name, []))
+        return problems, len(paths)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        # map keeps the manifest order in the report
+        for problems, images in pool.map(check_chapter, names):
+            report.chapters += 1
+            report.images += images
+            for kind, name, chapter, suggestions in problems:
+                report.add(kind, name, chapter, suggestions)
+    return report
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("chapters_file", help="chapters.txt listing the book's parts and chapters")
+    parser.add_argument("--folder", help="folder the chapters and images are in")
+    parser.add_argument("--joplin-export", help="look chapters up in a Joplin JEX archive or RAW export")
+    parser.add_argument("--jobs", type=int, default=8)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    joplin_index = None
+    if args.joplin_export:
+        from joplin import JoplinIndex
+        joplin_index = JoplinIndex.load(args.joplin_export)
+    report = preflight(chapters_file=args.chapters_file, folder_name=args.folder, joplin_index=joplin_index,
+                       jobs=args.jobs)
+    print(json.dumps(report.to_dict(), indent=2) if args.json else report.format())
+    return 0 if report.ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,309 @@
+import os
+import re
+
+# Opening code fence line: up to three spaces of indent, then a run of three or
+# more backticks or tildes. A backtick fence's info string cannot contain a
+# backtick.
+FENCE_OPEN_RE = re.compile(r"^ {0,3}(`{3,}(?=[^`\n]*$)|~{3,})[^\n]*\n?", re.MULTILINE)
+# Protected spans inside prose: HTML comments and inline code. A code span
+# closes on a backtick run of exactly the same length and never crosses a
+# blank line.
+INLINE_RE = re.compile(
+    r"<!--.*?-->|(?<!`)(`+)(?!`)(?:[^`\n]++|\n(?![ \t]*\n)|`++)*?(?<!`)\1(?!`)", re.DOTALL
+)
+
+_closing_fences = {}
+
+
+class Rule:
+    """
+    One markdown rewrite.
+    Args:
+        name: Rule name, for listing and removing rules
+        pattern: Regular expression to match
+        replacement: Replacement string (with \\1 style references) or a
+            function taking the re.Match and returning the replacement
+        where: "text" to rewrite prose only, never code or comments, or
+            "fence" to rewrite the opening line of fenced code blocks
+    """
+
+    def __init__(self, name, pattern, replacement, where="text"):
+        if where not in ("text", "fence"):
+            raise ValueError(f"Unknown rule target: {where!r}")
+        self.name = name
+        self.regex = re.compile(pattern)
+        self.replacement = replacement
+        self.where = where
+
+    def expand(self, match):
+        if callable(self.replacement):
+            return self.replacement(match)
+        return match.expand(self.replacement)
+
+
+def _closing_fence_re(fence):
+    key = (fence[0], len(fence))
+    if key not in _closing_fences:
+        _closing_fences[key] = re.compile(
+            r"^ {0,3}%s{%d,}[ \t]*(?:\n|$)" % (re.escape(fence[0]), len(fence)), re.MULTILINE
+        )
+    return _closing_fences[key]
+
+
+def _comment_start(text, start, end):
+    """
+    Return where the last "<!--" in text[start:end] starts, skipping any that
+    are inside a code span, or -1.
+    """
+    pos = text.rfind("<!--", start, end)
+    while pos >= 0:
+        # Code spans never cross a blank line, see protected_end
+        para_start = max(text.rfind("\n\n", start, pos) + 1, start)
+        in_code = False
+        if text.find("`", para_start, pos) >= 0:
+            for m in INLINE_RE.finditer(text, para_start):
+                if m.start() > pos:
+                    break
+                if m.end() > pos:
+                    in_code = m.group(1) is not None
+                    break
+        if not in_code:
+            return pos
+        pos = text.rfind("<!--", start, pos)
+    return -1
+
+
+def iter_blocks(md):
+    """
+    Split markdown into ("text" | "fence" | "code", str) blocks in one linear
+    pass. Joining the blocks gives back md. "fence" blocks are the opening and
+    closing fence lines, "code" the lines between them. Fence-looking lines
+    inside an HTML comment stay in the text; a "<!--" inside a code span does
+    not open a comment. Indented code blocks are treated
+    as text, since they cannot be told apart from indented list paragraphs
+    without a full parse.
+    """
+    pos = 0
+    text_start = 0
+    length = len(md)
+    while pos < length:
+        fence = FENCE_OPEN_RE.search(md, pos)
+        end = fence.start() if fence else length
+        comment_start = _comment_start(md, text_start, end)
+        if comment_start >= 0 and md.find("-->", comment_start + 4, end) < 0:
+            comment_end = md.find("-->", end)
+            if comment_end < 0:
+                break
+            pos = comment_end + 3
+            continue
+        if fence is None:
+            break
+
+        if end > text_start:
+            yield "text", md[text_start:end]
+        yield "fence", fence.group(0)
+        closing = _closing_fence_re(fence.group(1)).search(md, fence.end())
+        code_end = closing.start() if closing else length
+        if code_end > fence.end():
+            yield "code", md[fence.end():code_end]
+        if closing:
+            yield "fence", closing.group(0)
+        pos = text_start = closing.end() if closing else length
+
+    if text_start < length:
+        yield "text", md[text_start:]
+
+
+def protected_end(text, pos):
+    """
+    If pos in the prose `text` falls inside an HTML comment or a code span,
+    return the end of that span, otherwise None.
+    """
+    comment_start = _comment_start(text, 0, pos + 1)
+    if comment_start >= 0:
+        comment_end = text.find("-->", comment_start + 4)
+        if comment_end < 0 or comment_end + 3 > pos:
+            return len(text) if comment_end < 0 else comment_end + 3
+    # Code spans never cross a blank line, so scanning from the start of the
+    # paragraph is enough to pair the backticks around pos.
+    para_start = text.rfind("\n\n", 0, pos) + 1
+    if text.find("`", para_start, pos) < 0:
+        return None
+    for m in INLINE_RE.finditer(text, para_start):
+        if m.start() > pos:
+            break
+        if m.end() > pos:
+            return m.end()
+    return None
+
+
+def finditer_prose(regex, text):
+    """Yield the matches of regex in the prose `text` that start outside code spans and comments."""
+    pos = 0
+    while True:
+        m = regex.search(text, pos)
+        if m is None:
+            return
+        end = protected_end(text, m.start())
+        if end is None:
+            yield m
+            pos = m.end() if m.end() > m.start() else m.end() + 1
+        else:
+            pos = end
+
+
+class Preprocessor:
+    """
+    Apply a list of Rules to markdown in a single pass.
+    All text rules are combined into one alternation, so each prose block is
+    scanned once whatever the number of rules; at each position the first
+    rule in list order that matches wins. Code blocks, inline code and HTML
+    comments are passed through untouched; inline code and comments are only
+    tokenized around candidate matches. Because patterns are combined, rules
+    needing flags should use scoped inline flags such as (?i:...),
+    backreferences inside a pattern must be named, and group names must not
+    clash between rules.
+    If given, code_renderer is called as code_renderer(opening, code,
+    closing) with the fence lines (after fence rules) and the code of each
+    closed fenced block, and returns the markdown to put in place of the
+    whole block, or None to keep it.
+    """
+
+    def __init__(self, rules=(), code_renderer=None):
+        self.rules = list(rules)
+        self.code_renderer = code_renderer
+        self._compile()
+
+    def add_rule(self, rule):
+        self.rules.append(rule)
+        self._compile()
+
+    def remove_rule(self, name):
+        self.rules = [rule for rule in self.rules if rule.name != name]
+        self._compile()
+
+    def _compile(self):
+        self._text_rules = [rule for rule in self.rules if rule.where == "text"]
+        self._fence_rules = [rule for rule in self.rules if rule.where == "fence"]
+        self._combined = None
+        if self._text_rules:
+            self._combined = re.compile("|".join(
+                f"(?P<r{i}>{rule.regex.pattern})" for i, rule in enumerate(self._text_rules)
+            ))
+
+    def _rewrite_text(self, text, out, stats):
+        if self._combined is None:
+            out.append(text)
+            return
+        pos = 0
+        for m in finditer_prose(self._combined, text):
+            # The rule's wrapping group always closes last, so it is lastgroup
+            rule = self._text_rules[int(m.lastgroup[1:])]
+            if stats is not None:
+                stats[rule.name] = stats.get(rule.name, 0) + 1
+            out.append(text[pos:m.start()])
+            # Re-match in place so the rule sees its own groups and context
+            out.append(rule.expand(rule.regex.match(text, m.start())))
+            pos = m.end()
+        out.append(text[pos:])
+
+    def process(self, md, stats=None):
+        """
+        Return md with every rule applied. If a stats dict is given, the number
+        of matches of each text rule is added under the rule's name and the
+        number of fenced code blocks under "code_blocks".
+        """
+        out = []
+        opening = True
+        # Opening fence and code of the block being read, when there is a code_renderer
+        pending = None
+        for kind, block in iter_blocks(md):
+            if kind == "text":
+                self._rewrite_text(block, out, stats)
+            elif kind == "fence":
+                if opening:
+                    if stats is not None:
+                        stats["code_blocks"] = stats.get("code_blocks", 0) + 1
+                    for rule in self._fence_rules:
+                        block = rule.regex.sub(rule.expand, block)
+                    if self.code_renderer is not None:
+                        pending = [block, ""]
+                    else:
+                        out.append(block)
+                elif pending is not None:
+                    rendered = self.code_renderer(pending[0], pending[1], block)
+                    out.append(rendered if rendered is not None else pending[0] + pending[1] + block)
+                    pending = None
+                else:
+                    out.append(block)
+                opening = not opening
+            elif pending is not None:
+                pending[1] = block
+            else:
+                out.append(block)
+        if pending is not None:
+            # Unclosed fence: the block runs to the end of the chapter and is kept as it is
+            out.extend(pending)
+        return "".join(out)
+
+
+def find_in_prose(pattern, md):
+    """Yield the matches of pattern in md outside code blocks, code spans and comments."""
+    regex = re.compile(pattern)
+    for kind, block in iter_blocks(md):
+        if kind == "text":
+            yield from finditer_prose(regex, block)
+
+
+IMAGE_LINK_PATTERN = r'!\[[^\]]*\]\(([^\)]+)\)'
+
+
+def split_image_target(target):
+    """Split an image link target into its source and the rest (such as a title)."""
+    target = target.strip()
+    if target.startswith("<") and ">" in target:
+        end = target.index(">")
+        return target[1:end], target[end + 1:]
+    src, sep, rest = target.partition(" ")
+    return src, sep + rest
+
+
+def local_image_path(src, folder_name=None):
+    """Resolve an image source against folder_name, or return None for URLs."""
+    if re.match(r'^[a-zA-Z][a-zA-Z0-9+.-]*:', src) and not os.path.isabs(src):
+        return None
+    if folder_name and not os.path.isabs(src):
+        src = os.path.join(folder_name, src)
+    return src
+
+
+def image_paths(md, folder_name=None):
+    """Return the local files referenced by ![...](...) image links in md."""
+    paths = []
+    for m in find_in_prose(IMAGE_LINK_PATTERN, md):
+        path = local_image_path(split_image_target(m.group(1))[0], folder_name)
+        if path is not None:
+            paths.append(path)
+    return paths
+
+
+def image_rule(rewrite_src=None):
+    """
+    Rule suppressing alt text captions for images by replacing the alt text
+    with a non-breaking space. If given, rewrite_src maps each image source to
+    the one to use instead, in the same pass.
+    """
+    def replace(m):
+        if rewrite_src is None:
+            return f"![&nbsp;]({m.group(1)})"
+        src, rest = split_image_target(m.group(1))
+        new_src = rewrite_src(src)
+        if new_src != src and " " in new_src:
+            new_src = f"<{new_src}>"
+        return f"![&nbsp;]({new_src}{rest})"
+    return Rule("images", IMAGE_LINK_PATTERN, replace)
+
+
+SUPPRESS_IMAGE_ALT = image_rule()
+
+DEFAULT_RULES = [SUPPRESS_IMAGE_ALT]
@@ -0,0 +1,561 @@
+"""
+Serve DOCX conversions over local HTTP.
+
+    python service.py --port 8765 --workers 4
+    curl --data-binary @book.zip -H "Content-Type: application/zip" \\
+        "http://127.0.0.1:8765/convert?header_text=My+Book" -o book.docx
+
+POST /convert takes a manuscript bundle: a zip of markdown files and
+images, with an optional chapters.txt at its root (without one, the .md
+files at the root are used in name order), or a single markdown document
+sent as text/markdown. The response is the DOCX. GET /metrics returns
+throughput, latency and queue figures as JSON, GET /health returns 200
+once the workers are warm, and DELETE /jobs/<id> cancels a job whose id
+was sent in an X-Job-Id header.
+"""
+import argparse
+import io
+import json
+import os
+import queue
+import shutil
+import socketserver
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandoc_runner
+from convert import (
+    DEFAULT_HEADER_TEXT, PYGMENTS_THEME, cached_reference_docx, data_uri, iter_book_items, make_preprocessor,
+    pandoc_arguments, read_chapter, write_book_markdown,
+)
+from preprocess import Preprocessor, image_rule, local_image_path
+from tracing import BuildTrace
+
+DOCX_MIME = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+MARKDOWN_TYPES = ("text/markdown", "text/plain", "text/x-markdown")
+# Completed jobs kept for latency percentiles, and the window throughput is averaged over
+LATENCY_SAMPLES = 1000
+THROUGHPUT_WINDOW_S = 60
+# How often queued jobs and a running pandoc are checked for a cancelled or expired job
+POLL_INTERVAL_S = 0.05
+
+
+class _JobStopped(Exception):
+    """Raised inside a worker when its job is cancelled or expires; args are (status, error)."""
+
+
+class Job:
+    """
+    One conversion request. status moves from "queued" to "running" and ends
+    as "done", "failed", "timeout" or "cancelled"; done is set when it ends.
+    """
+
+    def __init__(self, bundle, content_type="application/zip", header_text=None, timeout=None, job_id=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.bundle = bundle
+        self.content_type = content_type
+        self.header_text = header_text
+        self.submitted = time.monotonic()
+        self.deadline = self.submitted + timeout if timeout else None
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def stopped(self):
+        """Return (status, error) if the job was cancelled or has expired, otherwise None."""
+        if self.cancelled.is_set():
+            return "cancelled", "Job cancelled"
+        if self.expired():
+            return "timeout", "Job timed out" if self.status == "running" else "Job timed out in the queue"
+        return None
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        return self
+
+
+def extract_bundle(data, folder):
+    """Unpack a zip bundle into folder, refusing entries that would land outside it."""
+    try:
+        archive = zipfile.ZipFile(io.BytesIO(data))
+    except zipfile.BadZipFile:
+        raise ValueError("Bundle is not a zip archive")
+    with archive:
+        root = os.path.realpath(folder)
+        for name in archive.namelist():
+            target = os.path.realpath(os.path.join(root, name))
+            if os.path.isabs(name) or not target.startswith(root + os.sep):
+                raise ValueError(f"Bundle entry outside the bundle: {name}")
+        archive.extractall(root)
+
+
+def bundle_reader(folder):
+    """Return a chapter reader that raises ValueError for chapters outside the bundle in folder."""
+    root = os.path.realpath(folder)
+
+    def read(path):
+        if not os.path.realpath(path).startswith(root + os.sep):
+            raise ValueError(f"Chapter outside the bundle: {path}")
+        return read_chapter(path)
+    return read
+
+
+def bundle_preprocessor(folder, optimize_images=True, cache_dir=None, trace=None, theme=None):
+    """
+    Return the Preprocessor for a bundle extracted to folder. Image links
+    to files in the bundle are replaced by data: URIs of the (optimized)
+    images, since pandoc runs sandboxed and reads no files itself. An image
+    link with an absolute source, or one that resolves outside the bundle,
+    raises ValueError; nothing outside the bundle is read.
+    """
+    trace = trace or BuildTrace()
+    root = os.path.realpath(folder)
+    uris = {}
+
+    def rewrite_src(src):
+        path = local_image_path(src, root)
+        if path is None:
+            return src  # A URL, which the sandboxed pandoc does not fetch
+        path = os.path.realpath(path)
+        if os.path.isabs(src) or not path.startswith(root + os.sep):
+            raise ValueError(f"Image outside the bundle: {src}")
+        if path not in uris:
+            if not os.path.isfile(path):
+                return src  # Missing, which pandoc warns about
+            if optimize_images:
+                from images import optimize_image
+                with trace.stage("optimize_images") as counts:
+                    counts["images"] += 1
+                    counts["bytes_read"] += os.path.getsize(path)
+                    optimized = optimize_image(path, cache_dir=cache_dir)
+            else:
+                optimized = path
+            with open(optimized, "rb") as f:
+                uris[path] = data_uri(f.read(), path)
+        return uris[path]
+
+    base = make_preprocessor(root, optimize_images=False, cache_dir=cache_dir, trace=trace, theme=theme)
+    return Preprocessor([image_rule(rewrite_src)] + [rule for rule in base.rules if rule.name != "images"],
+                        base.code_renderer)
+
+
+class ConversionService:
+    """
+    Pool of warm conversion workers fed from a bounded queue.
+    start() resolves pandoc, prepares the reference template and starts the
+    worker threads, so requests only pay for their own preprocessing and
+    pandoc run. Markdown is piped into pandoc and the DOCX read from its
+    stdout; only the bundle's own files touch the disk. pandoc runs with
+    --sandbox and the bundle's images are passed in as data: URIs (see
+    bundle_preprocessor), so a job can embed no file from the host. A job that is still
+    queued or running when its timeout expires, or when it is cancelled, is
+    ended right away: a queued job is taken off the queue, a running one is
+    stopped between chapters or has its pandoc process killed.
+    Args:
+        workers: Number of jobs converted at once
+        queue_size: Number of jobs that may wait for a worker; submit()
+            raises queue.Full beyond that
+        timeout: Default seconds a job may take from submission, or None
+        reference_docx: Optional DOCX template for styling
+        header_text: Default text of the centered page header
+        optimize_images: Embed optimized copies of the bundle's images
+        cache_dir: Optional cache root for templates, images and code blocks
+        theme: Pygments style to highlight code blocks in
+        prehighlight: Reuse cached highlighted code blocks instead of
+            letting pandoc highlight them
+    """
+
+    def __init__(self, workers=2, queue_size=16, timeout=120, reference_docx=None,
+                 header_text=DEFAULT_HEADER_TEXT, optimize_images=True, cache_dir=None, theme=PYGMENTS_THEME,
+                 prehighlight=True):
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.reference_docx = reference_docx
+        self.header_text = header_text
+        self.optimize_images = optimize_images
+        self.cache_dir = cache_dir
+        self.theme = theme
+        self.prehighlight = prehighlight
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._jobs = {}
+        self._templates = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        self._reaper = None
+        self._pandoc = None
+        self._scratch = None
+        self._started = time.monotonic()
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self._finished = deque()
+        self._counts = {"submitted": 0, "rejected": 0, "done": 0, "failed": 0, "timeout": 0, "cancelled": 0}
+        self._running = 0
+        self._stopping = threading.Event()
+        self.ready = threading.Event()
+
+    def start(self):
+        """Warm up and start the workers."""
+        self._pandoc = pandoc_runner.get_pandoc_path(self.cache_dir)
+        if not pandoc_runner.supports("--sandbox", self.cache_dir):
+            raise RuntimeError(f"pandoc {pandoc_runner.get_pandoc_version(self.cache_dir)} has no --sandbox option; "
+                               "the service needs pandoc 2.15 or later")
+        self._scratch = tempfile.mkdtemp(prefix="docx-service-")
+        self.reference_doc(self.header_text)
+        self._stopping.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"docx-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        self._reaper = threading.Thread(target=self._reap, name="docx-reaper", daemon=True)
+        self._reaper.start()
+        self.ready.set()
+        return self
+
+    def stop(self):
+        """Cancel the queued jobs, let running ones finish and stop the workers."""
+        while True:
+            try:
+                job = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None and self._claim(job, "cancelled"):
+                self._finish(job, "cancelled", error="Service stopped")
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._stopping.set()
+        if self._reaper is not None:
+            self._reaper.join()
+            self._reaper = None
+        if self._scratch:
+            shutil.rmtree(self._scratch, ignore_errors=True)
+
+    def reference_doc(self, header_text):
+        """Return the generated reference DOCX for header_text, preparing it once per service."""
+        with self._lock:
+            path = self._templates.get(header_text)
+        if path is None:
+            path = cached_reference_docx(self.reference_docx, header_text, cache_dir=self.cache_dir)
+            with self._lock:
+                self._templates[header_text] = path
+        return path
+
+    def submit(self, bundle, content_type="application/zip", header_text=None, timeout=None, job_id=None):
+        """Queue a conversion and return its Job. Raises queue.Full when the queue is full."""
+        job = Job(bundle, content_type, header_text or self.header_text, timeout or self.timeout, job_id)
+        with self._lock:
+            if job.id in self._jobs:
+                raise ValueError(f"Job {job.id} already exists")
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                self._counts["rejected"] += 1
+                raise
+            self._jobs[job.id] = job
+            self._counts["submitted"] += 1
+        return job
+
+    def convert(self, bundle, content_type="application/zip", header_text=None, timeout=None, job_id=None):
+        """Submit a conversion and wait for it to end; returns the finished Job."""
+        job = self.submit(bundle, content_type, header_text, timeout, job_id)
+        return job.wait()
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job. Returns False if there is no such job."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            return False
+        job.cancelled.set()
+        self._drop(job)
+        return True
+
+    def _claim(self, job, status):
+        """Move a queued job to status; returns False if a worker or _drop already took it."""
+        with self._lock:
+            if job.status != "queued":
+                return False
+            job.status = status
+            if status == "running":
+                self._running += 1
+            return True
+
+    def _drop(self, job):
+        """End a queued job that was cancelled or has expired, and take it off the queue."""
+        stopped = job.stopped()
+        if stopped is None or not self._claim(job, stopped[0]):
+            return
+        with self._queue.mutex:
+            try:
+                self._queue.queue.remove(job)
+            except ValueError:
+                pass  # Already taken by a worker, which skips it
+            else:
+                self._queue.not_full.notify()
+        self._finish(job, stopped[0], error=stopped[1])
+
+    def _reap(self):
+        """End queued jobs whose deadline passes while they wait for a worker."""
+        while not self._stopping.wait(POLL_INTERVAL_S):
+            with self._lock:
+                queued = [job for job in self._jobs.values() if job.status == "queued"]
+            for job in queued:
+                self._drop(job)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            self._drop(job)
+            if not self._claim(job, "running"):
+                continue
+            try:
+                self._finish(job, *self._run(job))
+            except ValueError as e:
+                self._finish(job, "failed", error=str(e))
+            except Exception as e:
+                self._finish(job, "failed", error=f"{type(e).__name__}: {e}")
+            finally:
+                with self._lock:
+                    self._running -= 1
+
+    def _run(self, job):
+        folder = tempfile.mkdtemp(dir=self._scratch)
+        try:
+            if job.content_type in MARKDOWN_TYPES:
+                md_files, chapters_file = ["book.md"], None
+                with open(os.path.join(folder, "book.md"), "wb") as f:
+                    f.write(job.bundle)
+            else:
+                extract_bundle(job.bundle, folder)
+                chapters_file = os.path.join(folder, "chapters.txt")
+                if not os.path.exists(chapters_file):
+                    chapters_file = None
+                md_files = sorted(name for name in os.listdir(folder) if name.endswith(".md"))
+                if chapters_file is None and not md_files:
+                    raise ValueError("Bundle has no chapters.txt and no markdown files")
+            trace = BuildTrace("service")
+            items = iter_book_items(md_files=md_files, chapters_file=chapters_file, folder_name=folder,
+                                    reader=bundle_reader(folder))
+            preprocessor = bundle_preprocessor(folder, optimize_images=self.optimize_images,
+                                               cache_dir=self.cache_dir, trace=trace,
+                                               theme=self.theme if self.prehighlight else None)
+            book = io.StringIO()
+            # Preprocessing stops at the next chapter once the job is cancelled or expires
+            write_book_markdown(self._until_stopped(job, items), book, preprocessor, trace)
+            args = pandoc_arguments(folder, self.theme, self.cache_dir)
+            args.append(f"--reference-doc={self.reference_doc(job.header_text)}")
+            stopped = job.stopped()
+            if stopped:
+                return stopped[0], None, stopped[1]
+            return self._pandoc_run(job, book.getvalue().encode("utf-8"), args, folder)
+        except _JobStopped as e:
+            return e.args[0], None, e.args[1]
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    @staticmethod
+    def _until_stopped(job, items):
+        for item in items:
+            stopped = job.stopped()
+            if stopped:
+                raise _JobStopped(*stopped)
+            yield item
+
+    def _pandoc_run(self, job, md, args, folder):
+        """Run pandoc on md and return (status, docx bytes or None, error)."""
+        proc = subprocess.Popen([self._pandoc, "--sandbox", *args, "-t", "docx", "-o", "-"], cwd=folder,
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        data = md
+        while True:
+            try:
+                out, err = proc.communicate(data, timeout=POLL_INTERVAL_S)
+                break
+            except subprocess.TimeoutExpired:
+                data = None
+                stopped = job.stopped()
+                if stopped:
+                    proc.kill()
+                    proc.communicate()
+                    return stopped[0], None, stopped[1]
+        if proc.returncode != 0:
+            return "failed", None, f"Pandoc error: {err.decode('utf-8', 'replace').strip()}"
+        return "done", out, None
+
+    def _finish(self, job, status, result=None, error=None):
+        now = time.monotonic()
+        job.status, job.result, job.error = status, result, error
+        with self._lock:
+            self._jobs.pop(job.id, None)
+            self._counts[status] += 1
+            if status == "done":
+                self._latencies.append(now - job.submitted)
+                self._finished.append(now)
+        job.bundle = None
+        job.done.set()
+
+    def metrics(self):
+        """Return counters, queue depth, throughput and latency percentiles as a dict."""
+        now = time.monotonic()
+        with self._lock:
+            while self._finished and self._finished[0] < now - THROUGHPUT_WINDOW_S:
+                self._finished.popleft()
+            latencies = sorted(self._latencies)
+            metrics = dict(self._counts)
+            metrics.update({
+                "workers": self.workers,
+                "running": self._running,
+                "queued": self._queue.qsize(),
+                "queue_size": self._queue.maxsize,
+                "uptime_s": now - self._started,
+                "docs_per_s": len(self._finished) / min(THROUGHPUT_WINDOW_S, max(now - self._started, 1e-9)),
+            })
+        for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+            index = min(len(latencies) - 1, int(q * len(latencies)))
+            metrics[f"latency_{name}_s"] = latencies[index] if latencies else None
+        return metrics
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """HTTP front end of the ConversionService in self.server.service."""
+
+    protocol_version = "HTTP/1.1"
+    # Largest accepted bundle, in bytes
+    max_bundle = 200 * 1024 * 1024
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, code, body=b"", content_type="application/json", headers=()):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, code, data, headers=()):
+        self._send(code, json.dumps(data).encode("utf-8"), headers=headers)
+
+    def do_GET(self):
+        service = self.server.service
+        path = urlparse(self.path).path
+        if path == "/metrics":
+            self._send_json(200, service.metrics())
+        elif path == "/health":
+            self._send_json(200 if service.ready.is_set() else 503, {"ready": service.ready.is_set()})
+        else:
+            self._send_json(404, {"error": "Not found"})
+
+    def do_DELETE(self):
+        path = urlparse(self.path).path
+        if not path.startswith("/jobs/"):
+            self._send_json(404, {"error": "Not found"})
+        elif self.server.service.cancel(path[len("/jobs/"):]):
+            self._send_json(202, {"cancelled": True})
+        else:
+            self._send_json(404, {"error": "No such job"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/convert":
+            self._send_json(404, {"error": "Not found"})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > self.max_bundle:
+            self.close_connection = True
+            self._send_json(413, {"error": "Bundle too large"})
+            return
+        bundle = self.rfile.read(length)
+        params = parse_qs(url.query)
+        timeout = params.get("timeout")
+        content_type = (self.headers.get("Content-Type") or "application/zip").split(";")[0].strip()
+        try:
+            job = self.server.service.convert(bundle, content_type, header_text=params.get("header_text", [None])[0],
+                                              timeout=float(timeout[0]) if timeout else None,
+                                              job_id=self.headers.get("X-Job-Id"))
+        except queue.Full:
+            self._send_json(503, {"error": "Queue full"}, headers=[("Retry-After", "1")])
+            return
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        job_headers = [("X-Job-Id", job.id)]
+        if job.status == "done":
+            self._send(200, job.result, DOCX_MIME, headers=job_headers)
+        else:
+            code = {"timeout": 504, "cancelled": 409}.get(job.status, 422)
+            self._send_json(code, {"status": job.status, "error": job.error}, headers=job_headers)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ("local", 0)
+
+
+def make_server(service, host="127.0.0.1", port=8765, unix_socket=None):
+    """Return an HTTP server for service on host:port, or on a Unix socket path."""
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = UnixHTTPServer(unix_socket, ServiceHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), ServiceHandler)
+        server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix-socket", metavar="PATH", help="listen on a Unix socket instead of host:port")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="jobs converted at once")
+    parser.add_argument("--queue-size", type=int, default=32, help="jobs that may wait for a worker")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds a job may take, queueing included")
+    parser.add_argument("--reference-docx", help="DOCX template for styling")
+    parser.add_argument("--header-text", default=DEFAULT_HEADER_TEXT, help="default text of the page header")
+    parser.add_argument("--no-optimize-images", dest="optimize_images", action="store_false",
+                        help="embed the original image files")
+    parser.add_argument("--theme", default=PYGMENTS_THEME, help="Pygments style to highlight code blocks in")
+    parser.add_argument("--no-prehighlight", dest="prehighlight", action="store_false",
+                        help="let pandoc highlight code blocks instead of reusing cached ones")
+    args = parser.parse_args()
+
+    service = ConversionService(workers=args.workers, queue_size=args.queue_size, timeout=args.timeout,
+                                reference_docx=args.reference_docx, header_text=args.header_text,
+                                optimize_images=args.optimize_images, theme=args.theme,
+                                prehighlight=args.prehighlight).start()
+    server = make_server(service, args.host, args.port, args.unix_socket)
+    print(f"Serving on {args.unix_socket or f'http://{args.host}:{server.server_address[1]}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+
+
+if __name__ == "__main__":
+    main()
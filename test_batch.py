@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+import batch
+import convert
+
+
+@pytest.fixture(autouse=True)
+def isolated_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("JOPLIN_DOCX_CACHE", str(tmp_path / "docx-cache"))
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    folder = tmp_path / "src"
+    folder.mkdir()
+    for name in ("intro", "tokens", "agents"):
+        (folder / f"{name}.md").write_text(f"# {name.title()}\n\nAbout {name}.\n")
+    (tmp_path / "chapters.txt").write_text("<partname> Part 1\nintro\ntokens\n")
+    (tmp_path / "chapters_new.txt").write_text("<partname> Part 1\nintro\ntokens\nagents\n")
+    path = tmp_path / "books.json"
+    path.write_text(json.dumps({
+        "defaults": {"folder_name": "src", "optimize_images": False},
+        "books": [
+            {"name": "first", "output": "first.docx", "chapters_file": "chapters.txt"},
+            {"name": "second", "output": "second.docx", "chapters_file": "chapters_new.txt"},
+            {"name": "broken", "output": "broken.docx", "chapters_file": "chapters.txt", "strict": True,
+             "md_files": ["missing.md"], "folder_name": "nowhere"},
+        ],
+    }))
+    return path
+
+
+def test_load_manifest_applies_defaults_and_resolves_paths(manifest, tmp_path):
+    books = batch.load_manifest(str(manifest))
+    assert [book["name"] for book in books] == ["first", "second", "broken"]
+    assert books[0]["folder_name"] == str(tmp_path / "src")
+    assert books[1]["output"] == str(tmp_path / "second.docx")
+    assert books[0]["optimize_images"] is False
+
+
+def test_load_manifest_rejects_unknown_options(tmp_path):
+    path = tmp_path / "books.json"
+    path.write_text(json.dumps({"books": [{"output": "a.docx", "chapter_file": "chapters.txt"}]}))
+    with pytest.raises(ValueError, match="chapter_file"):
+        batch.load_manifest(str(path))
+
+
+def test_shared_chapters_render_once(manifest, tmp_path, monkeypatch):
+    rendered = []
+    render_fragment = convert.render_fragment
+    def counting_render(md, *args, **kwargs):
+        rendered.append(md)
+        return render_fragment(md, *args, **kwargs)
+    monkeypatch.setattr(convert, "render_fragment", counting_render)
+    books = batch.load_manifest(str(manifest))
+    results = batch.build_books(books, jobs=2)
+    assert [result["status"] for result in results] == ["ok", "ok", "failed"]
+    assert "missing chapter" in results[2]["error"]
+    assert (tmp_path / "first.docx").exists() and (tmp_path / "second.docx").exists()
+    # One part page and three chapters, although the books list seven items between them
+    assert len(rendered) == len(set(rendered)) == 4
+    assert "2 of 3 books built" in batch.format_results(results)
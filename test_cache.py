@@ -0,0 +1,38 @@
+import os
+
+from cache import DiskCache, hash_parts
+from pandoc_ast import merge_documents
+
+
+def test_prune_evicts_least_recently_used(tmp_path):
+    cache = DiskCache(str(tmp_path), "ast")
+    keys = [hash_parts(i) for i in range(3)]
+    for i, key in enumerate(keys):
+        os.utime(cache.put_bytes(key, b"x" * 100, ".json"), (i, i))
+    # Reading the oldest entry makes it the most recently used
+    cache.get(keys[0], ".json", touch=True)
+    assert cache.stats()["entries"] == 3 and cache.stats()["bytes"] == 300
+    assert cache.prune(150) == 2
+    assert cache.get(keys[0], ".json") and not cache.get(keys[1], ".json") and not cache.get(keys[2], ".json")
+    cache.clear()
+    assert cache.stats()["entries"] == 0
+
+
+def _header(identifier, text="Intro"):
+    return {"t": "Header", "c": [1, [identifier, [], []], [{"t": "Str", "c": text}]]}
+
+
+def test_merge_documents_renumbers_ids_and_merges_meta():
+    # Chapter ids as pandoc gives them, unique within each chapter only
+    docs = [
+        {"pandoc-api-version": [1, 23], "meta": {"title": "A"}, "blocks": [_header("intro")]},
+        {"pandoc-api-version": [1, 23], "meta": {"title": "B", "lang": "en"},
+         "blocks": [_header("intro"), _header("intro-1"), {"t": "Div", "c": [["", [], []], [_header("intro-2")]]},
+                    _header("intro", text="Custom")]},
+    ]
+    merged = merge_documents(docs)
+    assert merged["meta"] == {"title": "A", "lang": "en"}
+    ids = [merged["blocks"][i]["c"][1][0] for i in range(3)] + [merged["blocks"][3]["c"][1][0]["c"][1][0],
+                                                                 merged["blocks"][4]["c"][1][0]]
+    # As in a single pass; the explicit {#intro} is kept as pandoc keeps it
+    assert ids == ["intro", "intro-1", "intro-2", "intro-3", "intro"]
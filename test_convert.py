@@ -1,9 +1,15 @@
 import os
 import tempfile
 import pytest
-import pypandoc
+import pandoc_runner
+import convert
 from convert import convert_markdowns_to_docx
 
+@pytest.fixture(autouse=True)
+def isolated_cache(tmp_path, monkeypatch):
+    # Keep generated templates and fragments out of the user's cache
+    monkeypatch.setenv("JOPLIN_DOCX_CACHE", str(tmp_path / "docx-cache"))
+
 def test_raises_if_no_input(tmp_path):
     with pytest.raises(ValueError):
         convert_markdowns_to_docx()
@@ -15,9 +21,9 @@ def test_combines_md_files(tmp_path, monkeypatch):
     md1.write_text("# Chapter 1\nHello")
     md2.write_text("# Chapter 2\nWorld")
     output_docx = tmp_path / "out.docx"
-    # Patch pypandoc.convert_file to avoid real conversion
+    # Patch pandoc_runner.convert_file to avoid real conversion
     called = {}
-    def fake_convert_file(input_file, to, outputfile=None, extra_args=None):
+    def fake_convert_file(input_file, to, outputfile=None, extra_args=None, cache_dir=None):
         called['input'] = input_file
         called['output'] = outputfile
         called['args'] = extra_args
@@ -32,7 +38,7 @@ def test_combines_md_files(tmp_path, monkeypatch):
         with open(outputfile, "w") as outf:
             outf.write("fake docx")
         return None
-    monkeypatch.setattr(pypandoc, "convert_file", fake_convert_file)
+    monkeypatch.setattr(pandoc_runner, "convert_file", fake_convert_file)
     convert_markdowns_to_docx(md_files=[str(md1), str(md2)], output_file=str(output_docx))
     assert output_docx.exists()
     assert called['output'] == str(output_docx)
@@ -53,7 +59,7 @@ c2.md
 """)
     output_docx = tmp_path / "out2.docx"
     called = {}
-    def fake_convert_file(input_file, to, outputfile=None, extra_args=None):
+    def fake_convert_file(input_file, to, outputfile=None, extra_args=None, cache_dir=None):
         called['input'] = input_file
         called['output'] = outputfile
         with open(input_file, encoding="utf-8") as f:
@@ -64,7 +70,7 @@ c2.md
         with open(outputfile, "w") as outf:
             outf.write("fake docx")
         return None
-    monkeypatch.setattr(pypandoc, "convert_file", fake_convert_file)
+    monkeypatch.setattr(pandoc_runner, "convert_file", fake_convert_file)
     convert_markdowns_to_docx(output_file=str(output_docx), chapters_file=str(chapters_txt), folder_name=str(folder))
     assert output_docx.exists()
     assert called['output'] == str(output_docx)
@@ -73,7 +79,7 @@ def test_image_alt_suppression(tmp_path, monkeypatch):
     md = tmp_path / "img.md"
     md.write_text("![alt text](img.png)")
     output_docx = tmp_path / "img.docx"
-    def fake_convert_file(input_file, to, outputfile=None, extra_args=None):
+    def fake_convert_file(input_file, to, outputfile=None, extra_args=None, cache_dir=None):
         with open(input_file, encoding="utf-8") as f:
             content = f.read()
             assert "![alt text]" not in content
@@ -81,6 +87,363 @@ def test_image_alt_suppression(tmp_path, monkeypatch):
         with open(outputfile, "w") as outf:
             outf.write("fake docx")
         return None
-    monkeypatch.setattr(pypandoc, "convert_file", fake_convert_file)
+    monkeypatch.setattr(pandoc_runner, "convert_file", fake_convert_file)
     convert_markdowns_to_docx(md_files=[str(md)], output_file=str(output_docx))
     assert output_docx.exists()
+
+def _has_pandoc():
+    try:
+        pandoc_runner.get_pandoc_path()
+        return True
+    except OSError:
+        return False
+
+requires_pandoc = pytest.mark.skipif(not _has_pandoc(), reason="pandoc is not installed")
+
+@requires_pandoc
+def test_incremental_rerenders_only_changed_chapters(tmp_path, monkeypatch):
+    from docx import Document
+    folder = tmp_path / "book"
+    folder.mkdir()
+    (folder / "c1.md").write_text("# C1\n\nFirst chapter\n\n1. one\n2. two\n")
+    (folder / "c2.md").write_text("# C2\n\nSecond chapter\n\n1. three\n2. four\n")
+    chapters_txt = tmp_path / "chapters.txt"
+    chapters_txt.write_text("<partname> Part 1\nc1\nc2\n")
+    output_docx = tmp_path / "out.docx"
+    rendered = []
+    real_convert_file = pandoc_runner.convert_file
+    def counting_convert_file(input_file, to, outputfile=None, extra_args=None, cache_dir=None):
+        with open(input_file, encoding="utf-8") as f:
+            rendered.append(f.read())
+        return real_convert_file(input_file, to, outputfile=outputfile, extra_args=extra_args,
+                                 cache_dir=cache_dir)
+    monkeypatch.setattr(pandoc_runner, "convert_file", counting_convert_file)
+    build = lambda: convert_markdowns_to_docx(output_file=str(output_docx), chapters_file=str(chapters_txt),
+                                              folder_name=str(folder), incremental=True,
+                                              cache_dir=str(tmp_path / "cache"))
+    build()
+    assert len(rendered) == 3
+    build()
+    assert len(rendered) == 3
+    (folder / "c2.md").write_text("# C2\n\nSecond chapter, fixed\n\n1. three\n2. four\n")
+    build()
+    assert len(rendered) == 4
+    assert "fixed" in rendered[-1]
+
+    texts = [p.text for p in Document(str(output_docx)).paragraphs]
+    assert texts.index("Part 1") < texts.index("C1") < texts.index("C2")
+    assert "Second chapter, fixed" in texts
+
+@requires_pandoc
+def test_parallel_build_keeps_chapter_order(tmp_path):
+    from docx import Document
+    folder = tmp_path / "book"
+    folder.mkdir()
+    lines = []
+    for i in range(6):
+        (folder / f"c{i}.md").write_text(f"# Chapter {i}\n\nBody {i}\n")
+        if i % 3 == 0:
+            lines.append(f"<partname> Part {i // 3}")
+        lines.append(f"c{i}")
+    chapters_txt = tmp_path / "chapters.txt"
+    chapters_txt.write_text("\n".join(lines))
+    output_docx = tmp_path / "out.docx"
+    convert_markdowns_to_docx(output_file=str(output_docx), chapters_file=str(chapters_txt),
+                              folder_name=str(folder), jobs=4)
+    headings = [p.text for p in Document(str(output_docx)).paragraphs if p.text.startswith(("Part", "Chapter"))]
+    assert headings == ["Part 0", "Chapter 0", "Chapter 1", "Chapter 2", "Part 1", "Chapter 3", "Chapter 4", "Chapter 5"]
+
+@requires_pandoc
+def test_book_filter_page_breaks_and_chapter_title_style(tmp_path):
+    import zipfile
+    from docx import Document
+    md1 = tmp_path / "a.md"
+    md2 = tmp_path / "b.md"
+    md1.write_text("# Opening {.csp-chapter-title}\n\nHello")
+    md2.write_text("# Second\n\nWorld")
+    output_docx = tmp_path / "out.docx"
+    convert_markdowns_to_docx(md_files=[str(md1), str(md2)], output_file=str(output_docx))
+    with zipfile.ZipFile(output_docx) as z:
+        body = z.read("word/document.xml").decode("utf-8")
+    assert body.count('w:type="page"') == 2
+    paragraphs = {p.text: p for p in Document(str(output_docx)).paragraphs}
+    assert paragraphs["Opening"].style.name == "CSP - Chapter Title"
+    assert paragraphs["Second"].style.name == "Heading 1"
+
+@requires_pandoc
+def test_chapter_title_stays_in_the_toc(tmp_path):
+    md = tmp_path / "a.md"
+    md.write_text("# Opening {.csp-chapter-title}\n\nHello\n\n# Second\n\nWorld")
+    output_docx = tmp_path / "out.docx"
+    convert_markdowns_to_docx(md_files=[str(md)], output_file=str(output_docx))
+    # The title's style has an outline level, so readers of the DOCX see a heading
+    html = pandoc_runner.convert_file(str(output_docx), "html", extra_args=["--toc", "--standalone"])
+    toc = html[html.index('<nav id="TOC"'):html.index("</nav>")]
+    assert "Opening" in toc and "Second" in toc
+
+def test_reference_docx_is_cached_per_header_text(tmp_path, monkeypatch):
+    md = tmp_path / "a.md"
+    md.write_text("# A")
+    built = []
+    real_make_reference = convert.make_reference_with_header_footer
+    def counting_make_reference(base_ref, header_text, footer_field=convert.FOOTER_FIELD):
+        built.append(header_text)
+        return real_make_reference(base_ref, header_text, footer_field)
+    monkeypatch.setattr(convert, "make_reference_with_header_footer", counting_make_reference)
+    used_refs = []
+    def fake_convert_file(input_file, to, outputfile=None, extra_args=None, cache_dir=None):
+        used_refs.extend(a.split("=", 1)[1] for a in extra_args if a.startswith("--reference-doc="))
+        with open(outputfile, "w") as outf:
+            outf.write("fake docx")
+    monkeypatch.setattr(pandoc_runner, "convert_file", fake_convert_file)
+    for header in ["Edition A", "Edition A", "Edition B"]:
+        convert_markdowns_to_docx(md_files=[str(md)], output_file=str(tmp_path / "out.docx"), header_text=header)
+    assert built == ["Edition A", "Edition B"]
+    assert used_refs[0] == used_refs[1] != used_refs[2]
+    assert all(os.path.exists(ref) for ref in used_refs)
+
+def test_book_markdown_is_streamed_chapter_by_chapter(tmp_path):
+    import io
+    folder = tmp_path / "chapters"
+    folder.mkdir()
+    (folder / "c1.md").write_text("# C1\n![one](a.png)")
+    (folder / "c2.md").write_text("# C2\nold")
+    chapters_txt = tmp_path / "chapters.txt"
+    chapters_txt.write_text("<partname> Part 1\nc1\nc2\n")
+    items = convert.iter_book_items(chapters_file=str(chapters_txt), folder_name=str(folder))
+    # Chapters are only read when the stream reaches them
+    (folder / "c2.md").write_text("# C2\nnew")
+    out = io.StringIO()
+    written = convert.write_book_markdown(items, out)
+    content = out.getvalue()
+    assert written == len(content)
+    assert content.index("# Part 1") < content.index("# C1") < content.index("# C2\nnew")
+    assert "![&nbsp;](a.png)" in content
+    assert content.count("<!-- PAGEBREAK -->") == 3
+
+@requires_pandoc
+def test_images_are_downsampled_and_deduplicated(tmp_path):
+    import io
+    import zipfile
+    Image = pytest.importorskip("PIL.Image")
+    folder = tmp_path / "book"
+    folder.mkdir()
+    Image.new("RGB", (3840, 2160), (30, 120, 200)).save(folder / "shot.png")
+    (folder / "copy.png").write_bytes((folder / "shot.png").read_bytes())
+    (folder / "c1.md").write_text("# C1\n\n![first](shot.png)\n")
+    (folder / "c2.md").write_text("# C2\n\n![again](copy.png)\n\n`![code](shot.png)`\n")
+    chapters_txt = tmp_path / "chapters.txt"
+    chapters_txt.write_text("c1\nc2\n")
+    output_docx = tmp_path / "out.docx"
+    convert_markdowns_to_docx(output_file=str(output_docx), chapters_file=str(chapters_txt), folder_name=str(folder))
+    with zipfile.ZipFile(output_docx) as z:
+        media = [n for n in z.namelist() if n.startswith("word/media/")]
+        assert len(media) == 1
+        img = Image.open(io.BytesIO(z.read(media[0])))
+    # Pandoc fits the image to the text width, which needs no more pixels than this at 300 dpi
+    assert img.width == 1800
+    assert img.width / img.info["dpi"][0] == pytest.approx(3840 / 96, rel=1e-3)
+
+@requires_pandoc
+def test_optimized_images_keep_their_printed_size(tmp_path):
+    import re
+    import zipfile
+    Image = pytest.importorskip("PIL.Image")
+    folder = tmp_path / "book"
+    folder.mkdir()
+    sizes = [(1100, None), (1300, None), (3840, None), (3840, (600, 600)), (2400, (300, 300))]
+    for i, (width, dpi) in enumerate(sizes):
+        Image.new("RGB", (width, 300), (30, 120, 200)).save(folder / f"{i}.png", **({"dpi": dpi} if dpi else {}))
+    (folder / "c1.md").write_text("# C1\n\n" + "".join(f"![{i}]({i}.png)\n\n" for i in range(len(sizes))))
+
+    def extents(optimize_images):
+        output_docx = tmp_path / f"{optimize_images}.docx"
+        convert_markdowns_to_docx(md_files=["c1.md"], output_file=str(output_docx), folder_name=str(folder),
+                                  optimize_images=optimize_images)
+        with zipfile.ZipFile(output_docx) as z:
+            xml = z.read("word/document.xml").decode("utf-8")
+        return [int(cx) for cx in re.findall(r'<wp:extent cx="(\d+)"', xml)]
+
+    original = extents(False)
+    assert len(original) == len(sizes)
+    assert extents(True) == pytest.approx(original, rel=0.01)
+
+def test_profile_traces_stages(tmp_path, monkeypatch):
+    import json
+    folder = tmp_path / "book"
+    folder.mkdir()
+    (folder / "c1.md").write_text("# C1\n\n![a](a.png)\n\n```python\nx = 1\n```\n")
+    (folder / "c2.md").write_text("# C2\n\n```\n![not an image](b.png)\n```\n")
+    chapters_txt = tmp_path / "chapters.txt"
+    chapters_txt.write_text("c1\nc2\n")
+    output_docx = tmp_path / "out.docx"
+    profile = tmp_path / "trace.json"
+
+    def fake_convert_file(input_file, to, outputfile=None, extra_args=None, cache_dir=None):
+        with open(outputfile, "w") as outf:
+            outf.write("fake docx")
+    monkeypatch.setattr(pandoc_runner, "convert_file", fake_convert_file)
+    seen = []
+    convert_markdowns_to_docx(output_file=str(output_docx), chapters_file=str(chapters_txt),
+                              folder_name=str(folder), profile=str(profile),
+                              on_stage=lambda record: seen.append(record["stage"]))
+    trace = json.loads(profile.read_text())
+    stages = {s["stage"]: s for s in trace["stages"]}
+    assert trace["tool"] == "convert" and trace["error"] is None
+    assert {"read_chapters", "preprocess", "write_markdown", "pandoc"} <= set(stages)
+    assert set(seen) == set(stages)
+    assert stages["read_chapters"]["chapters"] == 2
+    assert stages["preprocess"]["images"] == 1
+    assert stages["preprocess"]["code_blocks"] == 2
+    assert stages["pandoc"]["bytes_written"] == len("fake docx")
+    assert trace["total"]["chapters"] == 2
+    assert trace["total"]["wall_s"] >= stages["pandoc"]["wall_s"]
+
+def test_convert_to_docx_in_memory(tmp_path, monkeypatch):
+    import io
+    import zipfile
+    from benchmarks.synthbook import write_png
+    write_png(str(tmp_path / "fig.png"), 40, 30, 1)
+    png = (tmp_path / "fig.png").read_bytes()
+    # Warm the template and pandoc info caches so the conversion itself must not touch temp files
+    convert.cached_reference_docx(None, convert.DEFAULT_HEADER_TEXT)
+    pandoc_runner.pandoc_info()
+    def no_temp_files(*args, **kwargs):
+        raise AssertionError("temp file created")
+    monkeypatch.setattr(tempfile, "NamedTemporaryFile", no_temp_files)
+    monkeypatch.setattr(tempfile, "mkstemp", no_temp_files)
+
+    def chapters():
+        yield "# One\n\n![fig](_resources/fig.png)\n"
+        yield b"# Two\n\nBytes chapter."
+        yield io.StringIO("# Three\n\n![fig again](./_resources/fig.png)\n")
+    docx = convert.convert_to_docx(chapters(), images={"_resources/fig.png": png})
+    with zipfile.ZipFile(io.BytesIO(docx)) as archive:
+        xml = archive.read("word/document.xml").decode("utf-8")
+        media = [name for name in archive.namelist() if name.startswith("word/media/")]
+    assert "Bytes chapter." in xml and "Three" in xml
+    assert len(media) == 1
+
+    out = io.BytesIO()
+    assert convert.convert_to_docx(["# Only"], output=out) == len(out.getvalue()) > 0
+
+def test_convert_to_docx_errors(monkeypatch):
+    with pytest.raises(ValueError):
+        convert.convert_to_docx([42])
+    monkeypatch.setattr(pandoc_runner, "get_pandoc_path", lambda cache_dir=None: "false")
+    with pytest.raises(RuntimeError, match="Pandoc error"):
+        convert.convert_to_docx(["# Fails"])
+
+def test_ast_cache_matches_single_pass(tmp_path, monkeypatch):
+    import zipfile
+    folder = tmp_path / "book"
+    folder.mkdir()
+    (folder / "c1.md").write_text("# Setup\n\nFirst.\n\n## Summary\n\nDone.\n")
+    (folder / "c2.md").write_text("# Setup {.csp-chapter-title}\n\nSecond.\n\n## Summary\n\nDone again.\n")
+    chapters_txt = tmp_path / "chapters.txt"
+    chapters_txt.write_text("<partname> Part 1\nc1\nc2\n")
+    def build(name, **kwargs):
+        convert_markdowns_to_docx(output_file=str(tmp_path / name), chapters_file=str(chapters_txt),
+                                  folder_name=str(folder), **kwargs)
+        with zipfile.ZipFile(tmp_path / name) as archive:
+            return archive.read("word/document.xml")
+    single = build("single.docx")
+    assert build("ast.docx", ast_cache=True) == single
+    assert b'w:name="summary-1"' in single
+
+    parsed = []
+    parse_chapter = convert.parse_chapter
+    monkeypatch.setattr(convert, "parse_chapter", lambda md, *args, **kwargs: parsed.append(md) or
+                        parse_chapter(md, *args, **kwargs))
+    (folder / "c2.md").write_text("# Setup {.csp-chapter-title}\n\nChanged.\n")
+    assert b"Changed." in build("ast2.docx", ast_cache=True, jobs=2)
+    assert len(parsed) == 1 and "Changed." in parsed[0]
+
+
+
+def test_ast_cache_ids_match_single_pass_with_suffixed_chapters(tmp_path):
+    import json
+    import zipfile
+    from pandoc_ast import merge_documents
+    chapters = [
+        "# Example\n\n# Summary\n\n# Step 1\n",
+        "# Example\n\nA\n\n# Example\n\n[the second](#example-1)\n\n# Summary\n\n# Step\n\n# Step\n",
+        "# 1. Intro *to* `code`\n\n# Summary {#custom}\n\n# Title {.csp-chapter-title}\n\n> # Summary\n\n# Example-1\n",
+        "# Summary\n\n# Title {.csp-chapter-title}\n\n# Custom\n",
+    ]
+    def parse(md):
+        return json.loads(pandoc_runner.convert_text(md, "json", format=convert.READER,
+                                                     extra_args=convert.filter_arguments()))
+    assert merge_documents([parse(md) for md in chapters])["blocks"] == parse("\n\n".join(chapters))["blocks"]
+
+    folder = tmp_path / "book"
+    folder.mkdir()
+    (folder / "c1.md").write_text("# Example\n\nOne.\n")
+    (folder / "c2.md").write_text("# Example\n\nTwo.\n\n# Example\n\n[the second](#example-1)\n")
+    chapters_txt = tmp_path / "chapters.txt"
+    chapters_txt.write_text("c1\nc2\n")
+    documents = []
+    for name, kwargs in (("single.docx", {}), ("ast.docx", {"ast_cache": True})):
+        convert_markdowns_to_docx(output_file=str(tmp_path / name), chapters_file=str(chapters_txt),
+                                  folder_name=str(folder), **kwargs)
+        with zipfile.ZipFile(tmp_path / name) as archive:
+            documents.append(archive.read("word/document.xml"))
+    assert documents[1] == documents[0]
+    assert b'w:name="example-2"' in documents[0]
+
+def test_code_blocks_are_prehighlighted_and_cached(tmp_path, monkeypatch):
+    import zipfile
+    import code_blocks
+    md = tmp_path / "code.md"
+    md.write_text("Intro.\n\n```python\ndef f(x):\n    return x < 1\n```\n\n- item\n\n  ```js\n  let a = 1;\n  ```\n")
+    convert_markdowns_to_docx(md_files=[str(md)], output_file=str(tmp_path / "a.docx"), theme="monokai")
+    with zipfile.ZipFile(tmp_path / "a.docx") as archive:
+        document = archive.read("word/document.xml").decode()
+        styles = archive.read("word/styles.xml").decode()
+    assert document.count('w:fill="272822"') == 2 and ">&lt;<" in document
+    assert '<w:t xml:space="preserve">let</w:t>' in document  # list indentation stripped
+    assert 'w:styleId="SourceCode"' in styles
+
+    highlighted = []
+    code_block_xml = code_blocks.code_block_xml
+    monkeypatch.setattr(code_blocks, "code_block_xml", lambda *args: highlighted.append(args) or
+                        code_block_xml(*args))
+    md.write_text(md.read_text().replace("Intro.", "Changed prose."))
+    convert_markdowns_to_docx(md_files=[str(md)], output_file=str(tmp_path / "b.docx"), theme="monokai")
+    assert highlighted == []
+    with pytest.raises(ValueError):
+        convert_markdowns_to_docx(md_files=[str(md)], output_file=str(tmp_path / "c.docx"), theme="no-such-style")
+
+
+def test_cli_dry_run_and_build(tmp_path, monkeypatch, capsys):
+    md = tmp_path / "note.md"
+    md.write_text("# Note\n\nText.\n")
+    output = tmp_path / "note.docx"
+    monkeypatch.setattr(pandoc_runner, "convert_file", lambda *args, **kwargs: pytest.fail("pandoc ran"))
+    assert convert.main([str(md), "-o", str(output), "--dry-run"]) == 0
+    out = capsys.readouterr().out
+    assert "Checked 1 chapters" in out and "-t docx -o " + str(output) in out
+    assert convert.main(["--dry-run", "--chapters-file", str(tmp_path / "missing.txt")]) == 1
+
+    monkeypatch.undo()
+    monkeypatch.setenv("JOPLIN_DOCX_CACHE", str(tmp_path / "docx-cache"))
+    assert convert.main([str(md), "-o", str(output), "--no-prehighlight"]) == 0
+    assert output.exists()
+
+def test_preflight_only_runs_for_strict_builds(tmp_path, monkeypatch, capsys):
+    (tmp_path / "c1.md").write_text("# C1\n")
+    chapters_txt = tmp_path / "chapters.txt"
+    chapters_txt.write_text("c1\nmissing\n")
+
+    def fake_convert_file(input_file, to, outputfile=None, extra_args=None, cache_dir=None):
+        with open(outputfile, "w") as outf:
+            outf.write("fake docx")
+    monkeypatch.setattr(pandoc_runner, "convert_file", fake_convert_file)
+    trace = convert_markdowns_to_docx(output_file=str(tmp_path / "out.docx"), chapters_file=str(chapters_txt),
+                                      folder_name=str(tmp_path))
+    assert "preflight" not in trace.stages
+    assert trace.stages["read_chapters"]["chapters"] == 1
+    assert "chapter file not found" in capsys.readouterr().out
+    with pytest.raises(ValueError):
+        convert_markdowns_to_docx(output_file=str(tmp_path / "out.docx"), chapters_file=str(chapters_txt),
+                                  folder_name=str(tmp_path), strict=True)
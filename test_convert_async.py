@@ -0,0 +1,163 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+import pandoc_runner
+from convert_async import ConversionError, ConversionTimeout, PreflightError, convert_markdowns_to_docx_async
+from convert import read_chapter
+
+
+@pytest.fixture(autouse=True)
+def isolated_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("JOPLIN_DOCX_CACHE", str(tmp_path / "docx-cache"))
+
+
+@pytest.fixture
+def book(tmp_path):
+    folder = tmp_path / "book"
+    folder.mkdir()
+    for i in range(1, 4):
+        (folder / f"c{i}.md").write_text(f"# Chapter {i}\n\nText {i}.\n\n```python\nx = {i}\n```\n")
+    chapters = tmp_path / "chapters.txt"
+    chapters.write_text("<partname> Part 1\nc1\nc2\nc3\n")
+    return folder, chapters
+
+
+def _fake_pandoc(tmp_path, monkeypatch, script):
+    path = tmp_path / "fake-pandoc"
+    path.write_text("#!/bin/sh\n" + script + "\n")
+    path.chmod(0o755)
+    monkeypatch.setattr(pandoc_runner, "get_pandoc_path", lambda cache_dir=None: str(path))
+
+
+def test_chapters_stream_into_pandoc_while_later_ones_are_read(book, tmp_path, monkeypatch):
+    from docx import Document
+    folder, chapters = book
+    pandoc_started = threading.Event()
+    create_subprocess_exec = asyncio.create_subprocess_exec
+
+    async def recording_exec(*args, **kwargs):
+        proc = await create_subprocess_exec(*args, **kwargs)
+        pandoc_started.set()
+        return proc
+
+    def reader(path):
+        # The last chapter is only read once pandoc is running
+        if path.endswith("c3.md"):
+            assert pandoc_started.wait(10), "pandoc did not start before the last chapter was read"
+        return read_chapter(path)
+
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", recording_exec)
+    output = tmp_path / "out.docx"
+    trace = asyncio.run(convert_markdowns_to_docx_async(chapters_file=str(chapters), folder_name=str(folder),
+                                                        output_file=str(output), reader=reader, timeout=60))
+    texts = [p.text for p in Document(str(output)).paragraphs]
+    assert texts.index("Part 1") < texts.index("Chapter 1") < texts.index("Chapter 3")
+    assert trace.error is None
+    assert {"reference_docx", "read_chapters", "preprocess", "write_markdown", "pandoc"} <= set(trace.stages)
+    assert trace.stages["read_chapters"]["chapters"] == 3
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+
+def test_many_conversions_share_one_loop(book, tmp_path):
+    folder, chapters = book
+
+    async def convert_all():
+        return await asyncio.gather(*[
+            convert_markdowns_to_docx_async(chapters_file=str(chapters), folder_name=str(folder),
+                                            output_file=str(tmp_path / f"out{i}.docx"))
+            for i in range(3)])
+
+    traces = asyncio.run(convert_all())
+    assert all(trace.error is None for trace in traces)
+    assert all((tmp_path / f"out{i}.docx").stat().st_size > 0 for i in range(3))
+
+
+def test_pandoc_failure_raises_conversion_error(book, tmp_path, monkeypatch):
+    folder, chapters = book
+    _fake_pandoc(tmp_path, monkeypatch, "cat > /dev/null; echo 'unknown option --nope' >&2; exit 3")
+    output = tmp_path / "out.docx"
+    output.write_bytes(b"previous build")
+    with pytest.raises(ConversionError, match="unknown option") as info:
+        asyncio.run(convert_markdowns_to_docx_async(chapters_file=str(chapters), folder_name=str(folder),
+                                                    output_file=str(output)))
+    assert info.value.stage == "pandoc" and info.value.returncode == 3
+    assert info.value.trace.error.startswith("Pandoc error")
+    assert output.read_bytes() == b"previous build"
+
+
+def test_read_and_preprocess_errors_name_the_chapter(book, tmp_path, monkeypatch):
+    import convert_async
+    folder, chapters = book
+    output = tmp_path / "out.docx"
+    convert = lambda: convert_markdowns_to_docx_async(chapters_file=str(chapters), folder_name=str(folder),
+                                                      output_file=str(output))
+    (folder / "c2.md").write_bytes(b"# Chapter 2\n\n\xff\xfe\n")
+    with pytest.raises(ConversionError, match="Could not read") as info:
+        asyncio.run(convert())
+    assert info.value.stage == "read" and info.value.path == str(folder / "c2.md")
+    assert isinstance(info.value.__cause__, UnicodeDecodeError)
+    assert info.value.trace.error.startswith("Could not read")
+
+    (folder / "c2.md").write_text("# Chapter 2\n")
+    preprocess_item = convert_async.preprocess_item
+
+    def failing_preprocess(item, *args):
+        if item.get("path", "").endswith("c3.md"):
+            raise OSError("image unreadable")
+        return preprocess_item(item, *args)
+
+    monkeypatch.setattr(convert_async, "preprocess_item", failing_preprocess)
+    with pytest.raises(ConversionError, match="image unreadable") as info:
+        asyncio.run(convert())
+    assert info.value.stage == "preprocess" and info.value.path == str(folder / "c3.md")
+    assert not output.exists()
+
+def test_timeout_and_cancel_kill_pandoc(book, tmp_path, monkeypatch):
+    folder, chapters = book
+    pids = tmp_path / "pids"
+    _fake_pandoc(tmp_path, monkeypatch, f"echo $$ >> {pids}; exec sleep 30")
+    convert = lambda: convert_markdowns_to_docx_async(chapters_file=str(chapters), folder_name=str(folder),
+                                                      output_file=str(tmp_path / "out.docx"), timeout=0.5)
+    started = time.perf_counter()
+    with pytest.raises(ConversionTimeout) as info:
+        asyncio.run(convert())
+    assert isinstance(info.value, TimeoutError) and info.value.stage == "timeout"
+    assert time.perf_counter() - started < 10
+
+    async def cancel_soon():
+        task = asyncio.ensure_future(convert())
+        while not pids.exists() or len(pids.read_text().split()) < 2:
+            await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_soon())
+    for pid in pids.read_text().split():
+        with pytest.raises(ProcessLookupError):
+            os.kill(int(pid), 0)
+    assert not (tmp_path / "out.docx").exists()
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+
+def test_only_strict_builds_run_preflight(book, tmp_path, monkeypatch):
+    import convert_async
+    folder, chapters = book
+    chapters.write_text("c1\nc9\n")
+    monkeypatch.setattr(convert_async, "preflight", lambda **kwargs: pytest.fail("preflight ran"))
+    trace = asyncio.run(convert_markdowns_to_docx_async(chapters_file=str(chapters), folder_name=str(folder),
+                                                        output_file=str(tmp_path / "out.docx")))
+    assert trace.error is None and "preflight" not in trace.stages
+    assert (tmp_path / "out.docx").stat().st_size > 0
+
+def test_strict_preflight_error(book, tmp_path):
+    folder, chapters = book
+    chapters.write_text("c1\nc9\n")
+    with pytest.raises(PreflightError, match="missing chapter: c9") as info:
+        asyncio.run(convert_markdowns_to_docx_async(chapters_file=str(chapters), folder_name=str(folder),
+                                                    output_file=str(tmp_path / "out.docx"), strict=True))
+    assert isinstance(info.value, ValueError) and not info.value.report.ok
@@ -0,0 +1,268 @@
+from docx import Document
+from docx.oxml.ns import qn
+from pygments.token import Token
+
+import highlight
+from convert_old import add_code_block
+from highlight import highlight_lines, tokenize_lines, lexer_for
+
+CODE = '''def add(a, b):
+    """Return
+    the sum."""
+    return a + b
+'''
+
+
+def test_multiline_tokens_are_split_into_lines():
+    lines = highlight_lines(CODE, language="python")
+    assert len(lines) == 4
+    assert ["".join(run[0] for run in line) for line in lines] == CODE.splitlines()
+    # The docstring keeps its style on every line it spans
+    doc_styles = {run[1:] for line in lines[0:3] for run in line if '"""' in run[0] or "sum" in run[0]}
+    assert len(doc_styles) == 1
+
+
+def test_highlight_uses_theme_colors():
+    lines = highlight_lines("x = 1\n", language="python", theme="friendly")
+    runs = {text: style for text, *style in lines[0]}
+    assert runs["="] == [(0x66, 0x66, 0x66), False, False]  # #666 shorthand in the theme
+    assert runs[" "] == [None, False, False]
+
+
+def test_highlight_is_cached_by_language_theme_and_code():
+    highlight.clear_cache()
+    first = highlight_lines(CODE, language="python")
+    assert highlight_lines(CODE, language="python") is first
+    assert highlight_lines(CODE, language="python", theme="monokai") is not first
+    assert lexer_for("python") is lexer_for("python")
+
+
+def test_unknown_language_falls_back_to_plain_text():
+    lines = tokenize_lines("a = 1\n", lexer_for("no-such-language"))
+    assert lines == ((("a = 1", None, False, False),),)
+
+
+def test_unknown_token_types_inherit_parent_style():
+    styles = highlight.theme_styles("friendly")
+    custom = Token.Keyword.SomethingNew
+    assert highlight._token_style(styles, custom) == styles[Token.Keyword]
+
+
+def test_add_code_block_renders_one_row_per_line():
+    document = Document()
+    add_code_block(document, CODE, language="python")
+    table = document.tables[0]
+    assert len(table.rows) == 4
+    assert [row.cells[0].text for row in table.rows] == ["1", "2", "3", "4"]
+    assert table.rows[3].cells[1].text == "    return a + b"
+    keyword = table.rows[0].cells[1].paragraphs[0].runs[0]
+    assert keyword.text == "def" and keyword.bold
+
+
+def test_compact_code_block_is_one_styled_paragraph():
+    document = Document()
+    add_code_block(document, CODE + "x = '<&>'\n", language="python", code_style="compact")
+    add_code_block(document, "print(1)\n", language="python", code_style="compact")
+    assert not document.tables
+    first, second = document.paragraphs
+    assert first.style.name == "Code Block" and second.style.name == "Code Block"
+    assert first.text.splitlines() == ["1  def add(a, b):", '2      """Return', '3      the sum."""',
+                                       "4      return a + b", "5  x = '<&>'"]
+    numbers = [run for run in first.runs if run.style.name == "Code Line Number"]
+    assert len(numbers) == 5
+    # The shared styles are added once, not per block
+    assert [s.name for s in document.styles].count("Code Block") == 1
+
+
+def test_compact_code_block_without_line_numbers():
+    document = Document()
+    add_code_block(document, CODE, language="python", code_style="compact", line_numbers=False)
+    assert document.paragraphs[0].text.splitlines()[0] == "def add(a, b):"
+
+
+def test_unknown_code_style_raises():
+    import pytest
+    with pytest.raises(ValueError):
+        add_code_block(Document(), CODE, code_style="fancy")
+
+
+def _html_table(md):
+    import markdown
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(markdown.markdown(md, extensions=["tables"]), "html.parser").find("table")
+
+
+def test_add_table_keeps_headers_inline_formatting_and_alignment():
+    from convert_old import add_table
+    document = Document()
+    table = add_table(document, _html_table(
+        "| Name | **Value** |\n|:-----|------:|\n| `x` | *one* |\n| y | 2 |\n"))
+    assert [[cell.text for cell in row.cells] for row in table.rows] == [["Name", "Value"], ["x", "one"], ["y", "2"]]
+    header = table.rows[0]
+    assert header._tr.trPr is not None and header._tr.trPr.find(qn("w:tblHeader")) is not None
+    assert all(run.bold for cell in header.cells for run in cell.paragraphs[0].runs)
+    code_run = table.rows[1].cells[0].paragraphs[0].runs[0]
+    assert code_run.font.name == "Courier New"
+    assert table.rows[1].cells[1].paragraphs[0].runs[0].italic
+    assert table.rows[2].cells[1].paragraphs[0].alignment == 2
+
+
+def test_add_table_pads_ragged_rows_and_spans_columns():
+    from bs4 import BeautifulSoup
+    from convert_old import add_table
+    html = ("<table><tr><th>a</th><th>b</th><th>c</th></tr>"
+            "<tr><td colspan='2'>wide</td><td>z</td></tr>"
+            "<tr><td>short</td></tr></table>")
+    document = Document()
+    table = add_table(document, BeautifulSoup(html, "html.parser").find("table"))
+    trs = table._tbl.tr_lst
+    assert [len(tr.tc_lst) for tr in trs] == [3, 2, 3]
+    assert trs[1].tc_lst[0].grid_span == 2
+    assert [cell.text for cell in table.rows[2].cells] == ["short", "", ""]
+
+
+def test_stream_backend_matches_python_docx_backend(tmp_path):
+    import zipfile
+    from lxml import etree
+    import convert_old
+    from benchmarks.synthbook import write_book
+    chapters_file = write_book(str(tmp_path / "book"), chapters=3, paragraphs=3, code_blocks=1, tables=1,
+                               lists=1, images=2, image_size=(40, 20))
+    documents = {}
+    for backend in ("python-docx", "stream"):
+        output = tmp_path / f"{backend}.docx"
+        convert_old.convert_markdowns_to_docx(output_file=str(output), chapters_file=chapters_file,
+                                              folder_name=str(tmp_path / "book"), backend=backend)
+        with zipfile.ZipFile(output) as z:
+            documents[backend] = (sorted(z.namelist()), etree.tostring(
+                etree.fromstring(z.read("word/document.xml")), method="c14n"))
+    assert documents["stream"] == documents["python-docx"]
+
+
+def test_stream_writer_discards_output_on_failure(tmp_path):
+    from docx_stream import StreamingDocxWriter
+    output = tmp_path / "out.docx"
+    writer = StreamingDocxWriter(str(output))
+    writer.document.add_paragraph("partial")
+    writer.flush()
+    writer.abort()
+    assert list(tmp_path.iterdir()) == []
+
+
+LISTS_MD = """1. one
+2. two
+    1. nested
+    2. nested again
+        - deep bullet
+
+Between.
+
+- bullet
+
+After.
+
+3. three
+4. four
+"""
+
+
+def test_lists_share_definitions_and_restart_with_overrides():
+    from convert_old import add_markdown_content
+    document = Document()
+    numbering = document.part.numbering_part.element
+    abstracts_before = len(numbering.findall(qn("w:abstractNum")))
+    for _ in range(20):
+        add_markdown_content(document, LISTS_MD)
+    assert len(numbering.findall(qn("w:abstractNum"))) == abstracts_before + 2
+    # No blank paragraphs are inserted to force restarts
+    assert all(p.text for p in document.paragraphs)
+    items = [p for p in document.paragraphs if p._p.pPr is not None and p._p.pPr.numPr is not None]
+    levels = [int(p._p.pPr.numPr.ilvl.val) for p in items[:6]]
+    assert levels == [0, 0, 1, 1, 2, 0]
+    num_ids = [p._p.pPr.numPr.numId.val for p in items[:8]]
+    # Each ordered list restarts on its own num; bullets share one
+    assert num_ids[0] == num_ids[1] != num_ids[2] == num_ids[3]
+    assert num_ids[4] == num_ids[5]
+    assert num_ids[6] not in num_ids[:4]
+    restart = numbering.xpath(f'./w:num[@w:numId="{num_ids[6]}"]/w:lvlOverride/w:startOverride/@w:val')
+    assert restart == ["1"]
+
+
+def test_ordered_list_start_attribute():
+    from bs4 import BeautifulSoup
+    from convert_old import process_list
+    document = Document()
+    process_list(document, BeautifulSoup('<ol start="7"><li>seven</li></ol>', "html.parser").ol)
+    num_id = document.paragraphs[0]._p.pPr.numPr.numId.val
+    numbering = document.part.numbering_part.element
+    assert numbering.xpath(f'./w:num[@w:numId="{num_id}"]/w:lvlOverride/w:startOverride/@w:val') == ["7"]
+
+
+def test_numbering_is_deterministic_across_builds(tmp_path):
+    import zipfile
+    import convert_old
+    (tmp_path / "a.md").write_text(LISTS_MD)
+    outputs = []
+    for n in range(2):
+        output = tmp_path / f"out{n}.docx"
+        convert_old.convert_markdowns_to_docx(md_files=["a.md"], chapters_file=None, folder_name=str(tmp_path),
+                                              output_file=str(output))
+        with zipfile.ZipFile(output) as z:
+            outputs.append((z.read("word/numbering.xml"), z.read("word/document.xml")))
+    assert outputs[0] == outputs[1]
+
+
+def test_parallel_build_matches_serial_build(tmp_path):
+    import zipfile
+    import pytest
+    import convert_old
+    from benchmarks.synthbook import write_book
+    book = str(tmp_path / "book")
+    chapters_file = write_book(book, chapters=5, chapters_per_part=2, paragraphs=2, code_blocks=1, tables=1,
+                               lists=2, images=2, image_size=(40, 20))
+    for backend in ("python-docx", "stream"):
+        parts = []
+        for jobs in (1, 2):
+            output = tmp_path / f"{backend}-{jobs}.docx"
+            convert_old.convert_markdowns_to_docx(output_file=str(output), chapters_file=chapters_file,
+                                                  folder_name=book, code_style="compact", backend=backend,
+                                                  jobs=jobs)
+            with zipfile.ZipFile(output) as z:
+                parts.append([(name, z.read(name)) for name in z.namelist()])
+        assert parts[1] == parts[0]
+    with pytest.raises(ValueError):
+        convert_old.convert_markdowns_to_docx(md_files=["a.md"], chapters_file=None, jobs=0)
+
+
+def test_trace_counts_images_and_code_blocks(tmp_path):
+    import convert_old
+    from benchmarks.synthbook import write_book
+    book = str(tmp_path / "book")
+    chapters_file = write_book(book, chapters=6, paragraphs=2, code_blocks=2, images=1, image_size=(40, 20))
+    image = next((tmp_path / "book").rglob("*.png")).relative_to(tmp_path / "book").as_posix()
+    (tmp_path / "book" / "list.md").write_text(f"- item\n- ![x]({image})\n\n```python\nx = 1\n```\n")
+    with open(chapters_file, "a", encoding="utf-8") as f:
+        f.write("\nlist\n")
+    for jobs in (1, 2):
+        stages = {}
+        convert_old.convert_markdowns_to_docx(output_file=str(tmp_path / f"out{jobs}.docx"),
+                                              chapters_file=chapters_file, folder_name=book, jobs=jobs,
+                                              on_stage=lambda record: stages.__setitem__(record["stage"], record))
+        totals = {counter: sum(record[counter] for record in stages.values())
+                  for counter in ("chapters", "images", "code_blocks")}
+        assert totals == {"chapters": 7, "images": 7, "code_blocks": 13}
+
+
+def test_optimized_list_images_keep_their_printed_size(tmp_path, monkeypatch):
+    from bs4 import BeautifulSoup
+    from PIL import Image
+    from convert_old import process_list
+    monkeypatch.setenv("JOPLIN_DOCX_CACHE", str(tmp_path / "docx-cache"))
+    Image.new("RGB", (3840, 300), (30, 120, 200)).save(tmp_path / "shot.png", dpi=(600, 600))
+    widths = []
+    for optimize_images in (False, True):
+        document = Document()
+        process_list(document, BeautifulSoup('<ul><li><img src="shot.png"></li></ul>', "html.parser").ul,
+                     folder_name=str(tmp_path), optimize_images=optimize_images)
+        widths.append(document.inline_shapes[0].width)
+    assert widths[0] == widths[1]
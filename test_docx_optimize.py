@@ -0,0 +1,65 @@
+import zipfile
+
+from docx import Document
+from lxml import etree
+
+import convert_old
+import pandoc_runner
+from benchmarks.synthbook import write_png
+from docx_optimize import RELS_NS, optimize_docx
+
+
+def _with_orphan(path):
+    """Add a part nothing refers to, with a content type override, as some editors leave behind."""
+    with zipfile.ZipFile(path) as archive:
+        parts = {name: archive.read(name) for name in archive.namelist()}
+    parts["[Content_Types].xml"] = parts["[Content_Types].xml"].replace(
+        b"</Types>", b'<Override PartName="/word/orphan.xml" ContentType="application/xml"/></Types>')
+    parts["word/orphan.xml"] = b"<orphan/>"
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, data in parts.items():
+            archive.writestr(name, data)
+
+
+def test_optimize_dedupes_media_and_drops_unused_parts_and_styles(tmp_path):
+    write_png(str(tmp_path / "a.png"), 60, 40, 3)
+    (tmp_path / "b.png").write_bytes((tmp_path / "a.png").read_bytes())
+    source = tmp_path / "book.md"
+    source.write_text("# Title\n\n![](a.png)\n\nText.\n\n![](b.png)\n")
+    docx = tmp_path / "book.docx"
+    pandoc_runner.convert_file(str(source), "docx", outputfile=str(docx), extra_args=["--resource-path", str(tmp_path)])
+    _with_orphan(str(docx))
+
+    report = optimize_docx(str(docx), str(tmp_path / "small.docx"), compress_level=9)
+    assert report["media_deduped"] == 1
+    assert report["parts_dropped"] == 1
+    assert report["styles_dropped"] > 0
+    assert report["bytes_saved"] == report["bytes_before"] - report["bytes_after"] > 0
+
+    with zipfile.ZipFile(tmp_path / "small.docx") as archive:
+        names = archive.namelist()
+        rels = etree.fromstring(archive.read("word/_rels/document.xml.rels"))
+        styles = archive.read("word/styles.xml")
+        content_types = archive.read("[Content_Types].xml")
+    assert names[0] == "[Content_Types].xml"
+    assert len([name for name in names if name.startswith("word/media/")]) == 1
+    targets = [rel.get("Target") for rel in rels.iter(f"{{{RELS_NS}}}Relationship") if "media/" in rel.get("Target")]
+    assert len(targets) == 2 and len(set(targets)) == 1
+    assert "word/orphan.xml" not in names and b"orphan" not in content_types
+    # Used styles and the styles they are based on stay
+    assert b'w:styleId="Heading1"' in styles and b'w:styleId="Normal"' in styles
+    assert b'w:styleId="Heading9"' not in styles
+    assert len(Document(str(tmp_path / "small.docx")).inline_shapes) == 2
+    assert "Text." in pandoc_runner.convert_file(str(tmp_path / "small.docx"), "plain")
+
+
+def test_convert_old_optimizes_output(tmp_path):
+    (tmp_path / "a.md").write_text("# A\n\nSome text.\n")
+    output = tmp_path / "out.docx"
+    stages = []
+    convert_old.convert_markdowns_to_docx(md_files=["a.md"], chapters_file=None, folder_name=str(tmp_path),
+                                          output_file=str(output), optimize_output=True, compress_level=9,
+                                          on_stage=lambda record: stages.append(record))
+    optimize = [record for record in stages if record["stage"] == "optimize_docx"][-1]
+    assert optimize["bytes_written"] == output.stat().st_size < optimize["bytes_read"]
+    assert Document(str(output)).paragraphs[0].text == "A"
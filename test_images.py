@@ -0,0 +1,34 @@
+import io
+import random
+
+import pytest
+from PIL import Image
+
+from images import MAX_WIDTH_CM, optimize_image_bytes, target_width_px
+
+
+def png(width, height, noisy=False, dpi=None):
+    img = Image.new("RGB", (width, height), (200, 100, 50))
+    if noisy:
+        rng = random.Random(0)
+        img.putdata([(rng.randrange(256), rng.randrange(256), rng.randrange(256)) for _ in range(width * height)])
+    out = io.BytesIO()
+    img.save(out, "PNG", **({"dpi": dpi} if dpi else {}))
+    return out.getvalue()
+
+
+def test_dpi_only_changes_when_downsampling():
+    # Whether recompression saves bytes must not change the printed size
+    for noisy in (False, True):
+        img = Image.open(io.BytesIO(optimize_image_bytes(png(600, 400, noisy, dpi=(96, 96)))))
+        assert img.size == (600, 400)
+        assert round(img.info["dpi"][0]) == 96
+    img = Image.open(io.BytesIO(optimize_image_bytes(png(300, 200, noisy=True))))
+    assert "dpi" not in img.info
+    # A downsampled image keeps its printed size unless the caller pins its width
+    img = Image.open(io.BytesIO(optimize_image_bytes(png(2000, 400, dpi=(96, 96)))))
+    assert img.width == target_width_px(MAX_WIDTH_CM)
+    assert img.width / img.info["dpi"][0] == pytest.approx(2000 / 96, rel=1e-3)
+    img = Image.open(io.BytesIO(optimize_image_bytes(png(2000, 400, dpi=(96, 96)), width_cm=10)))
+    assert img.width == target_width_px(10)
+    assert round(img.info["dpi"][0]) == 300
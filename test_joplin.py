@@ -0,0 +1,99 @@
+import os
+import tarfile
+
+import pytest
+
+import convert
+from joplin import JoplinIndex, parse_item, safe_filename
+
+NOTE_ID = "a" * 32
+OTHER_NOTE_ID = "b" * 32
+RESOURCE_ID = "c" * 32
+FOLDER_ID = "d" * 32
+
+
+def _note(note_id, title, body, **extra):
+    props = {"id": note_id, "parent_id": FOLDER_ID, "is_conflict": "0", "type_": "1", **extra}
+    return f"{title}\n\n{body}\n\n" + "\n".join(f"{k}: {v}" for k, v in props.items())
+
+
+ITEMS = {
+    f"{NOTE_ID}.md": _note(NOTE_ID, "Chapter 2: LLM Fundamentals",
+                           f"## Tokens\n\n![diagram](:/{RESOURCE_ID})\n\n```\n![kept](:/{RESOURCE_ID})\n```"),
+    f"{OTHER_NOTE_ID}.md": _note(OTHER_NOTE_ID, "Deleted chapter", "gone", deleted_time="1700000000000"),
+    f"{FOLDER_ID}.md": f"Book\n\nid: {FOLDER_ID}\ntype_: 2",
+    f"{RESOURCE_ID}.md": f"diagram.png\n\nid: {RESOURCE_ID}\nmime: image/png\nfile_extension: png\ntype_: 4",
+}
+PNG = b"\x89PNG\r\n\x1a\nnot really a png"
+
+
+@pytest.fixture
+def raw_export(tmp_path):
+    folder = tmp_path / "raw"
+    (folder / "resources").mkdir(parents=True)
+    for name, text in ITEMS.items():
+        (folder / name).write_text(text, encoding="utf-8")
+    (folder / "resources" / f"{RESOURCE_ID}.png").write_bytes(PNG)
+    return folder
+
+
+@pytest.fixture
+def jex_export(tmp_path, raw_export):
+    path = tmp_path / "book.jex"
+    with tarfile.open(path, "w") as tar:
+        for name in sorted(os.listdir(raw_export)):
+            tar.add(raw_export / name, arcname=name)
+    return path
+
+
+def test_parse_item():
+    title, body, metadata = parse_item(ITEMS[f"{NOTE_ID}.md"])
+    assert title == "Chapter 2: LLM Fundamentals"
+    assert body.startswith("## Tokens\n\n") and body.endswith("```")
+    assert metadata["id"] == NOTE_ID and metadata["type_"] == "1"
+    assert parse_item(ITEMS[f"{NOTE_ID}.md"] + "\n\n") == (title, body, metadata)
+
+
+def test_safe_filename_matches_exported_names():
+    assert safe_filename("Chapter 2: LLM Fundamentals") == "Chapter 2_ LLM Fundamentals"
+    assert safe_filename("Chapter 1. What is AI?") == "Chapter 1. What is AI_"
+
+
+@pytest.mark.parametrize("export", ["raw_export", "jex_export"])
+def test_index_resolves_titles_and_resources(export, request, tmp_path):
+    index = JoplinIndex.load(str(request.getfixturevalue(export)), cache_dir=str(tmp_path / "cache"))
+    assert set(index.notes) == {NOTE_ID}
+    assert index.find_note("Chapter 2_ LLM Fundamentals") == NOTE_ID
+    assert index.find_note("Chapter 2: LLM Fundamentals.md") == NOTE_ID
+    assert index.find_note("Deleted chapter") is None
+    with open(index.resources[RESOURCE_ID], "rb") as f:
+        assert f.read() == PNG
+    md = index.note_markdown(NOTE_ID)
+    assert f"![diagram]({index.resources[RESOURCE_ID]})" in md
+    # Links inside code are left alone
+    assert f"![kept](:/{RESOURCE_ID})" in md
+
+
+def test_notes_ending_in_a_newline_are_indexed(raw_export, tmp_path):
+    note = raw_export / f"{NOTE_ID}.md"
+    note.write_text(ITEMS[f"{NOTE_ID}.md"] + "\n", encoding="utf-8")
+    index = JoplinIndex.load(str(raw_export), cache_dir=str(tmp_path / "cache"))
+    assert index.find_note("Chapter 2: LLM Fundamentals") == NOTE_ID
+
+def test_convert_reads_chapters_from_jex(tmp_path, jex_export, monkeypatch):
+    chapters_txt = tmp_path / "chapters.txt"
+    chapters_txt.write_text("<partname>PART 1\nChapter 2_ LLM Fundamentals\nMissing chapter\n")
+    seen = {}
+
+    def fake_convert_file(input_file, to, outputfile=None, extra_args=None, cache_dir=None):
+        with open(input_file, encoding="utf-8") as f:
+            seen["markdown"] = f.read()
+        with open(outputfile, "w") as outf:
+            outf.write("fake docx")
+    monkeypatch.setattr(convert.pandoc_runner, "convert_file", fake_convert_file)
+    convert.convert_markdowns_to_docx(output_file=str(tmp_path / "out.docx"), chapters_file=str(chapters_txt),
+                                      joplin_export=str(jex_export), cache_dir=str(tmp_path / "cache"),
+                                      optimize_images=False)
+    assert "# PART 1" in seen["markdown"]
+    assert "## Tokens" in seen["markdown"]
+    assert f"](:/{RESOURCE_ID})" not in seen["markdown"].split("```")[0]
@@ -0,0 +1,76 @@
+import os
+import stat
+import subprocess
+import sys
+
+import pytest
+
+import pandoc_runner
+
+FAKE_PANDOC = """#!/bin/sh
+echo "$1" >> "{calls}"
+case "$1" in
+  --version) echo "pandoc 9.{minor}"; echo "Features: +server +lua" ;;
+  --help) echo "pandoc [OPTIONS] [FILES]"; echo "  -f FORMAT  --from=FORMAT"; echo "  --highlight-style=STYLE|FILE" ;;
+  *) echo "no conversions here" >&2; exit 3 ;;
+esac
+"""
+
+
+@pytest.fixture
+def fake_pandoc(tmp_path, monkeypatch):
+    calls = tmp_path / "calls.txt"
+    path = tmp_path / "pandoc"
+
+    def write(minor):
+        path.write_text(FAKE_PANDOC.format(calls=calls, minor=minor))
+        path.chmod(path.stat().st_mode | stat.S_IEXEC)
+
+    write(1)
+    monkeypatch.setenv("PYPANDOC_PANDOC", str(path))
+    monkeypatch.setenv("JOPLIN_DOCX_CACHE", str(tmp_path / "cache"))
+    pandoc_runner.clear_memo()
+    yield write, lambda: calls.read_text().split() if calls.exists() else []
+    pandoc_runner.clear_memo()
+
+
+def test_pandoc_info_is_probed_once_and_cached_on_disk(fake_pandoc):
+    write, calls = fake_pandoc
+    assert pandoc_runner.get_pandoc_version() == "9.1"
+    assert pandoc_runner.supports("--highlight-style") and not pandoc_runner.supports("--syntax-highlighting")
+    assert calls() == ["--version", "--help"]
+    # A new process finds the info on disk
+    pandoc_runner.clear_memo()
+    assert pandoc_runner.get_pandoc_version() == "9.1"
+    assert len(calls()) == 2
+    # A changed binary is probed again
+    write(22)
+    os.utime(pandoc_runner.get_pandoc_path(), (1, 1))
+    pandoc_runner.clear_memo()
+    assert pandoc_runner.get_pandoc_version() == "9.22"
+    assert len(calls()) == 4
+
+
+def test_pandoc_info_is_kept_per_cache_root(fake_pandoc, tmp_path):
+    write, calls = fake_pandoc
+    assert pandoc_runner.get_pandoc_version(tmp_path / "one") == "9.1"
+    assert os.listdir(tmp_path / "one" / "pandoc")
+    assert not (tmp_path / "cache").exists()
+    # Another cache root probes pandoc again and keeps its own info
+    write(22)
+    assert pandoc_runner.get_pandoc_version(tmp_path / "two") == "9.22"
+    assert pandoc_runner.get_pandoc_version(tmp_path / "one") == "9.1"
+    assert len(calls()) == 4
+
+def test_run_raises_with_pandoc_message(fake_pandoc):
+    with pytest.raises(RuntimeError, match="no conversions here"):
+        pandoc_runner.convert_text("# Hi", "docx", format="markdown")
+
+
+def test_convert_imports_no_heavy_modules():
+    code = ("import sys, convert; "
+            "print(sorted({name.split('.')[0] for name in sys.modules} & "
+            "{'docx', 'lxml', 'PIL', 'pygments', 'pypandoc', 'argparse'}))")
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    assert out.strip() == "[]"
@@ -0,0 +1,67 @@
+import json
+
+import pandoc_runner
+import pytest
+
+import preflight
+from convert import convert_markdowns_to_docx
+from preflight import MISSING_CHAPTER, MISSING_IMAGE, MISSING_RESOURCE, preflight as run_preflight
+
+
+@pytest.fixture
+def book(tmp_path):
+    folder = tmp_path / "book"
+    (folder / "_resources").mkdir(parents=True)
+    (folder / "_resources" / "diagram.png").write_bytes(b"png")
+    (folder / "Chapter 1. Intro.md").write_text(
+        "# Intro\n\n![ok](_resources/diagram.png)\n\n![broken](_resources/diagam.png)\n\n"
+        "```\n![in code](_resources/none.png)\n```\n\n![web](https://example.com/x.png)\n"
+    )
+    (folder / "Chapter 2. Tokens.md").write_text("# Tokens\n\n![res](:/" + "c" * 32 + ")\n")
+    chapters = tmp_path / "chapters.txt"
+    chapters.write_text("<partname> Part 1\nChapter 1. Intro\nChapter 2. Tokens.md\n# comment\nChapter 3. Tokns\n")
+    return folder, chapters
+
+
+def test_report_lists_missing_chapters_images_and_resources(book):
+    folder, chapters = book
+    report = run_preflight(chapters_file=str(chapters), folder_name=str(folder), jobs=4)
+    assert not report.ok
+    assert report.chapters == 3
+    assert report.images == 3
+    kinds = [(p["kind"], p["name"], p["chapter"]) for p in report.problems]
+    assert kinds == [
+        (MISSING_IMAGE, "_resources/diagam.png", "Chapter 1. Intro"),
+        (MISSING_RESOURCE, "c" * 32, "Chapter 2. Tokens.md"),
+        (MISSING_CHAPTER, "Chapter 3. Tokns", None),
+    ]
+    assert report.problems[0]["suggestions"] == ["_resources/diagram.png"]
+    assert report.problems[2]["suggestions"][0] == "Chapter 2. Tokens"
+    assert "did you mean 'Chapter 2. Tokens'" in report.format()
+    assert json.loads(json.dumps(report.to_dict()))["ok"] is False
+
+
+def test_clean_book_is_ok(tmp_path):
+    md = tmp_path / "a.md"
+    md.write_text("# A\n\nNo images.")
+    report = run_preflight(md_files=[str(md)])
+    assert report.ok
+    assert report.format().startswith("Checked 1 chapters and 0 images: no problems")
+
+
+def test_strict_conversion_fails_before_pandoc(book, tmp_path, monkeypatch):
+    folder, chapters = book
+    def fail(*args, **kwargs):
+        raise AssertionError("pandoc should not run")
+    monkeypatch.setenv("JOPLIN_DOCX_CACHE", str(tmp_path / "docx-cache"))
+    monkeypatch.setattr(pandoc_runner, "convert_file", fail)
+    with pytest.raises(ValueError, match="missing chapter: Chapter 3. Tokns"):
+        convert_markdowns_to_docx(output_file=str(tmp_path / "out.docx"), chapters_file=str(chapters),
+                                  folder_name=str(folder), strict=True)
+
+
+def test_main_exit_status(book, monkeypatch, capsys):
+    folder, chapters = book
+    monkeypatch.setattr("sys.argv", ["preflight.py", str(chapters), "--folder", str(folder), "--json"])
+    assert preflight.main() == 1
+    assert len(json.loads(capsys.readouterr().out)["problems"]) == 3
@@ -0,0 +1,60 @@
+from preprocess import DEFAULT_RULES, Preprocessor, Rule, find_in_prose, iter_blocks, IMAGE_LINK_PATTERN
+
+SAMPLE = """# Title
+
+![shot](shot.png) and `![inline](code.png)` stay apart.
+
+```markdown
+![fenced](fence.png)
+```
+
+<!-- ![commented](old.png)
+```
+still a comment -->
+
+~~~~
+![tilde](tilde.png)
+~~~~
+"""
+
+def test_blocks_round_trip():
+    blocks = list(iter_blocks(SAMPLE))
+    assert "".join(text for _, text in blocks) == SAMPLE
+    assert [kind for kind, _ in blocks] == ["text", "fence", "code", "fence", "text", "fence", "code", "fence"]
+
+def test_image_rule_skips_code_and_comments():
+    out = Preprocessor(DEFAULT_RULES).process(SAMPLE)
+    assert "![&nbsp;](shot.png)" in out
+    for untouched in ["`![inline](code.png)`", "![fenced](fence.png)", "![commented](old.png)", "![tilde](tilde.png)"]:
+        assert untouched in out
+
+def test_find_in_prose():
+    assert [m.group(1) for m in find_in_prose(IMAGE_LINK_PATTERN, SAMPLE)] == ["shot.png"]
+
+def test_custom_rules():
+    preprocessor = Preprocessor(DEFAULT_RULES)
+    preprocessor.add_rule(Rule("smart-dash", r"(?<= )--(?= )", "—"))
+    preprocessor.add_rule(Rule("py-alias", r"^(\s*`{3,})py\b", r"\1python", where="fence"))
+    out = preprocessor.process("a -- b `x -- y`\n\n```py\nz -- w\n```\n")
+    assert out == "a — b `x -- y`\n\n```python\nz -- w\n```\n"
+    preprocessor.remove_rule("smart-dash")
+    assert preprocessor.process("a -- b") == "a -- b"
+
+def test_code_renderer():
+    calls = []
+    def render(opening, code, closing):
+        calls.append((opening, code, closing))
+        return None if "keep" in code else "RENDERED\n"
+    preprocessor = Preprocessor(DEFAULT_RULES, code_renderer=render)
+    preprocessor.add_rule(Rule("py-alias", r"^(\s*`{3,})py\b", r"\1python", where="fence"))
+    out = preprocessor.process("a\n\n```py\nx = 1\n```\n\n```\nkeep\n```\n\n```\nunclosed\n")
+    assert out == "a\n\nRENDERED\n\n```\nkeep\n```\n\n```\nunclosed\n"
+    assert calls == [("```python\n", "x = 1\n", "```\n"), ("```\n", "keep\n", "```\n")]
+
+def test_comment_opener_in_code_span():
+    md = "Write `` `<!--` `` to open a comment.\n\n![shot](shot.png)\n\n```python\nx = 1\n```\n"
+    assert [kind for kind, _ in iter_blocks(md)] == ["text", "fence", "code", "fence"]
+    stats = {}
+    out = Preprocessor(DEFAULT_RULES).process(md, stats)
+    assert "![&nbsp;](shot.png)" in out and "`` `<!--` ``" in out
+    assert stats == {"images": 1, "code_blocks": 1}
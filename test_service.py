@@ -0,0 +1,177 @@
+import io
+import json
+import queue
+import threading
+import urllib.error
+import urllib.request
+import zipfile
+
+import pytest
+
+import service
+from service import ConversionService, make_server
+
+
+@pytest.fixture(autouse=True)
+def isolated_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("JOPLIN_DOCX_CACHE", str(tmp_path / "docx-cache"))
+
+
+def _bundle(files):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w") as archive:
+        for name, text in files.items():
+            archive.writestr(name, text)
+    return data.getvalue()
+
+
+BUNDLE = _bundle({
+    "chapters.txt": "<partname> Part One\nintro\ntokens\n",
+    "intro.md": "# Intro\n\nHello from the service.\n",
+    "tokens.md": "# Tokens\n\n```python\nprint('hi')\n```\n",
+})
+
+
+def _document_xml(docx):
+    with zipfile.ZipFile(io.BytesIO(docx)) as archive:
+        return archive.read("word/document.xml").decode("utf-8")
+
+
+@pytest.fixture
+def server():
+    conversion_service = ConversionService(workers=2, queue_size=4).start()
+    http_server = make_server(conversion_service, port=0)
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{http_server.server_address[1]}"
+    http_server.shutdown()
+    http_server.server_close()
+    conversion_service.stop()
+
+
+def _post(url, data, content_type="application/zip"):
+    request = urllib.request.Request(url, data=data, headers={"Content-Type": content_type}, method="POST")
+    with urllib.request.urlopen(request) as response:
+        return response.read()
+
+
+def test_converts_bundles_concurrently(server):
+    results = [None] * 4
+    def post(i):
+        results[i] = _post(f"{server}/convert?header_text=Service+Book", BUNDLE)
+    threads = [threading.Thread(target=post, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for docx in results:
+        xml = _document_xml(docx)
+        assert "Hello from the service." in xml and "Part One" in xml
+    markdown = _post(f"{server}/convert", b"# Single\n\nJust one document.", "text/markdown")
+    assert "Just one document." in _document_xml(markdown)
+    with urllib.request.urlopen(f"{server}/metrics") as response:
+        metrics = json.load(response)
+    assert metrics["done"] == 5 and metrics["failed"] == 0
+    assert metrics["latency_p50_s"] > 0 and metrics["docs_per_s"] > 0
+
+
+def test_bad_bundle_is_rejected(server):
+    with pytest.raises(urllib.error.HTTPError) as error:
+        _post(f"{server}/convert", _bundle({"../evil.md": "# no"}))
+    assert error.value.code == 422
+    assert "outside the bundle" in json.load(error.value)["error"]
+
+
+def test_queue_limit_timeout_and_cancel():
+    conversion_service = ConversionService(workers=1, queue_size=2, timeout=0.01)
+    # Not started, so jobs stay queued
+    expired = conversion_service.submit(BUNDLE)
+    cancelled = conversion_service.submit(BUNDLE, timeout=60)
+    with pytest.raises(queue.Full):
+        conversion_service.submit(BUNDLE)
+    assert conversion_service.cancel(cancelled.id)
+    threading.Event().wait(0.02)
+    conversion_service.start()
+    assert expired.wait(10).status == "timeout"
+    assert cancelled.wait(10).status == "cancelled"
+    metrics = conversion_service.metrics()
+    assert (metrics["rejected"], metrics["timeout"], metrics["cancelled"]) == (1, 1, 1)
+    conversion_service.stop()
+
+
+def test_running_pandoc_is_killed_on_cancel(monkeypatch):
+    conversion_service = ConversionService(workers=1).start()
+    monkeypatch.setattr(service, "POLL_INTERVAL_S", 0.01)
+    popen = service.subprocess.Popen
+    # Stand in for a pandoc run that hangs
+    monkeypatch.setattr(service.subprocess, "Popen", lambda args, **kwargs: popen(["sleep", "30"], **kwargs))
+    job = conversion_service.submit(b"# Slow", "text/markdown", timeout=60)
+    threading.Event().wait(0.5)
+    assert job.status == "running"
+    conversion_service.cancel(job.id)
+    assert job.wait(5).status == "cancelled"
+    conversion_service.stop()
+
+
+def test_bundles_cannot_embed_host_files(server, tmp_path):
+    from PIL import Image
+    secret = tmp_path / "outside_secret.png"
+    Image.new("RGB", (8, 8), (1, 2, 3)).save(secret)
+    (tmp_path / "secret.md").write_text("# Secret chapter\n")
+    for markdown in (f"![x]({secret})", "![x](../outside_secret.png)"):
+        with pytest.raises(urllib.error.HTTPError) as error:
+            _post(f"{server}/convert", markdown.encode("utf-8"), "text/markdown")
+        assert error.value.code == 422
+        assert "outside the bundle" in json.load(error.value)["error"]
+    with pytest.raises(urllib.error.HTTPError) as error:
+        _post(f"{server}/convert", _bundle({"chapters.txt": f"{tmp_path / 'secret'}\n"}))
+    assert "Chapter outside the bundle" in json.load(error.value)["error"]
+    # pandoc's sandbox refuses what the image rule does not see
+    docx = _post(f"{server}/convert", f'# Raw\n\n<img src="{secret}">\n\n![ref][r]\n\n[r]: {secret}\n'.encode("utf-8"),
+                 "text/markdown")
+    with zipfile.ZipFile(io.BytesIO(docx)) as archive:
+        assert not [name for name in archive.namelist() if name.startswith("word/media/")]
+    # Images inside the bundle are still embedded
+    image = io.BytesIO()
+    Image.new("RGB", (8, 8), (4, 5, 6)).save(image, "PNG")
+    docx = _post(f"{server}/convert", _bundle({"a.md": "# A\n\n![in](img/in.png)\n", "img/in.png": image.getvalue()}))
+    with zipfile.ZipFile(io.BytesIO(docx)) as archive:
+        assert [name for name in archive.namelist() if name.startswith("word/media/")]
+
+
+def test_queued_jobs_end_at_their_deadline_or_cancel(monkeypatch):
+    conversion_service = ConversionService(workers=1, queue_size=4).start()
+    monkeypatch.setattr(service, "POLL_INTERVAL_S", 0.01)
+    popen = service.subprocess.Popen
+    monkeypatch.setattr(service.subprocess, "Popen", lambda args, **kwargs: popen(["sleep", "30"], **kwargs))
+    busy = conversion_service.submit(b"# Slow", "text/markdown", timeout=60)
+    threading.Event().wait(0.3)
+    # The only worker is busy, so these stay queued
+    expiring = conversion_service.submit(b"# Later", "text/markdown", timeout=0.2)
+    cancelled = conversion_service.submit(b"# Never", "text/markdown", timeout=60)
+    conversion_service.cancel(cancelled.id)
+    assert cancelled.done.is_set() and cancelled.status == "cancelled"
+    assert expiring.wait(2).status == "timeout"
+    assert busy.status == "running"
+    assert conversion_service.metrics()["queued"] == 0
+    conversion_service.cancel(busy.id)
+    assert busy.wait(5).status == "cancelled"
+    conversion_service.stop()
+
+
+def test_cancel_during_preprocessing_skips_pandoc(monkeypatch):
+    conversion_service = ConversionService(workers=1).start()
+    write_book_markdown = service.write_book_markdown
+
+    def cancel_after_first_chapter(items, stream, preprocessor, trace):
+        def chapters():
+            for i, item in enumerate(items):
+                if i == 1:
+                    conversion_service.cancel("job")
+                yield item
+        write_book_markdown(chapters(), stream, preprocessor, trace)
+    monkeypatch.setattr(service, "write_book_markdown", cancel_after_first_chapter)
+    monkeypatch.setattr(service.subprocess, "Popen", lambda *args, **kwargs: pytest.fail("pandoc was started"))
+    job = conversion_service.submit(BUNDLE, job_id="job")
+    assert job.wait(10).status == "cancelled"
+    conversion_service.stop()
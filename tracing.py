@@ -0,0 +1,114 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Not available on Windows; peak RSS is then reported as None
+    resource = None
+
+COUNTERS = ("bytes_read", "bytes_written", "chapters", "images", "code_blocks")
+
+
+def peak_rss_kb(who="self"):
+    """Peak resident set size in KiB of this process ("self") or of its finished subprocesses ("children")."""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere
+    return usage.ru_maxrss // 1024 if os.uname().sysname == "Darwin" else usage.ru_maxrss
+
+
+class BuildTrace:
+    """
+    Per-stage timing and memory trace of one build.
+    Each stage records wall time, CPU time, peak RSS of the process and of
+    its subprocesses (pandoc), and the bytes_read, bytes_written, chapters,
+    images and code_blocks counters its code adds to the record. Entering a
+    stage that already exists accumulates into it, so per-chapter work adds
+    up under one name. Stages entered from worker threads accumulate too, so
+    in parallel builds their summed wall time can exceed the build's.
+    Args:
+        tool: Name of the converter, recorded in the trace
+        on_stage: Optional callback called with each stage record as it ends
+    """
+
+    def __init__(self, tool="convert", on_stage=None):
+        self.tool = tool
+        self.on_stage = on_stage
+        self.stages = {}
+        self.error = None
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+
+    @contextmanager
+    def stage(self, name):
+        """Time a block; the yielded dict collects the counters to add to the stage."""
+        with self._lock:
+            record = self.stages.get(name)
+            if record is None:
+                record = self.stages[name] = {"stage": name, "wall_s": 0.0, "cpu_s": 0.0, "calls": 0}
+                record.update({counter: 0 for counter in COUNTERS})
+        counts = {counter: 0 for counter in COUNTERS}
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield counts
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            with self._lock:
+                record["wall_s"] += wall
+                record["cpu_s"] += cpu
+                record["calls"] += 1
+                for counter in COUNTERS:
+                    record[counter] += counts[counter]
+                record["peak_rss_kb"] = peak_rss_kb()
+                record["peak_rss_children_kb"] = peak_rss_kb("children")
+                snapshot = dict(record)
+            if self.on_stage is not None:
+                self.on_stage(snapshot)
+
+    def to_dict(self):
+        totals = {counter: sum(s[counter] for s in self.stages.values()) for counter in COUNTERS}
+        totals.update({
+            "wall_s": time.perf_counter() - self._wall,
+            "cpu_s": time.process_time() - self._cpu,
+            "peak_rss_kb": peak_rss_kb(),
+            "peak_rss_children_kb": peak_rss_kb("children"),
+        })
+        return {
+            "tool": self.tool,
+            "started_at": self._started,
+            "error": self.error,
+            "total": totals,
+            "stages": list(self.stages.values()),
+        }
+
+    def write(self, path):
+        """Write the trace as JSON to path ("-" for stdout)."""
+        data = json.dumps(self.to_dict(), indent=2)
+        if path == "-":
+            print(data)
+        else:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(data + "\n")
+
+
+def traced_items(items, trace, stage="read_chapters"):
+    """Yield items, timing the reads of a lazy item iterator under `stage`."""
+    items = iter(items)
+    while True:
+        with trace.stage(stage) as counts:
+            item = next(items, None)
+            if item is not None and item["type"] == "chapter":
+                counts["chapters"] += 1
+                if item.get("path"):
+                    counts["bytes_read"] += os.path.getsize(item["path"])
+                else:
+                    counts["bytes_read"] += len(item["markdown"].encode("utf-8"))
+        if item is None:
+            return
+        yield item